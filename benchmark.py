@@ -0,0 +1,620 @@
+import argparse
+import asyncio
+import contextlib
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from attrs import asdict
+
+from car import Car
+from fetch import (
+    Fetcher,
+    HttpFetcher,
+    Page,
+    RecordingFetcher,
+    ReplayFetcher,
+    fixture_path,
+    make_fetcher,
+    record,
+    serve_fixtures,
+)
+from parse_pool import ParsePool
+from rate_limit import RateLimiter, ThrottledFetcher
+from scraper import SearchQuery, search
+
+APP = Path(__file__).parent
+BENCH_FIXTURES = APP.joinpath('fixtures', 'bench')
+RESULTS = APP.joinpath('benchmarks')
+WORKERS = [1, 4, 16]
+PERCENTILES = [50, 90, 99]
+TOLERANCE = 0.1   # slower than this fraction counts as a regression
+HOME = APP.joinpath('01_🏠_Home.py')
+HOME_TARGET = 2.0   # seconds from a cold interpreter to the rendered page
+# searches for the generated fixtures, with the badges their titles use
+SYNTHETIC = {
+    SearchQuery('Volkswagen', 'Golf', 2012, 2016): [
+        '90TSI Trendline',
+        '110TSI Highline',
+        'GTI',
+    ],
+    SearchQuery('Toyota', 'Corolla', 2014, 2018): [
+        'Ascent',
+        'SX',
+        'ZR',
+    ],
+    SearchQuery('Mazda', 'CX-5', 2015, 2019): [
+        'Maxx',
+        'Maxx Sport',
+        'Akera',
+    ],
+}
+SYNTHETIC_PAGES = 3
+PAGE_SIZE = 12   # listings per carsales result page
+
+
+def record_fixtures(
+    queries: list[SearchQuery], directory: Path = BENCH_FIXTURES
+) -> int:
+    # the only step that touches the network, run once to capture pages
+    async def run() -> list[str]:
+        recorder = RecordingFetcher(make_fetcher('http'), directory)
+        fetcher = ThrottledFetcher(recorder, RateLimiter())
+        try:
+            for query in queries:
+                await search(fetcher, query)
+        finally:
+            await fetcher.aclose()
+        return recorder.urls
+
+    urls = asyncio.run(run())
+    directory.mkdir(parents=True, exist_ok=True)
+    directory.joinpath('manifest.json').write_text(
+        json.dumps(
+            {
+                'recorded_at': datetime.datetime.now().isoformat(
+                    timespec='seconds'
+                ),
+                'queries': [asdict(query) for query in queries],
+                'urls': list(dict.fromkeys(urls)),
+            },
+            indent=2,
+        )
+    )
+    return len(urls)
+
+
+def _synthetic_card(
+    rng: random.Random, query: SearchQuery, badges: list[str], number: int
+) -> str:
+    # the markup Car.from_card_html reads, values drawn from rng
+    listing_id = f'SYN-AD-{number:06d}'
+    year = rng.randint(query.min_year, query.max_year)
+    title = (
+        f'{year} {query.make} {query.model} {rng.choice(badges)} '
+        f'{rng.choice(["Auto", "Manual"])} MY{year % 100}'
+    )
+    price = rng.randrange(8000, 45000, 50)
+    if rng.random() < 0.3:
+        price_text, price_info = f'${price:,}*', 'Drive Away'
+    else:
+        price_text, price_info = f'${price:,}*', 'Excl. Govt. Charges'
+    dealer = rng.random() < 0.6
+    seller = (
+        '<div class="ad-type">Dealer Used Car</div>'
+        if dealer
+        else '<div class="seller-type">Private Seller Car</div>'
+    )
+    details = {
+        'Odometer': f'{rng.randrange(5000, 250000, 100):,} km',
+        'Body Style': rng.choice(['Hatch', 'Sedan', 'Wagon', 'SUV']),
+        'Transmission': rng.choice(['Automatic', 'Manual']),
+        'Engine': rng.choice(
+            ['4cyl 1.4L Turbo Petrol', '4cyl 2.0L Petrol', '4cyl 2.2L Diesel']
+        ),
+    }
+    items = ''.join(
+        f'<li data-type="{name}">{value}</li>'
+        for name, value in details.items()
+    )
+    return (
+        f'<div class="listing-item card {"cs-select" if dealer else ""}" '
+        f'id="{listing_id}" data-webm-vehcategory='
+        f'"{"dealer" if dealer else "private"}" '
+        f'data-webm-make="{query.make}" data-webm-model="{query.model}" '
+        f'data-webm-state="{rng.choice(["NSW", "VIC", "QLD", "WA", "SA"])}">'
+        f'<a href="/cars/details/{year}-{query.make}-{query.model}/'
+        f'{listing_id}/">{title}</a>'
+        f'<h3><a>{title}</a></h3>'
+        f'<div class="price"><a>{price_text}</a></div>'
+        f'<div class="price-info">{price_info}</div>'
+        f'<ul class="key-details">{items}</ul>'
+        f'{seller}</div>'
+    )
+
+
+def synthetic_fixtures(
+    directory: Path = BENCH_FIXTURES, seed: int = 0
+) -> int:
+    # made-up result pages shaped like carsales', the same bytes for the
+    # same seed, so the benchmark runs offline without recorded pages
+    rng = random.Random(seed)
+    urls = []
+    number = 0
+    for query, badges in SYNTHETIC.items():
+        num_results = SYNTHETIC_PAGES * PAGE_SIZE
+        url = query.url
+        for page_number in range(SYNTHETIC_PAGES):
+            cards = []
+            for _ in range(PAGE_SIZE):
+                cards.append(_synthetic_card(rng, query, badges, number))
+                number += 1
+            next_url = None
+            if page_number + 1 < SYNTHETIC_PAGES:
+                offset = (page_number + 1) * PAGE_SIZE
+                next_url = f'{query.url}&offset={offset}'
+            pagination = (
+                '<ul class="pagination">'
+                f'<li><a href="{next_url}">Next</a></li></ul>'
+                if next_url is not None
+                else ''
+            )
+            html = (
+                '<html><head><title>Cars for sale</title></head><body>'
+                f'<h1 class="title">{num_results} {query.make} '
+                f'{query.model} cars for sale in Australia</h1>'
+                f'<div class="listing-items">{"".join(cards)}</div>'
+                f'{pagination}</body></html>'
+            )
+            record(Page(url, html, 200, 0.0, 'synthetic'), directory)
+            urls.append(url)
+            url = next_url
+
+    directory.joinpath('manifest.json').write_text(
+        json.dumps(
+            {
+                'synthetic': True,
+                'seed': seed,
+                'queries': [asdict(query) for query in SYNTHETIC],
+                'urls': urls,
+            },
+            indent=2,
+        )
+        + '\n'
+    )
+    return len(urls)
+
+
+def load_urls(directory: Path = BENCH_FIXTURES) -> list[str]:
+    manifest = directory.joinpath('manifest.json')
+    if not manifest.exists():
+        raise FileNotFoundError(
+            f'no fixtures in {directory}, generate them with: python '
+            'benchmark.py fixtures, or record real pages with: python '
+            'benchmark.py record MAKE MODEL ...'
+        )
+    return json.loads(manifest.read_text())['urls']
+
+
+def _percentiles(samples: list[float]) -> dict[str, float]:
+    if not samples:
+        return {}
+    values = np.percentile(samples, PERCENTILES)
+    summary = {f'p{p}': float(v) for p, v in zip(PERCENTILES, values)}
+    summary['max'] = float(max(samples))
+    return summary
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+
+async def _replay(fetcher: Fetcher, urls: list[str], workers: int) -> dict:
+    # each worker takes the next url, fetches it and parses it the same
+    # way the scraper does, timing both stages
+    queue: asyncio.Queue = asyncio.Queue()
+    for url in urls:
+        queue.put_nowait(url)
+    fetch_times, parse_times = [], []
+    num_listings = 0
+
+    async def worker():
+        nonlocal num_listings
+        while not queue.empty():
+            url = queue.get_nowait()
+            start = time.perf_counter()
+            page = await fetcher.fetch(url)
+            fetched = time.perf_counter()
+            cars = await asyncio.to_thread(Car.from_page_source, page.html)
+            parse_times.append(time.perf_counter() - fetched)
+            fetch_times.append(fetched - start)
+            num_listings += len(cars)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    seconds = time.perf_counter() - start
+    return {
+        'pages': len(urls),
+        'listings': num_listings,
+        'seconds': seconds,
+        'pages_per_second': len(urls) / seconds,
+        'listings_per_second': num_listings / seconds,
+        'latency': {
+            'fetch': _percentiles(fetch_times),
+            'parse': _percentiles(parse_times),
+        },
+    }
+
+
+def run_case(
+    workers: int, backend: str, directory: Path, repeat: int
+) -> dict:
+    # runs in its own process so peak rss belongs to this case alone
+    urls = load_urls(directory) * repeat
+    server = None
+    if backend == 'http':
+        server = serve_fixtures(directory)
+        fetcher = HttpFetcher(
+            workers, base_url=f'http://127.0.0.1:{server.server_port}'
+        )
+    else:
+        fetcher = ReplayFetcher(directory)
+
+    async def run() -> dict:
+        try:
+            return await _replay(fetcher, urls, workers)
+        finally:
+            await fetcher.aclose()
+
+    try:
+        # the per-listing prints would otherwise be most of what's timed
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = asyncio.run(run())
+    finally:
+        if server is not None:
+            server.shutdown()
+    return {'workers': workers, **result, 'peak_rss_mb': _peak_rss_mb()}
+
+
+def _version() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(
+    workers: list[int] = WORKERS,
+    backend: str = 'http',
+    directory: Path = BENCH_FIXTURES,
+    repeat: int = 3,
+) -> dict:
+    cases = []
+    context = multiprocessing.get_context('spawn')
+    for num_workers in workers:
+        with ProcessPoolExecutor(1, mp_context=context) as executor:
+            case = executor.submit(
+                run_case, num_workers, backend, directory, repeat
+            ).result()
+        print(
+            f'{num_workers:>3} workers: '
+            f'{case["pages_per_second"]:8.1f} pages/s '
+            f'{case["listings_per_second"]:9.1f} listings/s '
+            f'fetch p90 {case["latency"]["fetch"]["p90"] * 1000:7.1f} ms '
+            f'parse p90 {case["latency"]["parse"]["p90"] * 1000:7.1f} ms '
+            f'peak rss {case["peak_rss_mb"]:6.0f} MB'
+        )
+        cases.append(case)
+
+    return {
+        'version': _version(),
+        'run_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'backend': backend,
+        'repeat': repeat,
+        'cases': cases,
+    }
+
+
+def compare(baseline: dict, current: dict, tolerance: float = TOLERANCE):
+    # list of regressions beyond tolerance, matched on worker count
+    if baseline['backend'] != current['backend']:
+        raise ValueError('benchmarks used different fetch backends')
+    previous = {case['workers']: case for case in baseline['cases']}
+    regressions = []
+    for case in current['cases']:
+        old = previous.get(case['workers'])
+        if old is None:
+            continue
+        for metric in ('pages_per_second', 'listings_per_second'):
+            change = case[metric] / old[metric] - 1
+            if change < -tolerance:
+                regressions.append(
+                    f'{case["workers"]} workers {metric} {change:+.0%}'
+                )
+        for stage in ('fetch', 'parse'):
+            change = (
+                case['latency'][stage]['p90']
+                / old['latency'][stage]['p90']
+                - 1
+            )
+            if change > tolerance:
+                regressions.append(
+                    f'{case["workers"]} workers {stage} p90 {change:+.0%}'
+                )
+    return regressions
+
+
+def run_parse(
+    processes: list[int],
+    directory: Path = BENCH_FIXTURES,
+    repeat: int = 10,
+) -> dict:
+    # recorded pages parsed in this thread, then through parse pools of
+    # each size. cpu time per core shows how many processes a given
+    # fetch rate needs
+    pages = [
+        fixture_path(url, directory).read_text()
+        for url in load_urls(directory)
+    ] * repeat
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        # imports and first-call caches, the pools are warmed up too
+        Car.from_page_source(pages[0])
+    start, cpu_start = time.perf_counter(), time.process_time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        num_listings = sum(len(Car.from_page_source(html)) for html in pages)
+    seconds = time.perf_counter() - start
+    baseline = {
+        'processes': 0,
+        'pages_per_second': len(pages) / seconds,
+        'listings_per_second': num_listings / seconds,
+        'listings_per_core_second': num_listings
+        / (time.process_time() - cpu_start),
+    }
+    print(
+        f'  in thread: {baseline["listings_per_second"]:9.1f} listings/s'
+    )
+
+    cases = [baseline]
+    for num_processes in processes:
+        parser = ParsePool(num_processes, quiet=True)
+        try:
+            parser.warm()
+
+            async def run():
+                await asyncio.gather(*(parser.parse(html) for html in pages))
+
+            asyncio.run(run())
+        finally:
+            parser.close()
+        stats = parser.stats
+        case = {
+            'processes': num_processes,
+            'pages_per_second': stats.pages / stats.elapsed,
+            'listings_per_second': stats.listings_per_second,
+            'listings_per_core_second': stats.listings_per_core_second,
+            'utilization': stats.utilization,
+            'speedup': stats.listings_per_second
+            / baseline['listings_per_second'],
+        }
+        print(
+            f'{num_processes:>3} processes: '
+            f'{case["listings_per_second"]:9.1f} listings/s '
+            f'{case["listings_per_core_second"]:8.1f} per core '
+            f'{case["utilization"]:4.0%} busy, '
+            f'{case["speedup"]:.1f}x the thread'
+        )
+        cases.append(case)
+
+    return {
+        'version': _version(),
+        'run_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'repeat': repeat,
+        'cases': cases,
+    }
+
+
+def _run_python(code: str, *flags: str) -> tuple[float, str]:
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, *flags, '-c', code],
+        cwd=APP,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return time.perf_counter() - start, process.stderr
+
+
+def import_report(page: Path, top: int = 10) -> dict:
+    # runs the page's module level code in a fresh interpreter under
+    # -X importtime, which is every import but not main()
+    code = (
+        f'import runpy, sys; sys.path.insert(0, {str(APP)!r}); '
+        f'runpy.run_path({str(page)!r}, run_name="startup")'
+    )
+    seconds, stderr = _run_python(code, '-X', 'importtime')
+    top_level = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line.split('|')
+        # nested imports are indented under the module that pulled them in
+        if cumulative.strip().isdigit() and not name[1:].startswith(' '):
+            top_level.append((name.strip(), int(cumulative) / 1e6))
+    top_level.sort(key=lambda item: item[1], reverse=True)
+    return {
+        'page': page.name,
+        'seconds': seconds,
+        'import_seconds': sum(seconds for _, seconds in top_level),
+        'slowest': top_level[:top],
+    }
+
+
+def first_render(page: Path) -> float:
+    # cold interpreter to the end of the first script run, the same work
+    # the server does before the browser sees anything
+    code = (
+        'from streamlit.testing.v1 import AppTest; '
+        f'app = AppTest.from_file({str(page)!r}, default_timeout=60); '
+        'app.run(); '
+        'assert not app.exception, app.exception'
+    )
+    seconds, _ = _run_python(code)
+    return seconds
+
+
+def run_startup(repeat: int = 3) -> dict:
+    pages = [HOME, *sorted(APP.joinpath('pages').glob('*.py'))]
+    reports = []
+    for page in pages:
+        # best of a few runs, the first one also pays for a cold disk cache
+        report = min(
+            (import_report(page) for _ in range(repeat)),
+            key=lambda report: report['seconds'],
+        )
+        print(
+            f'{page.name:<32} {report["seconds"]:6.2f}s, imports '
+            f'{report["import_seconds"]:6.2f}s, slowest: '
+            + ', '.join(
+                f'{name} {seconds:.2f}s'
+                for name, seconds in report['slowest'][:3]
+            )
+        )
+        reports.append(report)
+
+    home = min(first_render(HOME) for _ in range(repeat))
+    print(f'home first render {home:.2f}s (target {HOME_TARGET:.2f}s)')
+    return {
+        'version': _version(),
+        'run_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pages': reports,
+        'home_first_render': home,
+        'home_target': HOME_TARGET,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='offline scrape and app startup benchmarks'
+    )
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    record = commands.add_parser('record', help='capture fixtures, online')
+    record.add_argument('make')
+    record.add_argument('model')
+    record.add_argument('min_year', type=int)
+    record.add_argument('max_year', type=int)
+    record.add_argument('--fixtures', type=Path, default=BENCH_FIXTURES)
+
+    fixtures = commands.add_parser(
+        'fixtures', help='generate synthetic fixtures, offline'
+    )
+    fixtures.add_argument('--seed', type=int, default=0)
+    fixtures.add_argument('--fixtures', type=Path, default=BENCH_FIXTURES)
+
+    run = commands.add_parser('run', help='replay fixtures, offline')
+    run.add_argument('--workers', type=int, nargs='+', default=WORKERS)
+    run.add_argument(
+        '--backend', choices=['http', 'replay'], default='http'
+    )
+    run.add_argument('--repeat', type=int, default=3)
+    run.add_argument('--fixtures', type=Path, default=BENCH_FIXTURES)
+    run.add_argument('--output', type=Path)
+    run.add_argument('--compare', type=Path)
+
+    parse = commands.add_parser(
+        'parse', help='parse throughput per core, offline'
+    )
+    parse.add_argument(
+        '--processes', type=int, nargs='+', default=[1, 2, 4]
+    )
+    parse.add_argument('--repeat', type=int, default=10)
+    parse.add_argument('--fixtures', type=Path, default=BENCH_FIXTURES)
+    parse.add_argument('--output', type=Path)
+
+    startup = commands.add_parser(
+        'startup', help='import times and home page time to first render'
+    )
+    startup.add_argument('--repeat', type=int, default=3)
+    startup.add_argument('--output', type=Path)
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        query = SearchQuery(
+            args.make, args.model, args.min_year, args.max_year
+        )
+        print(record_fixtures([query], args.fixtures), 'pages recorded')
+        return
+
+    if args.command == 'fixtures':
+        print(synthetic_fixtures(args.fixtures, args.seed), 'pages written')
+        return
+
+    if args.command == 'parse':
+        results = run_parse(args.processes, args.fixtures, args.repeat)
+        output = args.output or RESULTS.joinpath(
+            f'parse-{results["run_at"].replace(":", "")}.json'
+        )
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(results, indent=2))
+        print('saved', output)
+        return
+
+    if args.command == 'startup':
+        results = run_startup(args.repeat)
+        output = args.output or RESULTS.joinpath(
+            f'startup-{results["run_at"].replace(":", "")}.json'
+        )
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(results, indent=2))
+        print('saved', output)
+        if results['home_first_render'] > HOME_TARGET:
+            sys.exit(1)
+        return
+
+    results = run_benchmark(
+        args.workers, args.backend, args.fixtures, args.repeat
+    )
+    output = args.output or RESULTS.joinpath(
+        f'{results["run_at"].replace(":", "")}.json'
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+    print('saved', output)
+
+    if args.compare is not None:
+        regressions = compare(json.loads(args.compare.read_text()), results)
+        for regression in regressions:
+            print('regression:', regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,57 @@
 import re
-from typing import Optional, Self
+import sys
+from html import unescape
+from typing import TYPE_CHECKING, Iterable, Optional, Self
+from urllib.parse import urljoin
 
 from attrs import frozen
-from selenium.webdriver.common.by import By
-from selenium.webdriver.remote.webelement import WebElement
 
+import normalize
+import tracing
 
-@frozen
+# bs4 and selenium are imported where they're used, so reading stored
+# listings doesn't load the scraping stack
+if TYPE_CHECKING:
+    from bs4 import BeautifulSoup, Tag
+    from selenium.webdriver.remote.webelement import WebElement
+
+BASE_URL = 'https://www.carsales.com.au'
+CARD_SELECTOR = 'div.listing-item'
+# the opening tag of the first element with class title, like '.title'
+TITLE_TAG = re.compile(
+    r'<[a-zA-Z][^>]*\sclass=(["\'])(?:[^"\']*\s)?title(?:\s[^"\']*)?\1[^>]*>'
+)
+# the first word of text after a position, skipping tags
+FIRST_WORD = re.compile(r'(?:\s|<[^>]*>)*([^<\s]+)')
+# low-cardinality text fields, interned so repeats share one string
+CATEGORICALS = [
+    'make',
+    'model',
+    'state',
+    'body_style',
+    'transmission',
+    'engine',
+    'seller_type',
+]
+
+
+def html_text(elem: Optional['Tag']) -> str:
+    # mimic WebElement.text, which collapses whitespace in rendered text
+    if elem is None:
+        return ''
+    return ' '.join(elem.get_text(' ').split())
+
+
+def parse_html(html: str) -> 'BeautifulSoup':
+    from bs4 import BeautifulSoup, FeatureNotFound
+
+    try:
+        return BeautifulSoup(html, 'lxml')
+    except FeatureNotFound:
+        return BeautifulSoup(html, 'html.parser')
+
+
+@frozen   # attrs classes are slotted by default
 class Car:
     link: str
     title: str
@@ -28,95 +73,135 @@ class Car:
     engine: str
     seller_type: Optional[str]
     build_date: Optional[str] = None
-    odometer: Optional[int] = None
+    odometer: Optional[str] = None
 
     @classmethod
-    def from_card_webelement(cls, card: WebElement) -> Self:
-        link = card.find_element(By.TAG_NAME, 'a').get_attribute('href')
-        title = card.find_element(By.TAG_NAME, 'h3').text
+    def from_card_webelement(cls, card: 'WebElement') -> Self:
+        from selenium.webdriver.common.by import By
 
-        print('Adding', title)
-        year = int(title.split(' ')[0])
+        # every find_element, .text and get_attribute is a WebDriver round
+        # trip, counted per listing under this span
+        with tracing.span('car.from_card_webelement'):
+            link = card.find_element(By.TAG_NAME, 'a').get_attribute('href')
+            title = card.find_element(By.TAG_NAME, 'h3').text
+            price_text = card.find_element(By.CSS_SELECTOR, 'div.price').text
+            price_info = card.find_element(By.CLASS_NAME, 'price-info').text
 
-        # TODO: split into drive away and ex gov charges
-        price_text = card.find_element(By.CSS_SELECTOR, 'div.price').text
-        price_info = card.find_element(By.CLASS_NAME, 'price-info').text
-        price_match = re.match(r'\$([\d,]+)', price_text)
-        if price_match is not None:
-            price = price_match.groups()[0].replace(',', '')
-            price = int(price)
-        else:
-            price = None
+            details_list = card.find_element(By.CLASS_NAME, 'key-details')
+            details_items = [
+                (item.get_attribute('data-type'), item.text)
+                for item in details_list.find_elements(By.TAG_NAME, 'li')
+            ]
+            card_attrs = {
+                'id': card.get_attribute('id'),
+                'category': card.get_attribute('data-webm-vehcategory'),
+                'make': card.get_attribute('data-webm-make'),
+                'model': card.get_attribute('data-webm-model'),
+                'state': card.get_attribute('data-webm-state'),
+            }
 
-        price_info_match = re.match(r'\$([\d,]+)', price_info)
-        if price_info_match is not None:
-            price_info_price = price_info_match.groups()[0].replace(',', '')
-            price_info_price = int(price_info_price)
-        else:
-            price_info_price = None
-
-        drive_away_price = (
-            price
-            if any('Drive Away' in text for text in [price_text, price_info])
-            else None
-        )
+            class_ = card.get_attribute('class').strip()
+            if 'cs-select' in class_:
+                seller_type_elem = card.find_element(By.CLASS_NAME, 'ad-type')
+            else:
+                seller_type_elem = card.find_element(
+                    By.CLASS_NAME, 'seller-type'
+                )
 
-        ex_gov_price = (
-            price
-            if all(
-                'Drive Away' not in text for text in [price_text, price_info]
+            return cls._from_fields(
+                link,
+                title,
+                price_text,
+                price_info,
+                details_items,
+                card_attrs,
+                seller_type_elem.text,
             )
-            else price_info_price
-        )
 
-        details_list = card.find_element(By.CLASS_NAME, 'key-details')
-        details_items = details_list.find_elements(By.TAG_NAME, 'li')
-        details = {}
-        details = {
-            item.get_attribute('data-type')
-            .lower()
-            .replace(' ', '_'): item.text
-            for item in details_items
+    @classmethod
+    def from_card_html(cls, card: 'str | Tag') -> Self:
+        # parse a card from an outerHTML snapshot, no WebDriver calls
+        if isinstance(card, str):
+            soup = parse_html(card)
+            card = soup.select_one(CARD_SELECTOR) or soup
+
+        link = urljoin(BASE_URL, card.find('a').get('href'))
+        title = html_text(card.find('h3'))
+        price_text = html_text(card.select_one('div.price'))
+        price_info = html_text(card.select_one('.price-info'))
+
+        details_list = card.select_one('.key-details')
+        details_items = [
+            (item.get('data-type'), html_text(item))
+            for item in details_list.find_all('li')
+        ]
+        card_attrs = {
+            'id': card.get('id'),
+            'category': card.get('data-webm-vehcategory'),
+            'make': card.get('data-webm-make'),
+            'model': card.get('data-webm-model'),
+            'state': card.get('data-webm-state'),
         }
-        details['id'] = card.get_attribute('id')
-        details['category'] = card.get_attribute('data-webm-vehcategory')
-        details['make'] = card.get_attribute('data-webm-make')
-        details['model'] = card.get_attribute('data-webm-model')
-        details['state'] = card.get_attribute('data-webm-state')
 
-        class_ = card.get_attribute('class').strip()
+        class_ = ' '.join(card.get('class', []))
         if 'cs-select' in class_:
-            seller_type_elem = card.find_element(By.CLASS_NAME, 'ad-type')
+            seller_type_elem = card.select_one('.ad-type')
         else:
-            seller_type_elem = card.find_element(By.CLASS_NAME, 'seller-type')
+            seller_type_elem = card.select_one('.seller-type')
 
-        seller_type = re.sub(r'[\d\.]+', '', seller_type_elem.text).strip()
+        return cls._from_fields(
+            link,
+            title,
+            price_text,
+            price_info,
+            details_items,
+            card_attrs,
+            html_text(seller_type_elem),
+        )
 
-        if 'odometer' in details:
-            kms_match = re.match(r'([\d,]+).*km', details['odometer'])
-            kms = 0
-            if kms_match is not None:
-                kms = int(kms_match.groups()[0].replace(',', ''))
-        else:
-            kms = 0
-
-        to_remove = [
-            str(year),
-            details['make'],
-            details['model'],
-            r'MY[\.\d]+',
-            'Auto',
-        ]
-        badge = title
-        for sub in to_remove:
-            badge = re.sub(sub, '', badge)
-
-        details['badge'] = badge.strip()
-        marketing_year = re.search(r'(MY[\.\d]+)', title)
-        if marketing_year is not None:
-            marketing_year = marketing_year.groups()[0]
-        else:
-            marketing_year = ''
+    @classmethod
+    def from_page_source(cls, html: str) -> list[Self]:
+        # one driver.page_source snapshot -> every card on the page
+        return cls.from_soup(parse_html(html))
+
+    @classmethod
+    def from_soup(cls, soup: 'BeautifulSoup') -> list[Self]:
+        cards = soup.select(CARD_SELECTOR)
+        return [cls.from_card_html(card) for card in cards]
+
+    @classmethod
+    def _from_fields(
+        cls,
+        link: str,
+        title: str,
+        price_text: str,
+        price_info: str,
+        details_items: Iterable[tuple[str, str]],
+        card_attrs: dict[str, str],
+        seller_type_text: str,
+    ) -> Self:
+        print('Adding', title)
+        year = int(title.split(' ')[0])
+
+        # TODO: split into drive away and ex gov charges
+        drive_away_price, ex_gov_price = normalize.split_prices(
+            price_text, price_info
+        )
+
+        details = {
+            data_type.lower().replace(' ', '_'): text
+            for data_type, text in details_items
+        }
+        details.update(card_attrs)
+        for name in CATEGORICALS:
+            if isinstance(details.get(name), str):
+                details[name] = sys.intern(details[name])
+
+        kms = normalize.parse_kms(details.get('odometer'))
+        details['badge'] = normalize.badge(
+            title, year, details['make'], details['model']
+        )
+        marketing_year = normalize.marketing_year(title)
 
         car = cls(
             link,
@@ -128,8 +213,68 @@ class Car:
             price_text,
             price_info,
             kms,
-            seller_type=seller_type,
+            seller_type=sys.intern(normalize.seller_type(seller_type_text)),
             **details,
         )
 
         return car
+
+
+def _count(text: str) -> Optional[int]:
+    num_search_results = text.split(' ')[0].replace(',', '').strip()
+    try:
+        return int(num_search_results)
+    except ValueError:
+        return None
+
+
+def _result_count(soup: 'BeautifulSoup') -> Optional[int]:
+    title = soup.select_one('.title')
+    if title is None:
+        return None
+    return _count(html_text(title))
+
+
+def _next_page_link(soup: 'BeautifulSoup', url: str) -> Optional[str]:
+    pagination = soup.select_one('ul.pagination')
+    if pagination is None:
+        return None
+    for link in pagination.find_all('a', href=True):
+        if 'Next' in html_text(link):
+            return urljoin(url, link['href'])
+    return None
+
+
+def result_count(html: str) -> Optional[int]:
+    # the '1,234 cars for sale' heading, None if the page didn't render
+    return _result_count(parse_html(html))
+
+
+def peek_result_count(html: str) -> Optional[int]:
+    # result_count without parsing the page, a regex for the heading's
+    # opening tag and the text after it. cheap enough for the checks on
+    # every fetch, the full parse happens once in parse_results
+    match = TITLE_TAG.search(html)
+    if match is None:
+        return None
+    word = FIRST_WORD.match(html, match.end())
+    if word is None:
+        return None
+    return _count(unescape(word.group(1)).split()[0])
+
+
+def next_page_link(html: str, url: str = BASE_URL) -> Optional[str]:
+    return _next_page_link(parse_html(html), url)
+
+
+def parse_results(
+    html: str, url: str = BASE_URL
+) -> tuple[list[Car], Optional[int], Optional[str]]:
+    # a search results page parsed once: its cards, the result count and
+    # the next page's url
+    soup = parse_html(html)
+    return (
+        Car.from_soup(soup),
+        _result_count(soup),
+        _next_page_link(soup, url),
+    )
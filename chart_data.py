@@ -0,0 +1,149 @@
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_numeric_dtype
+
+TREND_POINTS = 100   # samples along each fitted curve
+LOESS_BANDWIDTH = 0.3   # same default as vega's transform_loess
+LOESS_MAX_ROWS = 5000   # lowess is quadratic-ish, fit on a sample above this
+STRATA = 20   # quantile groups when sampling by a continuous colour
+
+
+def _fit(
+    x: np.ndarray, y: np.ndarray, method: str, order: int
+) -> Optional[tuple[np.ndarray, np.ndarray]]:
+    # same family of fits as vega's transform_regression
+    if method in ('log', 'pow'):
+        keep = x > 0
+        x, y = x[keep], y[keep]
+    if method in ('exp', 'pow'):
+        keep = y > 0
+        x, y = x[keep], y[keep]
+    if len(x) < 2 or np.ptp(x) == 0:
+        return None
+
+    if method == 'loess':
+        # statsmodels takes about a second to import, only pay for it here
+        from statsmodels.nonparametric.smoothers_lowess import lowess
+
+        if len(x) > LOESS_MAX_ROWS:
+            rng = np.random.default_rng(0)
+            sample = rng.choice(len(x), LOESS_MAX_ROWS, replace=False)
+            x, y = x[sample], y[sample]
+        fitted = lowess(
+            y, x, frac=LOESS_BANDWIDTH, delta=0.01 * np.ptp(x), it=0
+        )
+        xs = np.linspace(x.min(), x.max(), TREND_POINTS)
+        return xs, np.interp(xs, fitted[:, 0], fitted[:, 1])
+
+    xs = np.linspace(x.min(), x.max(), TREND_POINTS)
+    degree = {'linear': 1, 'quad': 2, 'poly': order}.get(method, 1)
+    degree = min(degree, len(np.unique(x)) - 1)
+    if method in ('linear', 'quad', 'poly'):
+        return xs, np.polyval(np.polyfit(x, y, degree), xs)
+    if method == 'log':
+        b, a = np.polyfit(np.log(x), y, 1)
+        return xs, a + b * np.log(xs)
+    if method == 'exp':
+        b, a = np.polyfit(x, np.log(y), 1)
+        return xs, np.exp(a + b * xs)
+    if method == 'pow':
+        b, a = np.polyfit(np.log(x), np.log(y), 1)
+        return xs, np.exp(a) * xs**b
+    raise ValueError(f'unknown trendline type {method}')
+
+
+def trendlines(
+    df: pd.DataFrame,
+    x_col: str,
+    y_col: str,
+    method: str,
+    order: int = 3,
+    groupby: Optional[str] = None,
+) -> pd.DataFrame:
+    # fitted on every row in python, only the curves go to the browser
+    if groupby in (x_col, y_col):
+        # one group per axis value leaves nothing to fit a curve through
+        groupby = None
+    columns = [x_col, y_col] + ([groupby] if groupby else [])
+    data = df[list(dict.fromkeys(columns))].dropna(subset=[x_col, y_col])
+    groups = (
+        data.groupby(groupby, observed=True, sort=False)
+        if groupby
+        else [(None, data)]
+    )
+
+    curves = []
+    for name, group in groups:
+        fitted = _fit(
+            group[x_col].to_numpy(dtype=float),
+            group[y_col].to_numpy(dtype=float),
+            method,
+            order,
+        )
+        if fitted is None:
+            continue
+        curve = pd.DataFrame({x_col: fitted[0], y_col: fitted[1]})
+        if groupby:
+            curve[groupby] = name
+        curves.append(curve)
+
+    if not curves:
+        return pd.DataFrame(columns=list(data.columns))
+    return pd.concat(curves, ignore_index=True)
+
+
+def stratified_sample(
+    df: pd.DataFrame, max_rows: int, stratify_by: str, seed: int = 0
+) -> pd.DataFrame:
+    # keeps each colour group's share of the points, and at least one each
+    if len(df) <= max_rows:
+        return df
+    fraction = max_rows / len(df)
+    shuffled = df.sample(frac=1, random_state=seed)
+    strata = shuffled[stratify_by]
+    if is_numeric_dtype(strata) and strata.nunique() > STRATA:
+        # a continuous colour would be a group per value, use quantiles
+        strata = pd.qcut(strata, STRATA, duplicates='drop')
+    groups = strata.groupby(
+        strata.array, observed=True, sort=False, dropna=False
+    )
+    ranks = groups.cumcount().to_numpy()
+    sizes = groups.transform('size').to_numpy()
+    keep = ranks < np.maximum(1, np.round(sizes * fraction))
+    # one row from each of many small groups can still pass max_rows
+    return shuffled[keep].head(max_rows).sort_index()
+
+
+def bin_points(
+    df: pd.DataFrame,
+    x_col: str,
+    y_col: str,
+    color_by: str,
+    bins: int = 40,
+) -> pd.DataFrame:
+    # counts on a bins x bins grid per colour, bounded regardless of rows
+    columns = list(dict.fromkeys([x_col, y_col, color_by]))
+    data = df[columns].dropna(subset=[x_col, y_col])
+    if data.empty:
+        return data.assign(count=pd.Series(dtype=int))
+
+    binned = {}
+    for col in (x_col, y_col):
+        values = data[col].to_numpy(dtype=float)
+        edges = np.linspace(values.min(), values.max(), bins + 1)
+        index = np.searchsorted(edges, values, 'right') - 1
+        centres = (edges[:-1] + edges[1:]) / 2
+        binned[col] = centres[np.clip(index, 0, bins - 1)]
+
+    # colouring by an axis column colours by its bin
+    binned.setdefault(color_by, data[color_by].to_numpy())
+    aggregated = (
+        pd.DataFrame(binned)
+        .groupby(columns, observed=True)
+        .size()
+        .rename('count')
+        .reset_index()
+    )
+    return aggregated
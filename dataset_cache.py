@@ -0,0 +1,134 @@
+import datetime
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+from attrs import define
+
+from facets import Facet, categorize, compute_facets
+from store import ListingStore, filter_expression, read_columns, to_dataframe
+
+
+@define
+class LoadStats:
+    hits: int = 0
+    misses: int = 0
+    files_read: int = 0
+    files_reused: int = 0
+    last_load_seconds: float = 0.0
+    last_was_hit: bool = False
+
+
+class DatasetCache:
+    # per-file tables are keyed on path + mtime + size so only files that
+    # changed since the last rerun are read again, and merged frames are
+    # kept in a small LRU keyed on the files, columns and filters along
+    # with their facets, so those are only computed once per version
+    def __init__(self, store: Optional[ListingStore] = None, max_frames=8):
+        self.store = store or ListingStore()
+        self.max_frames = max_frames
+        self.stats = LoadStats()
+        self._tables: dict[Path, tuple[tuple, tuple, pa.Table]] = {}
+        self._frames: OrderedDict[
+            tuple, tuple[pd.DataFrame, dict[str, Facet]]
+        ] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _file_table(self, path: Path, columns: tuple) -> pa.Table:
+        stat = path.stat()
+        version = (stat.st_mtime_ns, stat.st_size)
+        cached = self._tables.get(path)
+        if cached is not None and cached[:2] == (version, columns):
+            self.stats.files_reused += 1
+            return cached[2]
+
+        table = self.store.dataset([path]).to_table(columns=list(columns))
+        self._tables[path] = (version, columns, table)
+        self.stats.files_read += 1
+        return table
+
+    def load(self, *args, **kwargs) -> pd.DataFrame:
+        return self.load_faceted(*args, **kwargs)[0]
+
+    def load_faceted(
+        self,
+        columns: list[str],
+        makes: Optional[list[str]] = None,
+        models: Optional[list[str]] = None,
+        min_year: Optional[int] = None,
+        max_year: Optional[int] = None,
+        min_price: Optional[int] = None,
+        max_price: Optional[int] = None,
+    ) -> tuple[pd.DataFrame, dict[str, Facet]]:
+        start = time.perf_counter()
+        with self._lock:
+            files = self.store.files()
+            fingerprint = tuple(
+                (path, path.stat().st_mtime_ns, path.stat().st_size)
+                for path in files
+            )
+            filters = (
+                tuple(sorted(makes or [])),
+                tuple(sorted(models or [])),
+                min_year,
+                max_year,
+                min_price,
+                max_price,
+            )
+            key = (fingerprint, tuple(columns), filters)
+
+            cached = self._frames.get(key)
+            self.stats.last_was_hit = cached is not None
+            if cached is not None:
+                self._frames.move_to_end(key)
+                self.stats.hits += 1
+            else:
+                self.stats.misses += 1
+                df = self._build(files, columns, makes, models, filters[2:])
+                cached = df, compute_facets(df)
+                self._frames[key] = cached
+                while len(self._frames) > self.max_frames:
+                    self._frames.popitem(last=False)
+
+            # forget tables for files that were removed
+            for path in set(self._tables) - set(files):
+                del self._tables[path]
+
+        self.stats.last_load_seconds = time.perf_counter() - start
+        # callers add columns and filter, keep the cached frame intact
+        df, facets = cached
+        return df.copy(), facets
+
+    def _build(
+        self,
+        files: list[Path],
+        columns: list[str],
+        makes: Optional[list[str]],
+        models: Optional[list[str]],
+        ranges: tuple,
+    ) -> pd.DataFrame:
+        if not files:
+            return pd.DataFrame(columns=columns + ['age'])
+
+        needed = tuple(
+            read_columns(
+                list(dict.fromkeys(columns + ['make', 'model', 'year']))
+            )
+        )
+        tables = [self._file_table(path, needed) for path in files]
+        table = pa.concat_tables(tables, promote_options='permissive')
+        # like ListingStore.load, prices only filter the latest snapshots
+        min_year, max_year, min_price, max_price = ranges
+        table = ds.dataset(table).to_table(
+            filter=filter_expression(makes, models, min_year, max_year)
+        )
+        values = filter_expression(min_price=min_price, max_price=max_price)
+        df = categorize(to_dataframe(table, columns, values=values))
+        if 'year' in df:
+            df['age'] = datetime.date.today().year - df['year']
+        return df
@@ -0,0 +1,201 @@
+import datetime
+import functools
+from pathlib import Path
+from typing import Optional, Self
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from attrs import frozen
+
+from store import ListingStore
+
+CATEGORIES = ['badge', 'engine', 'seller_type']
+COLUMNS = [
+    'id',
+    'make',
+    'model',
+    'year',
+    'kms',
+    'ex_gov_price',
+    'drive_away_price',
+    *CATEGORIES,
+]
+MIN_COUNT = 5   # rarer categories share the baseline
+RIDGE = 1.0
+KMS_SCALE = 10000.0
+
+
+def listing_price(df: pd.DataFrame) -> pd.Series:
+    return df['ex_gov_price'].fillna(df['drive_away_price'])
+
+
+def _numeric(age: np.ndarray, kms: np.ndarray) -> np.ndarray:
+    kms = kms / KMS_SCALE
+    return np.column_stack(
+        [np.ones_like(age), age, age**2, kms, kms**2, age * kms]
+    )
+
+
+@frozen(eq=False)
+class DepreciationModel:
+    # log(price) ~ quadratic in age and kms plus an offset per badge,
+    # engine and seller type, fitted for one make/model
+    make: str
+    model: str
+    numeric_coef: np.ndarray
+    categories: dict[str, list[str]]
+    category_coef: dict[str, np.ndarray]
+    num_listings: int
+    rmse: float
+
+    @classmethod
+    def fit(cls, df: pd.DataFrame, make: str, model: str) -> Self:
+        df = df.assign(price=listing_price(df)).dropna(
+            subset=['price', 'year', 'kms']
+        )
+        df = df[df['price'] > 0]
+        age = (datetime.date.today().year - df['year']).to_numpy(float)
+        kms = df['kms'].to_numpy(float)
+        y = np.log(df['price'].to_numpy(float))
+
+        blocks = [sp.csr_matrix(_numeric(age, kms))]
+        categories = {}
+        for name in CATEGORIES:
+            counts = df[name].astype(str).value_counts()
+            categories[name] = list(counts[counts >= MIN_COUNT].index)
+            codes = pd.Categorical(
+                df[name].astype(str), categories=categories[name]
+            ).codes
+            rows = np.flatnonzero(codes >= 0)
+            blocks.append(
+                sp.csr_matrix(
+                    (np.ones(len(rows)), (rows, codes[rows])),
+                    shape=(len(df), len(categories[name])),
+                )
+            )
+
+        X = sp.hstack(blocks).tocsr()
+        penalty = np.full(X.shape[1], RIDGE)
+        penalty[0] = 0.0   # don't shrink the intercept
+        coef = np.linalg.solve(
+            (X.T @ X).toarray() + np.diag(penalty), X.T @ y
+        )
+        rmse = float(np.sqrt(np.mean((X @ coef - y) ** 2))) if len(y) else 0
+
+        numeric_coef = coef[:6]
+        category_coef = {}
+        offset = 6
+        for name in CATEGORIES:
+            size = len(categories[name])
+            # a trailing zero so unknown categories (code -1) are baseline
+            category_coef[name] = np.append(
+                coef[offset : offset + size], 0.0
+            )
+            offset += size
+
+        return cls(
+            make,
+            model,
+            numeric_coef,
+            categories,
+            category_coef,
+            len(df),
+            rmse,
+        )
+
+    def log_price(
+        self,
+        age,
+        kms,
+        badge=None,
+        engine=None,
+        seller_type=None,
+    ) -> np.ndarray:
+        age = np.atleast_1d(np.asarray(age, dtype=float))
+        kms = np.atleast_1d(np.asarray(kms, dtype=float))
+        log_price = _numeric(age, kms) @ self.numeric_coef
+        for name, values in zip(CATEGORIES, (badge, engine, seller_type)):
+            if values is None:
+                continue
+            codes = pd.Categorical(
+                np.atleast_1d(np.asarray(values, dtype=str)),
+                categories=self.categories[name],
+            ).codes
+            log_price = log_price + self.category_coef[name][codes]
+        return log_price
+
+    def expected_price(
+        self, year, kms, badge=None, engine=None, seller_type=None
+    ) -> np.ndarray:
+        age = datetime.date.today().year - np.asarray(year, dtype=float)
+        return np.exp(self.log_price(age, kms, badge, engine, seller_type))
+
+    def yearly_drop_off(
+        self, year, kms, badge=None, engine=None, seller_type=None
+    ) -> np.ndarray:
+        # value lost over the next year of age at the same kms
+        now = self.expected_price(year, kms, badge, engine, seller_type)
+        older = self.expected_price(
+            np.asarray(year) - 1, kms, badge, engine, seller_type
+        )
+        return now - older
+
+    def predict(self, df: pd.DataFrame) -> np.ndarray:
+        return self.expected_price(
+            df['year'].to_numpy(),
+            df['kms'].to_numpy(),
+            *(df[name].astype(str).to_numpy() for name in CATEGORIES),
+        )
+
+
+def fit_models(
+    df: pd.DataFrame, min_listings: int = 20
+) -> dict[tuple[str, str], DepreciationModel]:
+    models = {}
+    for (make, model), group in df.groupby(
+        ['make', 'model'], observed=True
+    ):
+        if len(group) >= min_listings:
+            models[(make, model)] = DepreciationModel.fit(group, make, model)
+    return models
+
+
+@functools.lru_cache(maxsize=4)
+def _models_for_version(
+    path: Path, version: tuple
+) -> dict[tuple[str, str], DepreciationModel]:
+    return fit_models(ListingStore(path).load(COLUMNS))
+
+
+def models_for(
+    store: Optional[ListingStore] = None,
+) -> dict[tuple[str, str], DepreciationModel]:
+    # refitted only when a file in the store changes
+    store = store or ListingStore()
+    version = tuple(
+        (path, path.stat().st_mtime_ns, path.stat().st_size)
+        for path in store.files()
+    )
+    return _models_for_version(store.path, version)
+
+
+def price_vs_curve(
+    df: pd.DataFrame, models: dict[tuple[str, str], DepreciationModel]
+) -> pd.DataFrame:
+    # expected price for every row and how far the asking price sits
+    # below (negative) or above it
+    expected = pd.Series(np.nan, index=df.index)
+    for (make, model), group in df.groupby(
+        ['make', 'model'], observed=True
+    ):
+        fitted = models.get((str(make), str(model)))
+        if fitted is not None:
+            expected[group.index] = fitted.predict(group)
+    return pd.DataFrame(
+        {
+            'expected_price': expected.round(),
+            'price_vs_curve': listing_price(df) / expected - 1,
+        },
+        index=df.index,
+    )
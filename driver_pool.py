@@ -0,0 +1,202 @@
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterator, Optional
+
+from attrs import define, field
+
+import tracing
+
+# selenium loads on the first browser start, not on import
+if TYPE_CHECKING:
+    from selenium import webdriver
+
+EXTENSIONS = [
+    'vpnetworks_proxy-2.9.2.xpi',
+    'ublock_origin-1.46.0.xpi',
+]
+
+
+def new_driver() -> 'webdriver.Firefox':
+    try:
+        from selenium import webdriver
+        from selenium.webdriver.firefox.options import Options
+    except ImportError as error:
+        raise ImportError(
+            'pip install -r requirements-scrape.txt to scrape with a browser'
+        ) from error
+
+    options = Options()
+    options.headless = True
+    # every Firefox session gets its own temporary profile
+    driver = webdriver.Firefox(options=options)
+    execute = driver.execute
+
+    def counted_execute(command, params=None):
+        # every WebDriver round trip, by command and in total
+        tracing.count('webdriver.calls')
+        tracing.count(f'webdriver.{command}')
+        return execute(command, params)
+
+    driver.execute = counted_execute
+    for extension in EXTENSIONS:
+        driver.install_addon(Path.cwd().joinpath('extensions', extension))
+    return driver
+
+
+@define
+class PooledDriver:
+    driver: 'webdriver.Firefox'
+    startup_time: float
+    pages: int = 0
+    blocked: bool = False
+
+    def get(self, url: str):
+        self.pages += 1
+        with tracing.span('driver.get', url=url):
+            self.driver.get(url)
+
+    def is_healthy(self) -> bool:
+        from selenium.common.exceptions import WebDriverException
+
+        try:
+            self.driver.current_url
+        except WebDriverException:
+            return False
+        return True
+
+
+@define
+class PoolStats:
+    hits: int = 0
+    misses: int = 0
+    recycled: int = 0
+    startup_times: list[float] = field(factory=list)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @property
+    def mean_startup_time(self) -> float:
+        if not self.startup_times:
+            return 0.0
+        return sum(self.startup_times) / len(self.startup_times)
+
+
+class DriverPool:
+    # warm Firefox sessions with the add-ons already installed, handed out
+    # to scrape workers and recycled after max_pages or a captcha
+    def __init__(self, max_size: int = 4, max_pages: int = 100):
+        self.max_size = max_size
+        self.max_pages = max_pages
+        self.stats = PoolStats()
+        self._idle: list[PooledDriver] = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._out = 0   # checked out, or starting for a checkout
+        self._warming = 0
+
+    def _start(self) -> PooledDriver:
+        start = time.perf_counter()
+        with tracing.span('driver.start'):
+            driver = new_driver()
+        startup_time = time.perf_counter() - start
+        with self._lock:
+            self.stats.startup_times.append(startup_time)
+        return PooledDriver(driver, startup_time)
+
+    def _discard(self, session: PooledDriver):
+        from selenium.common.exceptions import WebDriverException
+
+        with self._lock:
+            self.stats.recycled += 1
+        try:
+            session.driver.quit()
+        except WebDriverException:
+            pass
+
+    def acquire(self) -> PooledDriver:
+        self._slots.acquire()
+        with self._lock:
+            self._out += 1
+        while True:
+            with self._lock:
+                session = self._idle.pop() if self._idle else None
+            if session is None:
+                break
+            if session.is_healthy():
+                with self._lock:
+                    self.stats.hits += 1
+                return session
+            self._discard(session)
+
+        with self._lock:
+            self.stats.misses += 1
+        try:
+            return self._start()
+        except Exception:
+            with self._lock:
+                self._out -= 1
+            self._slots.release()
+            raise
+
+    def release(self, session: PooledDriver):
+        try:
+            if session.blocked or session.pages >= self.max_pages:
+                self._discard(session)
+            else:
+                with self._lock:
+                    self._idle.append(session)
+        finally:
+            with self._lock:
+                self._out -= 1
+            self._slots.release()
+
+    @contextmanager
+    def session(self) -> Iterator[PooledDriver]:
+        session = self.acquire()
+        try:
+            yield session
+        finally:
+            self.release(session)
+
+    def warm(self, num_sessions: Optional[int] = None):
+        # top up idle sessions in the background so the next search
+        # doesn't pay for browser start and add-on installation. idle,
+        # checked out and warming sessions together stay within max_size
+        num_sessions = num_sessions or self.max_size
+        with self._lock:
+            room = (
+                self.max_size - self._out - len(self._idle) - self._warming
+            )
+            missing = num_sessions - len(self._idle) - self._warming
+            missing = max(0, min(missing, room))
+            self._warming += missing
+
+        def start_one():
+            # a warming browser holds a slot like a checked out one, so a
+            # checkout waits for it instead of starting another
+            if not self._slots.acquire(blocking=False):
+                with self._lock:
+                    self._warming -= 1
+                return
+            try:
+                session = self._start()
+                with self._lock:
+                    self._idle.append(session)
+            finally:
+                with self._lock:
+                    self._warming -= 1
+                self._slots.release()
+
+        for _ in range(missing):
+            threading.Thread(target=start_one, daemon=True).start()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for session in idle:
+            session.driver.quit()
@@ -0,0 +1,288 @@
+import asyncio
+import datetime
+import re
+import sqlite3
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+import pandas as pd
+from attrs import define
+
+import tracing
+from car import html_text, parse_html
+from driver_pool import DriverPool
+from fetch import Fetcher, Page, ScrapeError, make_fetcher
+from rate_limit import RateLimiter, RateStats, ThrottledFetcher
+from store import ListingStore
+
+DETAILS_PATH = Path.cwd().joinpath('data', 'details.sqlite')
+DETAIL_COLUMNS = [
+    'build_date',
+    'odometer',
+    'vin',
+    'colour',
+    'rego_expiry',
+    'service_history',
+]
+# spec labels on the detail page, lower case without punctuation
+LABELS = {
+    'build date': 'build_date',
+    'built': 'build_date',
+    'odometer': 'odometer',
+    'kilometres': 'odometer',
+    'vin': 'vin',
+    'vin number': 'vin',
+    'colour': 'colour',
+    'exterior colour': 'colour',
+    'color': 'colour',
+    'registration expiry': 'rego_expiry',
+    'rego expiry': 'rego_expiry',
+    'registration expiry date': 'rego_expiry',
+    'service history': 'service_history',
+    'log books': 'service_history',
+}
+GONE = {404, 410}   # sold or withdrawn, nothing to retry
+MAX_WORKERS = 8
+
+
+def _label(text: str) -> str:
+    return ' '.join(re.sub(r'[^a-z ]', ' ', text.lower()).split())
+
+
+def parse_details(html: str) -> dict[str, Optional[str]]:
+    # the specifications are label/value pairs, as table rows, definition
+    # lists or items tagged with a data-type like the search cards use
+    soup = parse_html(html)
+    pairs = []
+    for row in soup.find_all('tr'):
+        cells = row.find_all(['th', 'td'])
+        if len(cells) == 2:
+            pairs.append((html_text(cells[0]), html_text(cells[1])))
+    for term in soup.find_all('dt'):
+        value = term.find_next_sibling('dd')
+        if value is not None:
+            pairs.append((html_text(term), html_text(value)))
+    for item in soup.select('[data-type]'):
+        pairs.append((item.get('data-type'), html_text(item)))
+
+    details = dict.fromkeys(DETAIL_COLUMNS)
+    for label, value in pairs:
+        column = LABELS.get(_label(label))
+        if column is not None and value and details[column] is None:
+            details[column] = value
+    return details
+
+
+def is_detail_page(page: Page) -> bool:
+    # every listing shows its odometer, a JS shell or error page doesn't
+    return page.status in GONE or (
+        page.status == 200 and 'dometer' in page.html
+    )
+
+
+class DetailCache:
+    # detail page fields by Car.id, so a listing is only fetched once.
+    # listings that are gone are kept with empty fields
+    def __init__(self, path: Path = DETAILS_PATH):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS details (
+                    id TEXT PRIMARY KEY,
+                    {", ".join(f"{c} TEXT" for c in DETAIL_COLUMNS)},
+                    status INTEGER NOT NULL,
+                    fetched_at TEXT NOT NULL
+                )
+                """
+            )
+
+    def missing(self, ids: list[str]) -> list[str]:
+        known = set()
+        # sqlite limits the number of parameters in one statement
+        for start in range(0, len(ids), 500):
+            chunk = ids[start : start + 500]
+            known.update(
+                row[0]
+                for row in self.conn.execute(
+                    'SELECT id FROM details '
+                    f'WHERE id IN ({",".join("?" * len(chunk))})',
+                    chunk,
+                )
+            )
+        return [listing_id for listing_id in ids if listing_id not in known]
+
+    def put(self, listing_id: str, details: dict, status: int = 200):
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO details VALUES '
+                f'({",".join("?" * (len(DETAIL_COLUMNS) + 3))})',
+                (
+                    listing_id,
+                    *(details.get(c) for c in DETAIL_COLUMNS),
+                    status,
+                    now,
+                ),
+            )
+
+    def load(self) -> pd.DataFrame:
+        return pd.read_sql_query(
+            f'SELECT id, {", ".join(DETAIL_COLUMNS)} FROM details',
+            self.conn,
+        )
+
+    def close(self):
+        self.conn.close()
+
+
+@define
+class EnrichStats:
+    listings: int = 0
+    cached: int = 0
+    fetched: int = 0
+    gone: int = 0
+    errors: int = 0
+    written: int = 0
+    seconds: float = 0.0
+    rate: Optional[RateStats] = None
+
+
+async def fetch_details(
+    fetcher: Fetcher,
+    listings: list[tuple[str, str]],
+    cache: DetailCache,
+    max_workers: int = MAX_WORKERS,
+    stats: Optional[EnrichStats] = None,
+    on_progress: Optional[Callable[[EnrichStats], None]] = None,
+) -> EnrichStats:
+    # (id, link) pairs, at most max_workers detail pages in flight and
+    # each one cached as soon as it's parsed, so an interrupted run picks
+    # up where it stopped
+    stats = stats or EnrichStats()
+    slots = asyncio.Semaphore(max_workers)
+
+    async def enrich_one(listing_id: str, link: str):
+        async with slots:
+            with tracing.span('detail', id=listing_id):
+                try:
+                    page = await fetcher.fetch(link)
+                except ScrapeError as error:
+                    # not cached, the next run tries it again
+                    print(error)
+                    stats.errors += 1
+                    return
+                if page.status in GONE:
+                    details = {}
+                    stats.gone += 1
+                elif not is_detail_page(page) or page.is_blocked:
+                    stats.errors += 1
+                    return
+                else:
+                    with tracing.span('parse'):
+                        details = await asyncio.to_thread(
+                            parse_details, page.html
+                        )
+        cache.put(listing_id, details, page.status)
+        stats.fetched += 1
+        if on_progress is not None:
+            on_progress(stats)
+
+    await asyncio.gather(
+        *(enrich_one(listing_id, link) for listing_id, link in listings)
+    )
+    return stats
+
+
+def merge(
+    store: ListingStore, cache: DetailCache, latest: pd.DataFrame
+) -> int:
+    # fields the latest snapshot is missing become a newer snapshot of the
+    # listing, the store stays append only and carries them onto later
+    # snapshots when it loads them. returns the rows written
+    details = cache.load()
+    merged = latest.merge(details, on='id', suffixes=('', '_detail'))
+    changed = pd.Series(False, index=merged.index)
+    for column in DETAIL_COLUMNS:
+        fill = merged[column].isna() & merged[f'{column}_detail'].notna()
+        merged[column] = merged[column].where(
+            ~fill, merged[f'{column}_detail']
+        )
+        changed |= fill
+    merged = merged.loc[changed, latest.columns]
+    if merged.empty:
+        return 0
+    merged['scraped_at'] = datetime.datetime.now().replace(microsecond=0)
+    return store.append(merged)
+
+
+def enrich(
+    makes: Optional[list[str]] = None,
+    models: Optional[list[str]] = None,
+    limit: Optional[int] = None,
+    max_workers: int = MAX_WORKERS,
+    backend: str = 'http',
+    pool: Optional[DriverPool] = None,
+    limiter: Optional[RateLimiter] = None,
+    store: Optional[ListingStore] = None,
+    cache: Optional[DetailCache] = None,
+    on_progress: Optional[Callable[[EnrichStats], None]] = None,
+) -> EnrichStats:
+    start = time.perf_counter()
+    store = store or ListingStore()
+    owns_cache = cache is None
+    cache = cache or DetailCache()
+    latest = store.load(makes=makes, models=models)
+    ids = latest['id'].tolist()
+    todo = set(cache.missing(ids)[:limit])
+    stats = EnrichStats(listings=len(ids), cached=len(ids) - len(todo))
+    listings = [
+        (listing_id, link)
+        for listing_id, link in zip(latest['id'], latest['link'])
+        if listing_id in todo
+    ]
+
+    async def run():
+        fetcher = ThrottledFetcher(
+            make_fetcher(
+                backend,
+                pool,
+                max_connections=max_workers,
+                is_usable=is_detail_page,
+            ),
+            limiter or RateLimiter(),
+            is_usable=is_detail_page,
+        )
+        try:
+            await fetch_details(
+                fetcher, listings, cache, max_workers, stats, on_progress
+            )
+        finally:
+            await fetcher.aclose()
+        stats.rate = fetcher.limiter.stats
+
+    try:
+        if listings:
+            asyncio.run(run())
+        stats.written = merge(store, cache, latest)
+    finally:
+        if owns_cache:
+            cache.close()
+    stats.seconds = time.perf_counter() - start
+    return stats
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 or sys.argv[1:] and not sys.argv[1].isdigit():
+        print('usage: python enrich.py [LIMIT]')
+        sys.exit(1)
+    stats = enrich(limit=int(sys.argv[1]) if sys.argv[1:] else None)
+    print(
+        f'{stats.fetched} detail pages fetched ({stats.gone} gone, '
+        f'{stats.errors} failed), {stats.cached} already cached, '
+        f'{stats.written} listings updated in {stats.seconds:.1f}s'
+    )
@@ -0,0 +1,133 @@
+from typing import Any, Optional
+
+import numpy as np
+import pandas as pd
+from attrs import frozen
+from pandas.api.types import (
+    is_bool_dtype,
+    is_datetime64_any_dtype,
+    is_numeric_dtype,
+    is_object_dtype,
+    is_string_dtype,
+)
+
+MAX_CATEGORIES = 100   # more distinct values than this is free text
+
+
+@frozen
+class Facet:
+    column: str
+    kind: str   # 'category', 'range' or 'text'
+    values: tuple = ()
+    counts: tuple = ()
+    low: Any = None
+    high: Any = None
+    nulls: int = 0
+
+
+def categorize(
+    df: pd.DataFrame, max_categories: int = MAX_CATEGORIES
+) -> pd.DataFrame:
+    # low-cardinality text as categoricals, so facets and filters work on
+    # integer codes instead of comparing strings. columns that are mostly
+    # unique, like id on a small dataset, stay text
+    limit = min(max_categories, len(df) // 2)
+    for name, series in df.items():
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            continue
+        is_text = is_object_dtype(series) or is_string_dtype(series)
+        if is_text and series.nunique(dropna=True) <= limit:
+            df[name] = series.astype('category')
+    return df
+
+
+def _scalar(value):
+    if isinstance(value, pd.Timestamp):
+        return value.to_pydatetime()
+    return value.item() if hasattr(value, 'item') else value
+
+
+def compute_facets(df: pd.DataFrame) -> dict[str, Facet]:
+    facets = {}
+    for name, series in df.items():
+        nulls = int(series.isna().sum())
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            codes = series.cat.codes.to_numpy()
+            counts = np.bincount(
+                codes[codes >= 0], minlength=len(series.cat.categories)
+            )
+            facets[name] = Facet(
+                name,
+                'category',
+                tuple(series.cat.categories),
+                tuple(counts.tolist()),
+                nulls=nulls,
+            )
+        elif is_bool_dtype(series):
+            counts = series.value_counts()
+            facets[name] = Facet(
+                name,
+                'category',
+                tuple(counts.index),
+                tuple(counts.tolist()),
+                nulls=nulls,
+            )
+        elif is_numeric_dtype(series) or is_datetime64_any_dtype(series):
+            valid = series.dropna()
+            facets[name] = Facet(
+                name,
+                'range',
+                low=_scalar(valid.min()) if len(valid) else None,
+                high=_scalar(valid.max()) if len(valid) else None,
+                nulls=nulls,
+            )
+        else:
+            facets[name] = Facet(name, 'text', nulls=nulls)
+    return facets
+
+
+def mask(
+    df: pd.DataFrame,
+    facets: dict[str, Facet],
+    selections: dict[str, Any],
+) -> np.ndarray:
+    # one boolean array for every selection, categoricals are filtered
+    # through a lookup table indexed by their codes
+    keep = np.ones(len(df), dtype=bool)
+    for name, selection in selections.items():
+        series = df[name]
+        kind = facets[name].kind
+        if kind == 'category' and isinstance(
+            series.dtype, pd.CategoricalDtype
+        ):
+            categories = series.cat.categories
+            allowed = np.zeros(len(categories) + 1, dtype=bool)
+            positions = categories.get_indexer(list(selection))
+            allowed[positions[positions >= 0]] = True
+            # missing values have code -1, which lands on the last slot
+            keep &= allowed[series.cat.codes.to_numpy()]
+        elif kind == 'category':
+            keep &= series.isin(list(selection)).to_numpy(dtype=bool)
+        elif kind == 'range':
+            low, high = selection
+            keep &= (
+                series.between(low, high).fillna(False).to_numpy(dtype=bool)
+            )
+        else:
+            keep &= (
+                series.astype(str)
+                .str.contains(selection, case=False, regex=False)
+                .to_numpy(dtype=bool)
+            )
+    return keep
+
+
+def color_columns(
+    facets: dict[str, Facet], exclude: Optional[list[str]] = None
+) -> list[str]:
+    # free-text columns like link and id would give one colour per row
+    return [
+        name
+        for name, facet in facets.items()
+        if facet.kind != 'text' and name not in (exclude or [])
+    ]
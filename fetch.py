@@ -0,0 +1,248 @@
+import asyncio
+import hashlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Optional, Protocol
+from urllib.parse import urlsplit, urlunsplit
+
+import httpx
+from attrs import frozen
+
+import tracing
+from car import peek_result_count
+from driver_pool import DriverPool
+
+FIXTURES = Path(__file__).parent.joinpath('fixtures')
+HEADERS = {
+    'User-Agent': (
+        'Mozilla/5.0 (X11; Linux x86_64; rv:108.0) '
+        'Gecko/20100101 Firefox/108.0'
+    ),
+    'Accept': 'text/html,application/xhtml+xml',
+    'Accept-Language': 'en-AU,en;q=0.5',
+}
+
+
+class ScrapeError(Exception):
+    pass
+
+
+@frozen
+class Page:
+    url: str
+    html: str
+    status: int
+    elapsed: float
+    source: str
+
+    @property
+    def is_blocked(self) -> bool:
+        return 'captcha' in self.html
+
+    @property
+    def is_rendered(self) -> bool:
+        # search pages served as a JS shell have no result heading
+        return peek_result_count(self.html) is not None
+
+
+class Fetcher(Protocol):
+    async def fetch(self, url: str) -> Page:
+        ...
+
+    async def aclose(self):
+        ...
+
+
+class HttpFetcher:
+    # plain async HTTP, no browser, connections kept alive across pages
+    def __init__(
+        self, max_connections: int = 16, base_url: Optional[str] = None
+    ):
+        self.base_url = base_url
+        self._client = httpx.AsyncClient(
+            headers=HEADERS,
+            follow_redirects=True,
+            timeout=30,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+        )
+
+    def _rewrite(self, url: str) -> str:
+        # point carsales urls at a replay server when base_url is set
+        if self.base_url is None:
+            return url
+        base = urlsplit(self.base_url)
+        parts = urlsplit(url)
+        return urlunsplit(
+            (base.scheme, base.netloc, parts.path, parts.query, '')
+        )
+
+    async def fetch(self, url: str) -> Page:
+        start = time.perf_counter()
+        response = await self._client.get(self._rewrite(url))
+        return Page(
+            url,
+            response.text,
+            response.status_code,
+            time.perf_counter() - start,
+            'http',
+        )
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+class SeleniumFetcher:
+    def __init__(self, pool: Optional[DriverPool] = None):
+        self._owns_pool = pool is None
+        self.pool = pool or DriverPool()
+
+    def _fetch(self, url: str) -> Page:
+        start = time.perf_counter()
+        with self.pool.session() as session:
+            session.get(url)
+            with tracing.span('driver.page_source'):
+                html = session.driver.page_source
+            if 'captcha' in html:
+                session.blocked = True
+        return Page(url, html, 200, time.perf_counter() - start, 'selenium')
+
+    async def fetch(self, url: str) -> Page:
+        return await asyncio.to_thread(self._fetch, url)
+
+    async def aclose(self):
+        if self._owns_pool:
+            await asyncio.to_thread(self.pool.close)
+
+
+class FallbackFetcher:
+    # try the cheap fetcher first, only start a browser when we must
+    def __init__(
+        self,
+        primary: Fetcher,
+        fallback: Fetcher,
+        is_usable: Optional[Callable[[Page], bool]] = None,
+    ):
+        self.primary = primary
+        self.fallback = fallback
+        # search pages by default, other pages bring their own check
+        self.is_usable = is_usable
+        self.fallbacks = 0
+
+    def _usable(self, page: Page) -> bool:
+        if self.is_usable is not None:
+            return self.is_usable(page)
+        return page.status == 200 and page.is_rendered
+
+    async def fetch(self, url: str) -> Page:
+        try:
+            page = await self.primary.fetch(url)
+        except httpx.HTTPError as error:
+            print('http fetch failed for', url, error)
+        else:
+            if self._usable(page):
+                return page
+        self.fallbacks += 1
+        return await self.fallback.fetch(url)
+
+    async def aclose(self):
+        await self.primary.aclose()
+        await self.fallback.aclose()
+
+
+def fixture_path(url: str, directory: Path = FIXTURES) -> Path:
+    parts = urlsplit(url)
+    key = parts.path + ('?' + parts.query if parts.query else '')
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return directory.joinpath(digest).with_suffix('.html')
+
+
+def record(page: Page, directory: Path = FIXTURES) -> Path:
+    path = fixture_path(page.url, directory)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(page.html)
+    return path
+
+
+class RecordingFetcher:
+    # saves every page it fetches so a live run can be replayed offline
+    def __init__(self, fetcher: Fetcher, directory: Path = FIXTURES):
+        self.fetcher = fetcher
+        self.directory = directory
+        self.urls: list[str] = []
+
+    async def fetch(self, url: str) -> Page:
+        page = await self.fetcher.fetch(url)
+        if page.status == 200:
+            record(page, self.directory)
+            self.urls.append(url)
+        return page
+
+    async def aclose(self):
+        await self.fetcher.aclose()
+
+
+class ReplayFetcher:
+    # in-process replay of recorded pages, no sockets at all
+    def __init__(self, directory: Path = FIXTURES):
+        self.directory = directory
+
+    async def fetch(self, url: str) -> Page:
+        start = time.perf_counter()
+        path = fixture_path(url, self.directory)
+        if not path.exists():
+            return Page(url, '', 404, time.perf_counter() - start, 'replay')
+        html = await asyncio.to_thread(path.read_text)
+        return Page(url, html, 200, time.perf_counter() - start, 'replay')
+
+    async def aclose(self):
+        pass
+
+
+def serve_fixtures(
+    directory: Path = FIXTURES, port: int = 0
+) -> ThreadingHTTPServer:
+    # local stub of carsales for benchmarking the real HTTP path offline,
+    # use with HttpFetcher(base_url=f'http://127.0.0.1:{server.server_port}')
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = fixture_path(self.path, directory)
+            if not path.exists():
+                self.send_error(404)
+                return
+            body = path.read_bytes()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_fetcher(
+    backend: str = 'http',
+    pool: Optional[DriverPool] = None,
+    fixtures: Path = FIXTURES,
+    max_connections: int = 16,
+    is_usable: Optional[Callable[[Page], bool]] = None,
+) -> Fetcher:
+    if backend == 'http':
+        return FallbackFetcher(
+            HttpFetcher(max_connections), SeleniumFetcher(pool), is_usable
+        )
+    if backend == 'selenium':
+        return SeleniumFetcher(pool)
+    if backend == 'replay':
+        # benchmarks and tests only, never offered in the app or job cli
+        return ReplayFetcher(fixtures)
+    raise ValueError(f'unknown fetch backend {backend}')
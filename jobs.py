@@ -0,0 +1,617 @@
+import argparse
+import datetime
+import fcntl
+import io
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+from attrs import asdict, evolve, fields, frozen
+
+import tracing
+from driver_pool import DriverPool, PoolStats
+from listing_index import ListingIndex
+from parse_pool import ParsePool
+from pipeline import StreamStats, streaming_search
+from rate_limit import RateLimiter, RateStats
+from scraper import SearchQuery
+
+JOBS_PATH = Path.cwd().joinpath('data', 'jobs.sqlite')
+LOCK_PATH = Path.cwd().joinpath('data', 'jobs.lock')
+WORKERS = 2
+MAX_BROWSERS = 16   # across all workers
+POLL = 1.0   # seconds between looks at the queue when it's empty
+HEARTBEAT = 5.0
+STALE = 30.0   # a worker this long without a heartbeat has died
+ACTIVE = ('queued', 'running', 'cancelling')
+LIVE_ROWS = 200   # latest rows kept for the page, the rest are in the store
+# columns added after the first job tables were made
+ADDED_COLUMNS = {
+    'parse_workers': 'INTEGER NOT NULL DEFAULT 0',
+    'rate': 'TEXT',
+    'pool': 'TEXT',
+    'recent': 'TEXT',
+}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+@frozen
+class Job:
+    id: int
+    key: str
+    make: str
+    model: str
+    min_year: int
+    max_year: int
+    max_workers: int
+    backend: str
+    incremental: bool
+    profiler: Optional[str]
+    parse_workers: int
+    status: str
+    submitted_at: str
+    started_at: Optional[str] = None
+    finished_at: Optional[str] = None
+    worker: Optional[str] = None
+    pages: int = 0
+    listings: int = 0
+    written: int = 0
+    shards: int = 0
+    pending: int = 0
+    errors: int = 0
+    resumed: int = 0
+    message: Optional[str] = None
+
+    @property
+    def query(self) -> SearchQuery:
+        return SearchQuery(self.make, self.model, self.min_year, self.max_year)
+
+    @property
+    def is_active(self) -> bool:
+        return self.status in ACTIVE
+
+    @property
+    def progress(self) -> float:
+        done = self.shards + self.errors
+        return done / max(done + self.pending, 1)
+
+
+JOB_COLUMNS = [field.name for field in fields(Job)]
+
+
+def _now() -> str:
+    return datetime.datetime.now().isoformat(timespec='seconds')
+
+
+def worker_name() -> str:
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def _exit_on_sigterm():
+    # a normal exit, so cleanup in finally blocks stops child processes
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+
+class JobQueue:
+    # scrape jobs and their progress in sqlite, shared by the app and the
+    # worker processes. a search can only be queued or running once
+    def __init__(self, path: Path = JOBS_PATH):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        # readers don't block the workers writing progress
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self._create()
+
+    def _create(self):
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT NOT NULL,
+                make TEXT NOT NULL,
+                model TEXT NOT NULL,
+                min_year INTEGER NOT NULL,
+                max_year INTEGER NOT NULL,
+                max_workers INTEGER NOT NULL,
+                backend TEXT NOT NULL,
+                incremental INTEGER NOT NULL,
+                profiler TEXT,
+                parse_workers INTEGER NOT NULL DEFAULT 0,
+                status TEXT NOT NULL,
+                submitted_at TEXT NOT NULL,
+                started_at TEXT,
+                finished_at TEXT,
+                worker TEXT,
+                pages INTEGER NOT NULL DEFAULT 0,
+                listings INTEGER NOT NULL DEFAULT 0,
+                written INTEGER NOT NULL DEFAULT 0,
+                shards INTEGER NOT NULL DEFAULT 0,
+                pending INTEGER NOT NULL DEFAULT 0,
+                errors INTEGER NOT NULL DEFAULT 0,
+                resumed INTEGER NOT NULL DEFAULT 0,
+                message TEXT,
+                trace TEXT,
+                profile TEXT,
+                rate TEXT,
+                pool TEXT,
+                recent TEXT
+            )
+            """
+        )
+        existing = {
+            row[1] for row in self.conn.execute('PRAGMA table_info(jobs)')
+        }
+        for name, definition in ADDED_COLUMNS.items():
+            if name not in existing:
+                self.conn.execute(
+                    f'ALTER TABLE jobs ADD COLUMN {name} {definition}'
+                )
+        # at most one active job per search, enforced by sqlite itself so
+        # two sessions submitting at once still get the same job
+        self.conn.execute(
+            'CREATE UNIQUE INDEX IF NOT EXISTS jobs_active ON jobs (key) '
+            f'WHERE status IN {ACTIVE}'
+        )
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS workers (
+                name TEXT PRIMARY KEY,
+                pid INTEGER NOT NULL,
+                job_id INTEGER,
+                heartbeat REAL NOT NULL
+            )
+            """
+        )
+
+    def _job(self, row: sqlite3.Row) -> Job:
+        job = {name: row[name] for name in JOB_COLUMNS}
+        return Job(**job | {'incremental': bool(job['incremental'])})
+
+    def submit(
+        self,
+        query: SearchQuery,
+        max_workers: int = 4,
+        backend: str = 'http',
+        incremental: bool = False,
+        profiler: Optional[str] = None,
+        parse_workers: int = 0,
+    ) -> tuple[Job, bool]:
+        # the job and whether it's new, or the one already running
+        key = query.name.lower()
+        with self.conn:
+            cursor = self.conn.execute(
+                """
+                INSERT OR IGNORE INTO jobs (
+                    key, make, model, min_year, max_year, max_workers,
+                    backend, incremental, profiler, parse_workers, status,
+                    submitted_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'queued', ?)
+                """,
+                (
+                    key,
+                    query.make,
+                    query.model,
+                    query.min_year,
+                    query.max_year,
+                    max_workers,
+                    backend,
+                    incremental,
+                    profiler,
+                    parse_workers,
+                    _now(),
+                ),
+            )
+        row = self.conn.execute(
+            f'SELECT * FROM jobs WHERE key = ? AND status IN {ACTIVE}', [key]
+        ).fetchone()
+        return self._job(row), cursor.rowcount == 1
+
+    def get(self, job_id: int) -> Optional[Job]:
+        row = self.conn.execute(
+            'SELECT * FROM jobs WHERE id = ?', [job_id]
+        ).fetchone()
+        return None if row is None else self._job(row)
+
+    def jobs(self, limit: int = 20) -> list[Job]:
+        # active jobs first, then the most recent
+        rows = self.conn.execute(
+            f"""
+            SELECT * FROM jobs
+            ORDER BY status IN {ACTIVE} DESC, id DESC
+            LIMIT ?
+            """,
+            [limit],
+        )
+        return [self._job(row) for row in rows]
+
+    def claim(self, worker: str) -> Optional[Job]:
+        # the oldest queued job, one worker wins it
+        with self.conn:
+            rows = self.conn.execute(
+                """
+                UPDATE jobs SET status = 'running', started_at = ?,
+                    worker = ?
+                WHERE id = (
+                    SELECT id FROM jobs WHERE status = 'queued'
+                    ORDER BY id LIMIT 1
+                )
+                RETURNING *
+                """,
+                [_now(), worker],
+            ).fetchall()
+        return self._job(rows[0]) if rows else None
+
+    def progress(
+        self,
+        job_id: int,
+        stats: StreamStats,
+        rate: Optional[RateStats] = None,
+        pool: Optional[PoolStats] = None,
+        recent: Optional[pd.DataFrame] = None,
+    ) -> str:
+        # returns the status, so a worker sees a cancel on its next flush.
+        # rate, pool and recent are left as they were when not given
+        if rate is not None:
+            # elapsed as of now, the page reading it has its own clock
+            rate = evolve(rate, finished=rate.finished or time.monotonic())
+        with self.conn:
+            self.conn.execute(
+                """
+                UPDATE jobs SET pages = ?, listings = ?, written = ?,
+                    shards = ?, pending = ?, errors = ?, resumed = ?,
+                    rate = COALESCE(?, rate), pool = COALESCE(?, pool),
+                    recent = COALESCE(?, recent)
+                WHERE id = ?
+                """,
+                [
+                    stats.pages,
+                    stats.listings,
+                    stats.written,
+                    stats.shards,
+                    stats.pending,
+                    len(stats.errors),
+                    stats.resumed,
+                    None if rate is None else json.dumps(asdict(rate)),
+                    None if pool is None else json.dumps(asdict(pool)),
+                    None
+                    if recent is None
+                    else recent.to_json(orient='split', date_format='iso'),
+                    job_id,
+                ],
+            )
+        return self.conn.execute(
+            'SELECT status FROM jobs WHERE id = ?', [job_id]
+        ).fetchone()[0]
+
+    def finish(
+        self,
+        job_id: int,
+        status: str,
+        message: Optional[str] = None,
+        trace: Optional[dict] = None,
+        profile: Optional[str] = None,
+    ):
+        with self.conn:
+            self.conn.execute(
+                """
+                UPDATE jobs SET status = ?, finished_at = ?, message = ?,
+                    trace = ?, profile = ?
+                WHERE id = ?
+                """,
+                [
+                    status,
+                    _now(),
+                    message,
+                    None if trace is None else json.dumps(trace),
+                    profile,
+                    job_id,
+                ],
+            )
+
+    def cancel(self, job_id: int):
+        # queued jobs stop here, running ones at their next flush
+        with self.conn:
+            self.conn.execute(
+                """
+                UPDATE jobs SET
+                    status = CASE status
+                        WHEN 'queued' THEN 'cancelled' ELSE 'cancelling' END,
+                    finished_at = CASE status
+                        WHEN 'queued' THEN ? ELSE finished_at END
+                WHERE id = ? AND status IN ('queued', 'running')
+                """,
+                [_now(), job_id],
+            )
+
+    def trace(self, job_id: int) -> tuple[Optional[dict], Optional[str]]:
+        row = self.conn.execute(
+            'SELECT trace, profile FROM jobs WHERE id = ?', [job_id]
+        ).fetchone()
+        if row is None or row['trace'] is None:
+            return None, None
+        return json.loads(row['trace']), row['profile']
+
+    def live(
+        self, job_id: int
+    ) -> tuple[Optional[RateStats], Optional[PoolStats], pd.DataFrame]:
+        # the fetch rate, the worker's browser pool and the latest rows,
+        # as of the job's last flush
+        row = self.conn.execute(
+            'SELECT rate, pool, recent FROM jobs WHERE id = ?', [job_id]
+        ).fetchone()
+        if row is None:
+            return None, None, pd.DataFrame()
+        rate = None if row['rate'] is None else json.loads(row['rate'])
+        pool = None if row['pool'] is None else json.loads(row['pool'])
+        recent = (
+            pd.DataFrame()
+            if row['recent'] is None
+            else pd.read_json(io.StringIO(row['recent']), orient='split')
+        )
+        return (
+            None if rate is None else RateStats(**rate),
+            None if pool is None else PoolStats(**pool),
+            recent,
+        )
+
+    def heartbeat(self, worker: str, job_id: Optional[int] = None):
+        with self.conn:
+            self.conn.execute(
+                """
+                INSERT INTO workers VALUES (?, ?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    job_id = excluded.job_id, heartbeat = excluded.heartbeat
+                """,
+                [worker, os.getpid(), job_id, time.time()],
+            )
+
+    def workers(self) -> pd.DataFrame:
+        return pd.read_sql_query(
+            'SELECT * FROM workers WHERE heartbeat >= ? ORDER BY name',
+            self.conn,
+            params=[time.time() - STALE],
+        )
+
+    def requeue_stale(self) -> int:
+        # jobs whose worker died are queued again, their checkpoint makes
+        # them resume from the last page written
+        cutoff = time.time() - STALE
+        stale = (
+            'worker IS NOT NULL AND worker NOT IN '
+            '(SELECT name FROM workers WHERE heartbeat >= ?)'
+        )
+        with self.conn:
+            self.conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = ? "
+                f"WHERE status = 'cancelling' AND {stale}",
+                [_now(), cutoff],
+            )
+            cursor = self.conn.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL "
+                f"WHERE status = 'running' AND {stale}",
+                [cutoff],
+            )
+            self.conn.execute(
+                'DELETE FROM workers WHERE heartbeat < ?', [cutoff]
+            )
+        return cursor.rowcount
+
+    def close(self):
+        self.conn.close()
+
+
+def run_job(
+    queue: JobQueue,
+    job: Job,
+    pool: DriverPool,
+    limiter: RateLimiter,
+    parser: Optional[ParsePool] = None,
+):
+    # the rate carries over from the worker's last job, the counts don't
+    limiter.stats = RateStats()
+    recent = pd.DataFrame()
+
+    def on_flush(df: pd.DataFrame, stats: StreamStats):
+        nonlocal recent
+        if not df.empty:
+            recent = pd.concat([recent, df], ignore_index=True)
+            recent = recent.tail(LIVE_ROWS).reset_index(drop=True)
+        status = queue.progress(
+            job.id, stats, limiter.stats, pool.stats, recent
+        )
+        if status == 'cancelling':
+            raise JobCancelled()
+
+    index = ListingIndex()
+    status, message = 'done', None
+    with tracing.tracing() as tracer, tracing.profiled(
+        job.profiler
+    ) as profile:
+        try:
+            with tracing.span('job', backend=job.backend):
+                stats = streaming_search(
+                    job.query,
+                    job.max_workers,
+                    on_flush,
+                    pool=pool,
+                    backend=job.backend,
+                    limiter=limiter,
+                    index=index,
+                    incremental=job.incremental,
+                    parser=parser,
+                )
+            queue.progress(job.id, stats, stats.rate, pool.stats)
+            if stats.errors:
+                status = 'failed'
+                message = '\n'.join(str(error) for error in stats.errors)
+            elif stats.parse is not None and stats.parse.pages:
+                parse = stats.parse
+                message = (
+                    f'parsed {parse.listings_per_core_second:.0f} '
+                    f'listings/s per core, {parse.utilization:.0%} of '
+                    f'{parse.workers} parse processes busy'
+                )
+        except JobCancelled:
+            status = 'cancelled'
+        except Exception as error:
+            status, message = 'failed', f'{type(error).__name__}: {error}'
+        finally:
+            index.close()
+    queue.finish(job.id, status, message, tracer.to_json(), profile.report)
+
+
+def work(path: Path = JOBS_PATH, num_workers: int = WORKERS):
+    # one worker process: takes the next queued job and runs it, its
+    # browsers stay warm between jobs. carsales sees every worker at
+    # once, so each gets its share of the browsers and the request rate
+    _exit_on_sigterm()
+    name = worker_name()
+    queue = JobQueue(path)
+    pool = DriverPool(max_size=max(1, MAX_BROWSERS // num_workers))
+    limiter = RateLimiter().share(num_workers)
+    parser: Optional[ParsePool] = None
+    current: list[Optional[int]] = [None]
+    stop = threading.Event()
+
+    def beat():
+        # on its own connection, a long page mustn't look like a dead worker
+        beats = JobQueue(path)
+        while not stop.wait(HEARTBEAT):
+            beats.heartbeat(name, current[0])
+        beats.close()
+
+    queue.heartbeat(name)
+    threading.Thread(target=beat, daemon=True).start()
+    try:
+        while True:
+            job = queue.claim(name)
+            if job is None:
+                time.sleep(POLL)
+                continue
+            current[0] = job.id
+            queue.heartbeat(name, job.id)
+            # parse processes stay warm while jobs ask for the same number
+            if parser is not None and parser.max_workers != job.parse_workers:
+                parser.close()
+                parser = None
+            if parser is None and job.parse_workers:
+                parser = ParsePool(job.parse_workers)
+            run_job(queue, job, pool, limiter, parser)
+            current[0] = None
+            queue.heartbeat(name)
+    finally:
+        stop.set()
+        if parser is not None:
+            parser.close()
+        pool.close()
+        queue.close()
+
+
+def serve(num_workers: int = WORKERS, path: Path = JOBS_PATH):
+    # keeps num_workers worker processes alive. the lock makes a second
+    # supervisor exit straight away, so any page can call start_workers
+    LOCK_PATH.parent.mkdir(parents=True, exist_ok=True)
+    lock = LOCK_PATH.open('w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        print('job workers are already running')
+        return
+
+    _exit_on_sigterm()
+    context = multiprocessing.get_context('spawn')
+    processes: list[multiprocessing.Process] = []
+    queue = JobQueue(path)
+    try:
+        while True:
+            queue.requeue_stale()
+            processes = [p for p in processes if p.is_alive()]
+            while len(processes) < num_workers:
+                # not daemonic, a worker may start its own parse processes
+                process = context.Process(
+                    target=work, args=(path, num_workers)
+                )
+                process.start()
+                processes.append(process)
+            time.sleep(HEARTBEAT)
+    finally:
+        for process in processes:
+            process.terminate()
+        queue.close()
+        lock.close()
+
+
+def start_workers(num_workers: int = WORKERS) -> subprocess.Popen:
+    # a detached supervisor, it outlives the script run that started it
+    return subprocess.Popen(
+        [sys.executable, __file__, 'serve', '--workers', str(num_workers)],
+        cwd=Path.cwd(),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='background scrape jobs')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve_parser = commands.add_parser('serve', help='run the job workers')
+    serve_parser.add_argument('--workers', type=int, default=WORKERS)
+    submit = commands.add_parser('submit', help='queue a search')
+    submit.add_argument('make')
+    submit.add_argument('model')
+    submit.add_argument('min_year', type=int)
+    submit.add_argument('max_year', type=int)
+    submit.add_argument('--max-workers', type=int, default=4)
+    submit.add_argument(
+        '--backend', choices=['http', 'selenium'], default='http'
+    )
+    submit.add_argument('--incremental', action='store_true')
+    submit.add_argument('--parse-workers', type=int, default=0)
+    commands.add_parser('status', help='list recent jobs')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.workers)
+        return
+
+    queue = JobQueue()
+    if args.command == 'submit':
+        query = SearchQuery(
+            args.make, args.model, args.min_year, args.max_year
+        )
+        job, created = queue.submit(
+            query,
+            args.max_workers,
+            args.backend,
+            args.incremental,
+            parse_workers=args.parse_workers,
+        )
+        print('queued' if created else 'already queued as', f'job {job.id}')
+    else:
+        for job in queue.jobs():
+            print(
+                f'{job.id:>4} {job.status:<10} {job.query.name:<32} '
+                f'{job.pages} pages, {job.listings} listings'
+            )
+    queue.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+import functools
+from decimal import ROUND_HALF_DOWN, Decimal
+from typing import Iterable, Sequence
+
+import numpy as np
+import numpy_financial as npf
+import pandas as pd
+from attrs import define, field
+
+
+def D(num, prec='0.01'):
+    return Decimal(num).quantize(Decimal(prec), rounding=ROUND_HALF_DOWN)
+
+
+RESIDUAL = {
+    1: D(65.63),
+    2: D(56.25),
+    3: D(46.88),
+    4: D(37.50),
+    5: D(28.13),
+}
+
+TAX_RATE = D(0.325, '0.001')
+MEDICARE_RATE = D(0.02, '0.01')
+
+
+@define
+class Car:
+    make: str
+    model: str
+    base_price_ex_gst: Decimal
+    accessories_price_ex_gst: Decimal
+    delivery_charges_ex_gst: Decimal
+    is_electric: bool
+    annual_running_costs: Decimal
+
+    stamp_duty: Decimal = field(init=False)
+
+    total_price_inc_gst: Decimal = field(init=False)
+    total_price_inc_gst_and_sd: Decimal = field(init=False)
+    total_price_ex_gst: Decimal = field(init=False)
+    gst: Decimal = field(init=False)
+
+    def __attrs_post_init__(self):
+        self.total_price_ex_gst = D(
+            sum(
+                [
+                    self.base_price_ex_gst,
+                    self.accessories_price_ex_gst,
+                    self.delivery_charges_ex_gst,
+                ]
+            )
+        )
+        self.gst = self.total_price_ex_gst * D(0.1)
+        self.total_price_inc_gst = D(self.total_price_ex_gst + self.gst)
+        self.stamp_duty = D(self.total_price_inc_gst * D(8.4) / D(200))
+        self.total_price_inc_gst_and_sd = D(
+            self.total_price_inc_gst + self.stamp_duty
+        )
+
+
+@define
+class NovatedLease:
+    car: Car
+    interest_rate: Decimal
+    lease_term: int
+
+    name: str = field(init=False)
+    financed_amount: Decimal = field(init=False)
+    residual_amount_ex_gst: Decimal = field(init=False)
+    residual_amount_inc_gst: Decimal = field(init=False)
+    monthly_lease: Decimal = field(init=False)
+    annual_lease: Decimal = field(init=False)
+    total_purchase_cost: Decimal = field(init=False)
+    fbt: Decimal = field(init=False)
+    fbt_taxable_value: Decimal = field(init=False)
+    annual_repayment_before_tax: Decimal = field(init=False)
+    annual_repayment_post_tax: Decimal = field(init=False)
+    annual_tax_saving: Decimal = field(init=False)
+    annual_repayment_full: Decimal = field(init=False)
+    monthly_repayment_full: Decimal = field(init=False)
+    fortnightly_repayment_full: Decimal = field(init=False)
+
+    def __attrs_post_init__(self):
+        self.fbt_taxable_value = D(self.car.total_price_inc_gst * D(0.2))
+        self.fbt = D(self.fbt_taxable_value * D(2.0802 * 0.47, '0.0001'))
+
+        self.financed_amount = (
+            self.car.total_price_ex_gst + self.car.stamp_duty
+        )
+        self.residual_amount_ex_gst = D(
+            self.financed_amount * RESIDUAL[self.lease_term] / 100
+        )
+        self.residual_amount_inc_gst = D(
+            D(self.residual_amount_ex_gst) * D(1.1)
+        )
+        self.monthly_lease = D(
+            npf.pmt(
+                float(self.interest_rate) / 12,
+                self.lease_term * 12,
+                -(
+                    float(self.financed_amount)
+                    - float(self.residual_amount_ex_gst)
+                ),
+            )
+            + float(self.residual_amount_ex_gst)
+            * float(self.interest_rate)
+            / 12
+        )   # principal+interest on lease portion, interest only on residual
+
+        self.annual_lease = D(self.monthly_lease * 12)
+
+        self.annual_repayment_before_tax = (
+            self.annual_lease
+            if self.car.is_electric
+            else self.annual_lease - self.fbt_taxable_value
+        )
+
+        self.annual_repayment_post_tax = (
+            D(0.0) if self.car.is_electric else self.fbt_taxable_value
+        )
+
+        self.annual_tax_saving = D(
+            self.annual_repayment_before_tax * (TAX_RATE + MEDICARE_RATE)
+        )
+
+        self.annual_repayment_full = (
+            self.annual_repayment_before_tax
+            + self.annual_repayment_post_tax
+            - self.annual_tax_saving
+        )
+
+        self.monthly_repayment_full = D(self.annual_repayment_full / D(12))
+        self.fortnightly_repayment_full = D(self.annual_repayment_full / D(26))
+
+        self.total_purchase_cost = D(
+            self.annual_repayment_full * self.lease_term
+            + self.residual_amount_inc_gst
+        )
+
+        self.name = '_'.join(
+            [self.car.make, self.car.model, 'novated_lease']
+        ).replace(' ', '_')
+
+
+# the batch engine below works in integer cents (or 1e-4 units) so that it
+# rounds exactly like the Decimal ROUND_HALF_DOWN path above
+
+
+def _cents(value: Decimal, places: int = 2) -> int:
+    return int(value.scaleb(places))
+
+
+RESIDUAL_BP = np.array([0] + [_cents(RESIDUAL[term]) for term in range(1, 6)])
+FBT_RATE_BP = _cents(D(2.0802 * 0.47, '0.0001'), 4)
+TAX_AND_MEDICARE = _cents(TAX_RATE + MEDICARE_RATE, 3)
+
+
+def _split(a: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    c = 134217729.0 * a   # 2**27 + 1
+    hi = c - (c - a)
+    return hi, a - hi
+
+
+def quantize(values, places: int = 2) -> np.ndarray:
+    # D(float) as integers: round half down on the exact binary value of
+    # each float, the product is kept exact with a Dekker two-product
+    values = np.asarray(values, dtype=float)
+    sign = np.sign(values)
+    a = np.abs(values)
+    b = float(10**places)
+    product = a * b
+    a_hi, a_lo = _split(a)
+    b_hi, b_lo = _split(np.full_like(a, b))
+    error = (
+        (a_hi * b_hi - product) + a_hi * b_lo + a_lo * b_hi
+    ) + a_lo * b_lo
+    floor = np.floor(product)
+    round_up = ((product - floor) - 0.5) + error > 0
+    return (sign * (floor + round_up)).astype(np.int64)
+
+
+def _divide(numerator: np.ndarray, denominator: int) -> np.ndarray:
+    # integer division rounding half down (towards zero on a tie)
+    sign = np.sign(numerator)
+    quotient, remainder = np.divmod(np.abs(numerator), denominator)
+    return sign * (quotient + (2 * remainder > denominator))
+
+
+def _as_units(values, places: int = 2) -> np.ndarray:
+    values = np.asarray(values)
+    if values.dtype == object:
+        return np.array(
+            [_cents(D(value, f'1e-{places}'), places) for value in values],
+            dtype=np.int64,
+        )
+    return quantize(values, places)
+
+
+def lease_grid(
+    cars: pd.DataFrame,
+    interest_rates: Sequence[float],
+    lease_terms: Iterable[int] = range(1, 6),
+) -> pd.DataFrame:
+    # every car x interest rate x lease term at once, cars needs
+    # base_price_ex_gst, accessories_price_ex_gst, delivery_charges_ex_gst
+    # and is_electric, rates are fractions like 0.0939
+    base = _as_units(cars['base_price_ex_gst'])
+    accessories = _as_units(cars['accessories_price_ex_gst'])
+    delivery = _as_units(cars['delivery_charges_ex_gst'])
+    is_electric = cars['is_electric'].to_numpy(dtype=bool)[:, None, None]
+    rate_bp = _as_units(interest_rates, 4)[None, :, None]
+    terms = np.asarray(list(lease_terms), dtype=np.int64)[None, None, :]
+
+    # Car
+    total_price_ex_gst = (base + accessories + delivery)[:, None, None]
+    gst = total_price_ex_gst * 10   # 1e-4 units, not quantized
+    total_price_inc_gst = _divide(total_price_ex_gst * 110, 100)
+    stamp_duty = _divide(total_price_inc_gst * 42, 1000)
+
+    # NovatedLease
+    fbt_taxable_value = _divide(total_price_inc_gst * 2, 10)
+    fbt = _divide(fbt_taxable_value * FBT_RATE_BP, 10000)
+    financed_amount = total_price_ex_gst + stamp_duty
+    residual_amount_ex_gst = _divide(
+        financed_amount * RESIDUAL_BP[terms], 10000
+    )
+    residual_amount_inc_gst = _divide(residual_amount_ex_gst * 110, 100)
+
+    # same float operations, in the same order, as the scalar path
+    rate = rate_bp / 10000
+    residual = residual_amount_ex_gst / 100
+    monthly_lease = quantize(
+        npf.pmt(rate / 12, terms * 12, -(financed_amount / 100 - residual))
+        + residual * rate / 12
+    )
+
+    annual_lease = monthly_lease * 12
+    annual_repayment_before_tax = np.where(
+        is_electric, annual_lease, annual_lease - fbt_taxable_value
+    )
+    annual_repayment_post_tax = np.where(is_electric, 0, fbt_taxable_value)
+    annual_tax_saving = _divide(
+        annual_repayment_before_tax * TAX_AND_MEDICARE, 1000
+    )
+    annual_repayment_full = (
+        annual_repayment_before_tax
+        + annual_repayment_post_tax
+        - annual_tax_saving
+    )
+    monthly_repayment_full = _divide(annual_repayment_full, 12)
+    fortnightly_repayment_full = _divide(annual_repayment_full, 26)
+    total_purchase_cost = (
+        annual_repayment_full * terms + residual_amount_inc_gst
+    )
+
+    columns = {
+        'total_price_ex_gst': total_price_ex_gst,
+        'gst': gst,
+        'total_price_inc_gst': total_price_inc_gst,
+        'stamp_duty': stamp_duty,
+        'fbt_taxable_value': fbt_taxable_value,
+        'fbt': fbt,
+        'financed_amount': financed_amount,
+        'residual_amount_ex_gst': residual_amount_ex_gst,
+        'residual_amount_inc_gst': residual_amount_inc_gst,
+        'monthly_lease': monthly_lease,
+        'annual_lease': annual_lease,
+        'annual_repayment_before_tax': annual_repayment_before_tax,
+        'annual_repayment_post_tax': annual_repayment_post_tax,
+        'annual_tax_saving': annual_tax_saving,
+        'annual_repayment_full': annual_repayment_full,
+        'monthly_repayment_full': monthly_repayment_full,
+        'fortnightly_repayment_full': fortnightly_repayment_full,
+        'total_purchase_cost': total_purchase_cost,
+    }
+    shape = np.broadcast_shapes(
+        total_price_ex_gst.shape, rate_bp.shape, terms.shape
+    )
+    index = pd.MultiIndex.from_product(
+        [cars.index, rate_bp.ravel() / 10000, terms.ravel()],
+        names=[cars.index.name or 'car', 'interest_rate', 'lease_term'],
+    )
+    return pd.DataFrame(
+        {
+            name: np.broadcast_to(values, shape).ravel()
+            / (10000 if name == 'gst' else 100)
+            for name, values in columns.items()
+        },
+        index=index,
+    )
+
+
+SLIDER_RATES = np.arange(100, 1501) / 10000   # 1% to 15% in 0.01% steps
+
+
+@functools.lru_cache(maxsize=64)
+def _sensitivity(
+    base_price_ex_gst: Decimal,
+    accessories_price_ex_gst: Decimal,
+    delivery_charges_ex_gst: Decimal,
+    is_electric: bool,
+) -> pd.DataFrame:
+    cars = pd.DataFrame(
+        {
+            'base_price_ex_gst': [base_price_ex_gst],
+            'accessories_price_ex_gst': [accessories_price_ex_gst],
+            'delivery_charges_ex_gst': [delivery_charges_ex_gst],
+            'is_electric': [is_electric],
+        }
+    )
+    return lease_grid(cars, SLIDER_RATES).droplevel(0)
+
+
+def sensitivity(car: Car) -> pd.DataFrame:
+    # every slider rate x term for one car, memoized on the car's inputs
+    # so moving the sliders is a lookup, don't modify the returned frame
+    return _sensitivity(
+        car.base_price_ex_gst,
+        car.accessories_price_ex_gst,
+        car.delivery_charges_ex_gst,
+        car.is_electric,
+    )
+
+
+def lookup(car: Car, interest_rate: Decimal, lease_term: int) -> pd.Series:
+    return sensitivity(car).loc[(float(interest_rate), lease_term)]
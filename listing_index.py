@@ -0,0 +1,311 @@
+import datetime
+import operator
+import sqlite3
+import sys
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterable, Optional, Union
+
+import attrs
+import pandas as pd
+
+from car import Car
+
+if TYPE_CHECKING:
+    import pyarrow as pa
+
+INDEX_PATH = Path.cwd().joinpath('data', 'listings.sqlite')
+WEEK = datetime.timedelta(days=7)
+FIELDS = [field for field in attrs.fields(Car) if field.name != 'id']
+NAMES = [field.name for field in attrs.fields(Car)]
+KEY = ['drive_away_price', 'ex_gov_price', 'kms']
+INDEXES = {
+    'listings_make_model_year': 'listings (make, model, year)',
+    'listings_model': 'listings (model)',
+    'listings_year': 'listings (year)',
+    'listings_state': 'listings (state)',
+    'listings_price': 'listings (ex_gov_price)',
+    'price_history_seen_at': 'price_history (seen_at)',
+}
+
+
+# price and kms of a row of NAMES, a change in either is a new snapshot
+_key = operator.itemgetter(*(NAMES.index(name) for name in KEY))
+_id = operator.itemgetter(NAMES.index('id'))
+_fields = operator.itemgetter(*(NAMES.index(field.name) for field in FIELDS))
+
+
+def _columns(
+    listings: Union['pa.Table', Iterable[Car]], names: list[str]
+) -> list[list]:
+    # the scraper hands over arrow tables of its parsed pages, so no Car
+    # is built per row, everything else Car objects
+    if hasattr(listings, 'column_names'):
+        return [listings[name].to_pylist() for name in names]
+    listings = list(listings)
+    return [[getattr(car, name) for car in listings] for name in names]
+
+
+def _sql_type(type_) -> str:
+    if int in (type_, *getattr(type_, '__args__', ())):
+        return 'INTEGER'
+    return 'TEXT'
+
+
+def _timestamp(value: Optional[datetime.datetime] = None) -> str:
+    value = value or datetime.datetime.now()
+    return value.isoformat(sep='T', timespec='seconds')
+
+
+def _where(
+    makes: Optional[list[str]] = None,
+    models: Optional[list[str]] = None,
+    min_year: Optional[int] = None,
+    max_year: Optional[int] = None,
+    states: Optional[list[str]] = None,
+    min_price: Optional[int] = None,
+    max_price: Optional[int] = None,
+) -> tuple[list[str], list]:
+    # same filters as store.filter_expression, each one an indexed column
+    conditions, params = [], []
+    for column, values in (
+        ('make', makes),
+        ('model', models),
+        ('state', states),
+    ):
+        if values:
+            conditions.append(
+                f'l.{column} IN ({",".join("?" * len(values))})'
+            )
+            params.extend(values)
+    for condition, value in (
+        ('l.year >= ?', min_year),
+        ('l.year <= ?', max_year),
+        ('l.ex_gov_price >= ?', min_price),
+        ('l.ex_gov_price <= ?', max_price),
+    ):
+        if value is not None:
+            conditions.append(condition)
+            params.append(value)
+    return conditions, params
+
+
+class ListingIndex:
+    # the latest snapshot of every Car.id we've scraped, plus a history row
+    # each time its price or kms changed
+    def __init__(self, path: Path = INDEX_PATH):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self._create()
+
+    def _create(self):
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS listings (
+                id TEXT PRIMARY KEY,
+                drive_away_price INTEGER,
+                ex_gov_price INTEGER,
+                kms INTEGER,
+                first_seen TEXT NOT NULL,
+                last_seen TEXT NOT NULL
+            )
+            """
+        )
+        # indexes made before the full snapshot was kept only had prices
+        existing = {
+            row[1] for row in self.conn.execute('PRAGMA table_info(listings)')
+        }
+        for field in FIELDS:
+            if field.name not in existing:
+                self.conn.execute(
+                    f'ALTER TABLE listings '
+                    f'ADD COLUMN {field.name} {_sql_type(field.type)}'
+                )
+
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS price_history (
+                id TEXT NOT NULL,
+                seen_at TEXT NOT NULL,
+                drive_away_price INTEGER,
+                ex_gov_price INTEGER,
+                kms INTEGER,
+                PRIMARY KEY (id, seen_at)
+            )
+            """
+        )
+        for name, columns in INDEXES.items():
+            self.conn.execute(
+                f'CREATE INDEX IF NOT EXISTS {name} ON {columns}'
+            )
+
+    def is_empty(self) -> bool:
+        return self.conn.execute('SELECT 1 FROM listings').fetchone() is None
+
+    def _known(self, ids: list[str]) -> dict[str, tuple]:
+        if not ids:
+            return {}
+        rows = self.conn.execute(
+            'SELECT id, drive_away_price, ex_gov_price, kms, first_seen '
+            f'FROM listings WHERE id IN ({",".join("?" * len(ids))})',
+            ids,
+        )
+        return {row[0]: row[1:] for row in rows}
+
+    def all_unchanged(
+        self, listings: Union['pa.Table', Iterable[Car]]
+    ) -> bool:
+        # a results page made up only of listings we already have
+        ids, *keys = _columns(listings, ['id', *KEY])
+        known = self._known(ids)
+        return bool(ids) and all(
+            known.get(listing_id, (None,) * 4)[:3] == key
+            for listing_id, key in zip(ids, zip(*keys))
+        )
+
+    def record(
+        self,
+        listings: Union['pa.Table', Iterable[Car]],
+        seen_at: Optional[datetime.datetime] = None,
+    ) -> pd.DataFrame:
+        # update the index and return only the new or changed listings
+        rows = list(zip(*_columns(listings, NAMES)))
+        now = _timestamp(seen_at)
+        known = self._known([_id(row) for row in rows])
+
+        records, history = [], []
+        for row in rows:
+            previous = known.get(_id(row))
+            first_seen = previous[3] if previous else now
+            if previous is None or previous[:3] != _key(row):
+                records.append(
+                    dict(zip(NAMES, row))
+                    | {'first_seen': first_seen, 'last_seen': now}
+                )
+                history.append((_id(row), now, *_key(row)))
+
+        names = [field.name for field in FIELDS]
+        with self.conn:
+            self.conn.executemany(
+                f"""
+                INSERT INTO listings
+                    (id, {", ".join(names)}, first_seen, last_seen)
+                VALUES ({", ".join("?" * (len(names) + 3))})
+                ON CONFLICT(id) DO UPDATE SET
+                    {", ".join(f"{n} = excluded.{n}" for n in names)},
+                    last_seen = excluded.last_seen
+                """,
+                [(_id(row), *_fields(row), now, now) for row in rows],
+            )
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO price_history VALUES (?, ?, ?, ?, ?)',
+                history,
+            )
+
+        return pd.DataFrame.from_records(records)
+
+    def query(
+        self,
+        columns: Optional[list[str]] = None,
+        makes: Optional[list[str]] = None,
+        models: Optional[list[str]] = None,
+        min_year: Optional[int] = None,
+        max_year: Optional[int] = None,
+        states: Optional[list[str]] = None,
+        min_price: Optional[int] = None,
+        max_price: Optional[int] = None,
+    ) -> pd.DataFrame:
+        conditions, params = _where(
+            makes, models, min_year, max_year, states, min_price, max_price
+        )
+        select = ', '.join(f'l.{c}' for c in columns) if columns else 'l.*'
+        where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+        return pd.read_sql_query(
+            f'SELECT {select} FROM listings l {where}',
+            self.conn,
+            params=params,
+        )
+
+    def price_drops(
+        self,
+        min_drop: float = 0.05,
+        since: Optional[datetime.datetime] = None,
+        makes: Optional[list[str]] = None,
+        models: Optional[list[str]] = None,
+        min_year: Optional[int] = None,
+        max_year: Optional[int] = None,
+        states: Optional[list[str]] = None,
+    ) -> pd.DataFrame:
+        # listings whose price now is at least min_drop below what it was
+        # before since, default the last week. only ids with a history row
+        # after since can qualify, which the seen_at index finds directly
+        since = _timestamp(since or datetime.datetime.now() - WEEK)
+        conditions, params = _where(
+            makes, models, min_year, max_year, states
+        )
+        filters = ''.join(f' AND {condition}' for condition in conditions)
+        return pd.read_sql_query(
+            f"""
+            WITH changed AS (
+                SELECT DISTINCT id FROM price_history WHERE seen_at >= ?
+            ),
+            before AS (
+                SELECT h.id, COALESCE(h.ex_gov_price, h.drive_away_price)
+                    AS previous_price
+                FROM changed c JOIN price_history h ON h.id = c.id
+                WHERE h.seen_at = (
+                    SELECT MAX(seen_at) FROM price_history
+                    WHERE id = c.id AND seen_at < ?
+                )
+            )
+            SELECT l.*, b.previous_price,
+                COALESCE(l.ex_gov_price, l.drive_away_price) AS price,
+                1.0 * COALESCE(l.ex_gov_price, l.drive_away_price)
+                    / b.previous_price - 1 AS price_change
+            FROM before b JOIN listings l ON l.id = b.id
+            WHERE COALESCE(l.ex_gov_price, l.drive_away_price)
+                <= b.previous_price * (1 - ?){filters}
+            ORDER BY price_change
+            """,
+            self.conn,
+            params=[since, since, min_drop, *params],
+        )
+
+    def history(self, listing_id: str) -> pd.DataFrame:
+        return pd.read_sql_query(
+            'SELECT * FROM price_history WHERE id = ? ORDER BY seen_at',
+            self.conn,
+            params=[listing_id],
+        )
+
+    def rebuild(self, store=None) -> int:
+        # replay every snapshot in the parquet store in scrape order, so
+        # the history covers listings scraped before the index existed
+        from store import ListingStore
+
+        store = store or ListingStore()
+        df = store.load(latest=False)
+        if df.empty:
+            return 0
+        df = df.sort_values('scraped_at', kind='stable')
+        for scraped_at, group in df.groupby('scraped_at', sort=False):
+            records = group[NAMES].astype(object)
+            records = records.where(records.notna(), None)
+            cars = [
+                Car(**record) for record in records.to_dict('records')
+            ]
+            self.record(cars, scraped_at.to_pydatetime())
+        return len(df)
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['rebuild']:
+        index = ListingIndex()
+        print(index.rebuild(), 'snapshots indexed')
+        index.close()
+    else:
+        print('usage: python listing_index.py rebuild')
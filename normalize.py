@@ -0,0 +1,180 @@
+import functools
+import re
+import sys
+import timeit
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+
+PRICE = re.compile(r'\$([\d,]+)')
+KMS = re.compile(r'([\d,]+).*km')
+MARKETING_YEAR = re.compile(r'(MY[\.\d]+)')
+SELLER_TYPE_NOISE = re.compile(r'[\d\.]+')
+DRIVE_AWAY = 'Drive Away'
+BADGE_NOISE = [MARKETING_YEAR.pattern, 'Auto']
+
+
+def parse_price(text: str) -> Optional[int]:
+    match = PRICE.match(text)
+    if match is None:
+        return None
+    return int(match.group(1).replace(',', ''))
+
+
+def split_prices(
+    price_text: str, price_info: str
+) -> tuple[Optional[int], Optional[int]]:
+    # (drive_away_price, ex_gov_price), a drive away listing may still
+    # quote the excluding government charges price in its price info
+    price = parse_price(price_text)
+    if DRIVE_AWAY in price_text or DRIVE_AWAY in price_info:
+        return price, parse_price(price_info)
+    return None, price
+
+
+def parse_kms(odometer: Optional[str]) -> int:
+    if not odometer:
+        return 0
+    match = KMS.match(odometer)
+    if match is None:
+        return 0
+    return int(match.group(1).replace(',', ''))
+
+
+def marketing_year(title: str) -> str:
+    match = MARKETING_YEAR.search(title)
+    return match.group(1) if match is not None else ''
+
+
+def seller_type(text: str) -> str:
+    return SELLER_TYPE_NOISE.sub('', text).strip()
+
+
+@functools.lru_cache(maxsize=1024)
+def _badge_patterns(year: int, make: str, model: str) -> list[re.Pattern]:
+    # make and model are literal text, not patterns
+    return [
+        re.compile(re.escape(str(year))),
+        re.compile(re.escape(make)),
+        re.compile(re.escape(model)),
+        *(re.compile(pattern) for pattern in BADGE_NOISE),
+    ]
+
+
+def badge(title: str, year: int, make: str, model: str) -> str:
+    for pattern in _badge_patterns(year, make, model):
+        title = pattern.sub('', title)
+    return title.strip()
+
+
+def prices_series(
+    price_text: pd.Series, price_info: pd.Series
+) -> pd.DataFrame:
+    def to_int(series: pd.Series) -> pd.Series:
+        digits = series.str.extract('^' + PRICE.pattern, expand=False)
+        return pd.to_numeric(digits.str.replace(',', '', regex=False))
+
+    price_text = price_text.fillna('').astype(str)
+    price_info = price_info.fillna('').astype(str)
+    price = to_int(price_text).astype('Int64')
+    is_drive_away = price_text.str.contains(
+        DRIVE_AWAY, regex=False
+    ) | price_info.str.contains(DRIVE_AWAY, regex=False)
+    return pd.DataFrame(
+        {
+            'drive_away_price': price.where(is_drive_away),
+            'ex_gov_price': price.where(
+                ~is_drive_away, to_int(price_info).astype('Int64')
+            ),
+        }
+    )
+
+
+def kms_series(odometer: pd.Series) -> pd.Series:
+    digits = odometer.astype('string').str.extract(
+        '^' + KMS.pattern, expand=False
+    )
+    kms = pd.to_numeric(digits.str.replace(',', '', regex=False))
+    return kms.fillna(0).astype('int64')
+
+
+def marketing_year_series(title: pd.Series) -> pd.Series:
+    return (
+        title.astype(str)
+        .str.extract(MARKETING_YEAR.pattern, expand=False)
+        .fillna('')
+    )
+
+
+def badge_series(
+    title: pd.Series, year: pd.Series, make: pd.Series, model: pd.Series
+) -> pd.Series:
+    # year, make and model differ per row but repeat a lot, so they are
+    # stripped once per distinct combination and the rest in one pass
+    badge = title.astype(str)
+    keys = pd.DataFrame(
+        {'year': year, 'make': make.astype(str), 'model': model.astype(str)}
+    )
+    # positions rather than labels, the index needn't be unique
+    stripped = badge.to_numpy(copy=True)
+    for (year_, make_, model_), rows in keys.groupby(
+        ['year', 'make', 'model'], sort=False
+    ).indices.items():
+        subset = badge.iloc[rows]
+        for value in (str(year_), make_, model_):
+            subset = subset.str.replace(value, '', regex=False)
+        stripped[rows] = subset.to_numpy()
+    badge = pd.Series(stripped, index=badge.index, name=badge.name)
+    for pattern in BADGE_NOISE:
+        badge = badge.str.replace(pattern, '', regex=True)
+    return badge.str.strip()
+
+
+def normalize_frame(df: pd.DataFrame) -> pd.DataFrame:
+    # re-derive the parsed fields of a stored dataset from its raw text
+    df = df.copy()
+    prices = prices_series(df['price_text'], df['price_info'])
+    df['drive_away_price'] = prices['drive_away_price']
+    df['ex_gov_price'] = prices['ex_gov_price']
+    df['kms'] = kms_series(df['odometer'])
+    df['marketing_year'] = marketing_year_series(df['title'])
+    df['badge'] = badge_series(
+        df['title'], df['year'], df['make'], df['model']
+    )
+    return df
+
+
+def _benchmark(paths: list[Path], number: int = 5):
+    df = pd.concat([pd.read_csv(path, index_col=0) for path in paths])
+    df = df.reset_index(drop=True)
+    rows = list(
+        df[
+            ['title', 'year', 'make', 'model', 'price_text', 'price_info']
+        ].itertuples(index=False)
+    )
+    odometers = df['odometer'].tolist()
+
+    def scalar():
+        for row, odometer in zip(rows, odometers):
+            split_prices(row.price_text, row.price_info)
+            parse_kms(odometer)
+            marketing_year(row.title)
+            badge(row.title, row.year, row.make, row.model)
+
+    def vectorized():
+        normalize_frame(df)
+
+    for name, func in [('scalar', scalar), ('series', vectorized)]:
+        seconds = min(timeit.repeat(func, number=number, repeat=3)) / number
+        print(
+            f'{name:>8}: {seconds * 1000:8.2f} ms for {len(df)} rows, '
+            f'{len(df) / seconds:10.0f} rows/s'
+        )
+
+
+if __name__ == '__main__':
+    paths = [Path(arg) for arg in sys.argv[1:]] or sorted(
+        Path.cwd().joinpath('data').glob('*.csv')
+    )
+    _benchmark(paths)
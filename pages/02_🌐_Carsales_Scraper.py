@@ -1,139 +1,156 @@
 import datetime
-import time
-from pathlib import Path
-from typing import Optional
+import json
+import os
+import subprocess
 
 import pandas as pd
 import streamlit as st
-from attrs import asdict
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.firefox.options import Options
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.wait import WebDriverWait
-
-from car import Car
-import random
-
-
-def do_search(
-    min_year: Optional[int], max_year: Optional[int], make: str, model: str
-) -> Optional[pd.DataFrame]:
-
-    options = Options()
-    options.headless = True
-    driver = webdriver.Firefox(options=options)
-    driver.install_addon(
-        Path.cwd().joinpath(
-            'extensions',
-            'vpnetworks_proxy-2.9.2.xpi',
-        )
-    )
-
-    driver.install_addon(
-        Path.cwd().joinpath(
-            'extensions',
-            'ublock_origin-1.46.0.xpi',
-        )
-    )
 
-    print('Searching Carsales')
-    driver.get(
-        'https://www.carsales.com.au/cars/?q=(And.(C.Make.'
-        + make
-        + '._.Model.'
-        + model
-        + '.)_.Year.range('
-        + str(min_year)
-        + '..'
-        + str(max_year)
-        + ')._.Condition.Used.)&sort=~Price'
-    )
+import tracing
+from driver_pool import PoolStats
+from jobs import Job, JobQueue, start_workers
+from rate_limit import RateStats
+from scraper import SearchQuery
 
-    title = driver.find_elements(By.CLASS_NAME, 'title')
+POLL_SECONDS = 2
+# CARSALES_PROFILE=cprofile or pyinstrument turns profiling on by default
+PROFILE_DEFAULT = os.environ.get('CARSALES_PROFILE', 'off')
 
-    if not title:
 
-        if 'captcha' in driver.page_source:
-            st.error('carsales thinks you are a robot, try a new ip address.')
-        else:
-            st.error('did not load, try again.')
+@st.cache_resource
+def get_workers() -> subprocess.Popen:
+    # started once per server, the workers outlive reruns and refreshes
+    return start_workers()
 
-        driver.save_screenshot('error.png')
-        st.image('error.png')
-        return None
 
-    title = title[0]
+def ensure_workers(queue: JobQueue):
+    process = get_workers()
+    # the supervisor exits straight away if another one holds the lock
+    if process.poll() is not None and queue.workers().empty:
+        get_workers.clear()
+        get_workers()
 
-    driver.save_screenshot('success.png')
-    st.image('success.png')
 
-    num_search_results = title.text.split(' ')[0]
-    num_search_results = num_search_results.replace(',', '').strip()
-    num_search_results = int(num_search_results)
-    if num_search_results > 1000:
-        st.error(
-            f"Found {num_search_results} results, carsales doesn't like over 1000, try splitting the search."
+def show_pool_stats(stats: PoolStats):
+    # the job worker's browsers, they stay warm across its jobs
+    with st.expander('Browser Pool'):
+        st.metric('Hit Rate', f'{stats.hit_rate:.0%}')
+        st.text(
+            f'hits: {stats.hits}\n'
+            f'misses: {stats.misses}\n'
+            f'recycled: {stats.recycled}\n'
+            f'mean startup: {stats.mean_startup_time:.1f}s'
         )
-        return None
 
-    if num_search_results == 0:
-        st.error(f'found no results, try again.')
-        return None
 
-    st.info(f'Found {num_search_results} results, scraping details...')
+def show_rate(rate: RateStats):
+    st.caption(
+        f'{rate.pages} pages in {rate.elapsed:.0f}s '
+        f'({rate.pages_per_second:.2f} pages/s), '
+        f'block rate {rate.block_rate:.0%}, {rate.retries} retries'
+    )
 
-    current_page = 0
-    car_list = []
 
-    progress_bar = st.progress(0)
-    while True:
-        print('Loading page', str(current_page))
-        page_listings = driver.find_elements(
-            By.CSS_SELECTOR, 'div.listing-item'
+def show_live(job: Job, queue: JobQueue):
+    # as of the job's last flush, only the latest rows are kept for
+    # display, the rest are in the store
+    rate, pool, recent = queue.live(job.id)
+    if rate is not None:
+        show_rate(rate)
+    if not recent.empty:
+        st.dataframe(recent)
+    if pool is not None:
+        show_pool_stats(pool)
+
+
+def show_trace(tracer: tracing.Tracer, profile: tracing.Profile):
+    with st.expander('Timings for last run'):
+        summary = tracer.summary()
+        st.dataframe(summary, hide_index=True)
+        if tracer.counts:
+            st.text(
+                '\n'.join(
+                    f'{name}: {total}'
+                    for name, total in sorted(tracer.counts.items())
+                )
+            )
+
+        left, right = st.columns(2)
+        left.download_button(
+            'Spans as JSON',
+            json.dumps(tracer.to_json(), indent=2),
+            file_name='trace.json',
+            mime='application/json',
         )
-        new_list = [Car.from_card_webelement(card) for card in page_listings]
-        car_list.extend(new_list)
-        titles = [car.title for car in new_list]
-        titles.reverse()
-        with st.expander(f'Page {current_page+1}'):
-            st.text('\n'.join(titles))
-
-        progress_bar.progress(min(1.0, len(car_list) / num_search_results))
-        sleep_time = random.randrange(0, 2)
-        time.sleep(sleep_time)   # to avoid being blocked as a bot
-        driver.execute_script(
-            'window.scrollTo(0, document.body.scrollHeight);'
+        right.download_button(
+            'OpenTelemetry (OTLP/JSON)',
+            json.dumps(tracer.to_otlp()),
+            file_name='trace.otlp.json',
+            mime='application/json',
         )
-        if len(car_list) < num_search_results:
-            pagination_div = driver.find_elements(
-                By.CSS_SELECTOR, 'ul.pagination'
-            )
-            if pagination_div:
-                next_page_elem = pagination_div[0].find_elements(
-                    By.PARTIAL_LINK_TEXT, 'Next'
-                )
-            else:
-                st.warning('could not find next page, stopping.')
-                driver.save_screenshot('error2.png')
-                st.image('error2.png')
-                break
-            if next_page_elem:
-                next_page_link = next_page_elem[0].get_attribute('href')
-                driver.get(next_page_link)
-            else:
-                st.warning('could not find next page, stopping.')
-                break
-        else:
-            break
+        if profile.report:
+            st.caption(f'{profile.kind} profile')
+            st.code(profile.report, language=None)
 
-        current_page += 1
 
-    driver.close()
-    dict_list = [asdict(car) for car in car_list]
-    df = pd.DataFrame.from_records(dict_list)
+def show_job(job: Job, queue: JobQueue):
+    st.write(
+        f'**{job.make} {job.model} {job.min_year}–{job.max_year}**, '
+        f'job {job.id} {job.status}'
+    )
+    st.progress(job.progress)
+    left, right = st.columns((5, 1))
+    left.text(
+        f'{job.listings} listings from {job.pages} pages, '
+        f'{job.written} written, {job.pending} searches remaining'
+        + (f', resumed {job.resumed}' if job.resumed else '')
+    )
+    if job.status != 'cancelling' and right.button(
+        'Cancel', key=f'cancel_{job.id}'
+    ):
+        queue.cancel(job.id)
+    show_live(job, queue)
+
+
+def jobs_table(jobs: list[Job]) -> pd.DataFrame:
+    return pd.DataFrame(
+        [
+            {
+                'job': job.id,
+                'search': job.query.name,
+                'status': job.status,
+                'pages': job.pages,
+                'listings': job.listings,
+                'written': job.written,
+                'submitted': job.submitted_at,
+                'finished': job.finished_at,
+                'message': job.message,
+            }
+            for job in jobs
+        ]
+    )
 
-    return df
+
+def show_jobs(polling: bool):
+    # a cheap read of the jobs table, re-run on its own while jobs are
+    # active so the rest of the page isn't
+    queue = JobQueue()
+    try:
+        jobs = queue.jobs()
+        num_workers = len(queue.workers())
+        active = [job for job in jobs if job.is_active]
+        for job in active:
+            show_job(job, queue)
+    finally:
+        queue.close()
+
+    st.caption(f'{num_workers} job workers running')
+    finished = [job for job in jobs if not job.is_active]
+    if finished:
+        st.dataframe(jobs_table(finished), hide_index=True)
+    if polling and not active:
+        # the last job finished, stop polling and show its results
+        st.rerun()
 
 
 def main():
@@ -148,28 +165,58 @@ def main():
         year_range = range(next_year, 1990, -1)
         min_year = st.selectbox('Min Year', year_range, index=4)
         max_year = st.selectbox('Max Year', year_range, index=0)
+        max_workers = st.slider('Workers', 1, 16, value=4)
+        # 0 parses in a thread of the job's worker process
+        parse_workers = st.slider('Parse Processes', 0, os.cpu_count() or 1)
+        backend = st.selectbox('Fetch With', ['http', 'selenium'])
+        incremental = st.checkbox('Only new and changed listings', False)
+        profilers = ['off', *tracing.PROFILERS]
+        profiler = st.selectbox(
+            'Profile',
+            profilers,
+            index=profilers.index(PROFILE_DEFAULT)
+            if PROFILE_DEFAULT in profilers
+            else 0,
+        )
 
         submit_button = st.form_submit_button('Do Search')
 
-    if submit_button:
-        df = do_search(min_year, max_year, make, model)
-        if df is not None:
-
-            filename = '_'.join(
-                [
-                    make.lower(),
-                    model.lower(),
-                    str(min_year),
-                    str(max_year),
-                ]
-            ).replace(' ', '_')
-
-            path = Path.cwd().joinpath('data', filename).with_suffix('.csv')
-            st.success('Search Complete')
-            st.dataframe(df)
-            if not path.parent.exists():
-                path.parent.mkdir()
-            df.to_csv(path)
+    queue = JobQueue()
+    try:
+        ensure_workers(queue)
+        if submit_button:
+            # runs in a worker process, the page only records the job
+            job, created = queue.submit(
+                SearchQuery(make, model, min_year, max_year),
+                max_workers,
+                backend,
+                incremental,
+                None if profiler == 'off' else profiler,
+                parse_workers,
+            )
+            if created:
+                st.success(f'Queued job {job.id}')
+            else:
+                st.info(f'Already {job.status} as job {job.id}')
+        jobs = queue.jobs()
+        polling = any(job.is_active for job in jobs)
+        st.fragment(run_every=POLL_SECONDS if polling else None)(
+            show_jobs
+        )(polling)
+
+        # the most recent finished job's results and timings
+        last = next((job for job in jobs if not job.is_active), None)
+        if last is not None:
+            st.write(f'**Last run**: job {last.id}, {last.query.name}')
+            show_live(last, queue)
+            trace, report = queue.trace(last.id)
+            if trace is not None:
+                show_trace(
+                    tracing.Tracer.from_json(trace),
+                    tracing.Profile(last.profiler or '', report or ''),
+                )
+    finally:
+        queue.close()
 
 
 if __name__ == '__main__':
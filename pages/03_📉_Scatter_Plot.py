@@ -1,44 +1,158 @@
-import glob
-from pathlib import Path
-
-import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
 import streamlit as st
-from streamlit_extras.dataframe_explorer import dataframe_explorer
-from sklearn.linear_model import LinearRegression
 import datetime
 import altair as alt
 
+from chart_data import bin_points, stratified_sample, trendlines
+from dataset_cache import DatasetCache
+from facets import Facet, color_columns, compute_facets, mask
+from listing_index import ListingIndex
+from store import migrate_csvs
+
+COLUMNS = [
+    'link',
+    'title',
+    'year',
+    'marketing_year',
+    'drive_away_price',
+    'ex_gov_price',
+    'kms',
+    'id',
+    'make',
+    'model',
+    'badge',
+    'state',
+    'body_style',
+    'transmission',
+    'engine',
+    'seller_type',
+]
+
+
+def format_func(make_model: tuple[str, str]):
+    return ' '.join(make_model)
+
+
+def filter_by_facets(df, facets: dict[str, Facet]):
+    # the same controls as dataframe_explorer, built from cached facets
+    # instead of re-scanning every column on each rerun
+    columns = st.multiselect('Filter dataframe on', list(facets))
+    selections = {}
+    for name in columns:
+        facet = facets[name]
+        left, right = st.columns((1, 20))
+        left.write('↳')
+        if facet.kind == 'category':
+            counts = dict(zip(facet.values, facet.counts))
+            selections[name] = right.multiselect(
+                f'Values for {name}',
+                facet.values,
+                default=list(facet.values),
+                format_func=lambda value: f'{value} ({counts[value]})',
+            )
+        elif facet.kind == 'range':
+            if facet.low is None or facet.low == facet.high:
+                right.caption(f'{name} has a single value')
+                continue
+            selections[name] = right.slider(
+                f'Values for {name}',
+                facet.low,
+                facet.high,
+                (facet.low, facet.high),
+            )
+        else:
+            text = right.text_input(f'Substring in {name}')
+            if text:
+                selections[name] = text
+    return df[mask(df, facets, selections)]
 
-def format_func(path: Path):
-    return Path(path).name
+
+@st.cache_resource
+def get_dataset_cache() -> DatasetCache:
+    # survives reruns, so widget changes don't re-read the store
+    return DatasetCache()
 
 
 def main():
     st.set_page_config(page_title='Scatter Plot', layout='wide')
     st.write('# Carsales Analyser')
     st.write('⌘/^ click to open carsales page in new tab')
-    data = Path.cwd().joinpath('data').resolve()
-    files = glob.glob(str(data) + '/*.csv')
-    files_selected = st.sidebar.multiselect(
-        'Choose files', files, default=files, format_func=format_func
+    cache = get_dataset_cache()
+    store = cache.store
+    if store.is_empty():
+        st.info('The listing store is empty.')
+        if st.button('Import data/*.csv'):
+            migrate_csvs(store=store)
+            st.rerun()
+        return
+
+    models = store.models()
+    models_selected = st.sidebar.multiselect(
+        'Choose models', models, default=models, format_func=format_func
+    )
+    next_year = datetime.date.today().year + 1
+    min_year, max_year = st.sidebar.slider(
+        'Years', 1990, next_year, value=(1990, next_year)
     )
-    dataframes = [pd.read_csv(file, index_col=0) for file in files_selected]
-    df = (
-        pd.concat(dataframes, axis=0)
-        .drop_duplicates(subset=['id'])
-        .reset_index(drop=True)
+    df, facets = cache.load_faceted(
+        COLUMNS,
+        makes=list({make for make, _ in models_selected}),
+        models=list({model for _, model in models_selected}),
+        min_year=min_year,
+        max_year=max_year,
     )
-    df['model'] = df['model'].astype(str)
-    df['age'] = datetime.date.today().year - df['year']
-    df = dataframe_explorer(df)
+    stats = cache.stats
+    st.sidebar.caption(
+        f'loaded in {stats.last_load_seconds * 1000:.0f}ms '
+        f'({"cached" if stats.last_was_hit else "read"}), '
+        f'{stats.hits} hits / {stats.misses} misses, '
+        f'{stats.files_read} files read, {stats.files_reused} reused'
+    )
+
+    flag_under = st.sidebar.checkbox('Flag listings under fitted curve')
+    if flag_under:
+        # scipy is only needed once someone asks for the fitted curves
+        from depreciation import models_for, price_vs_curve
+
+        margin = st.sidebar.slider('Under curve by at least (%)', 0, 50, 10)
+        df = df.join(price_vs_curve(df, models_for(store)))
+        df['under_curve'] = df['price_vs_curve'] < -margin / 100
+
+    if st.sidebar.checkbox('Only listings with a recent price drop'):
+        min_drop = st.sidebar.slider('Dropped by at least (%)', 1, 50, 5)
+        days = st.sidebar.number_input('In the last (days)', 1, 365, 7)
+        index = ListingIndex()
+        try:
+            if index.is_empty() and st.sidebar.button(
+                'Build price history from the store'
+            ):
+                index.rebuild(store)
+            # an indexed query on the price history, not a scan
+            drops = index.price_drops(
+                min_drop / 100,
+                since=datetime.datetime.now() - datetime.timedelta(days),
+                makes=list({make for make, _ in models_selected}),
+                models=list({model for _, model in models_selected}),
+                min_year=min_year,
+                max_year=max_year,
+            )
+        finally:
+            index.close()
+        df = df.merge(
+            drops[['id', 'previous_price', 'price_change']], on='id'
+        )
+
+    # only the columns added above need new facets
+    facets = facets | compute_facets(df[df.columns.difference(list(facets))])
+    df = filter_by_facets(df, facets)
 
     y_col = st.sidebar.selectbox(
         'Y Value', ['ex_gov_price', 'drive_away_price', 'age', 'kms'], index=0
     )
     y_col = y_col if y_col is not None else 'ex_gov_price'
-    color_by = st.sidebar.selectbox('Color By', df.columns, index=12)
+    colors = color_columns(facets)
+    color_by = st.sidebar.selectbox(
+        'Color By', colors, index=colors.index('model')
+    )
     x_cols = st.sidebar.selectbox(
         'X Value', [['kms', 'age'], ['kms'], ['age']], index=0
     )
@@ -69,6 +183,17 @@ def main():
         'Trendline Scope', ['overall', 'trace']
     )
     only_trends = st.sidebar.checkbox('Only Show Trendlines', value=False)
+
+    st.sidebar.markdown("""---""")
+    render_mode = st.sidebar.selectbox(
+        'Render Points', ['auto', 'all', 'sample', 'bins']
+    )
+    max_points = st.sidebar.number_input(
+        'Max Points', min_value=100, value=5000, step=500
+    )
+    if render_mode == 'auto':
+        render_mode = 'sample' if len(df) > max_points else 'all'
+
     tooltip = [
         'make',
         'model',
@@ -81,63 +206,86 @@ def main():
         'id',
         'engine',
     ]
+    if flag_under:
+        tooltip += ['expected_price', 'price_vs_curve', 'under_curve']
     brush = alt.selection_interval()  # selection of type "interval"
     width = 800 / len(x_cols)
-    base_chart = (
-        alt.Chart(df)
-        .mark_point()
-        .encode(
-            # x=x_col + ':Q',
-            y=y_col + ':Q',
-            color=color_by,
-            tooltip=tooltip,
-            href='link:N',
-            # size=size_by,
+
+    # only a bounded number of rows is serialized for the browser, trends
+    # are fitted here on every row
+    if render_mode == 'bins':
+        points_charts = [
+            alt.Chart(bin_points(df, col, y_col, color_by))
+            .mark_circle()
+            .encode(
+                x=alt.X(col + ':Q', scale=alt.Scale(zero=False)),
+                y=y_col + ':Q',
+                color=alt.condition(brush, color_by, alt.value('lightgray')),
+                size='count:Q',
+                tooltip=list(dict.fromkeys([color_by, col, y_col, 'count'])),
+            )
+            .add_selection(brush)
+            .properties(width=width, height=400)
+            for col in x_cols
+        ]
+    else:
+        plot_df = df
+        if render_mode == 'sample':
+            plot_df = stratified_sample(df, max_points, color_by)
+            st.caption(f'showing {len(plot_df)} of {len(df)} listings')
+
+        chart_columns = list(
+            dict.fromkeys(
+                tooltip + ['link', y_col, color_by, *x_cols, *size_by]
+            )
         )
-        .properties(width=width, height=400)
-    )
+        base_chart = (
+            alt.Chart(plot_df[chart_columns])
+            .mark_point()
+            .encode(
+                y=y_col + ':Q',
+                color=alt.condition(brush, color_by, alt.value('lightgray')),
+                tooltip=tooltip,
+                href='link:N',
+            )
+            .properties(width=width, height=400)
+        )
+        points_charts = [
+            base_chart.encode(
+                x=alt.X(col + ':Q', scale=alt.Scale(zero=False))
+            ).add_selection(brush)
+            for col in x_cols
+        ]
+        if use_size:
+            points_charts = [
+                chart.encode(
+                    size=size,
+                )
+                for chart, size in zip(points_charts, size_by)
+            ]
 
-    points_charts = list(
-        base_chart.encode(x=alt.X(col + ':Q', scale=alt.Scale(zero=False)))
-        for col in x_cols
-    )
     trend_charts = None
     if trendline_type:
-        groupby = [color_by] if trendline_scope == 'trace' else []
-
-        if trendline_type == 'loess':
-            trend_charts = list(
-                chart.transform_loess(
-                    col,
-                    y_col,
-                    groupby=groupby,
-                ).mark_line()
-                for col, chart in zip(x_cols, points_charts)
+        groupby = color_by if trendline_scope == 'trace' else None
+        trend_charts = [
+            alt.Chart(
+                trendlines(
+                    df, col, y_col, trendline_type, trendline_order, groupby
+                )
             )
-        else:
-            trend_charts = list(
-                chart.transform_regression(
-                    col,
-                    y_col,
-                    method=trendline_type,
-                    groupby=groupby,
-                    order=trendline_order,
-                ).mark_line()
-                for col, chart in zip(x_cols, points_charts)
+            .mark_line()
+            .encode(
+                x=alt.X(col + ':Q', scale=alt.Scale(zero=False)),
+                y=y_col + ':Q',
+                # trendlines ignores a group on an axis column
+                **(
+                    {'color': color_by}
+                    if groupby not in (None, col, y_col)
+                    else {}
+                ),
             )
-
-    points_charts = [
-        chart.encode(
-            color=alt.condition(brush, color_by, alt.value('lightgray')),
-        ).add_selection(brush)
-        for chart in points_charts
-    ]
-    if use_size:
-        points_charts = [
-            chart.encode(
-                size=size,
-            )
-            for chart, size in zip(points_charts, size_by)
+            .properties(width=width, height=400)
+            for col in x_cols
         ]
 
     if trend_charts and only_trends:
@@ -156,6 +304,12 @@ def main():
     )
     # st.altair_chart(trend_chart, use_container_width=True)
 
+    if flag_under:
+        with st.expander(f'{df["under_curve"].sum()} listings under curve'):
+            st.write(
+                df[df['under_curve']].sort_values('price_vs_curve')
+            )
+
     with st.expander('Show Dataframe'):
         st.write(df)
 
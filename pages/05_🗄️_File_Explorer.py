@@ -0,0 +1,191 @@
+import csv
+import itertools
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+import streamlit as st
+
+from store import FileSummary, ListingStore, read_rows
+
+DATA = Path.cwd().joinpath('data')
+PAGE_SIZES = [50, 100, 500, 1000]
+
+
+def format_size(size: float) -> str:
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024 or unit == 'GB':
+            break
+        size /= 1024
+    return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+
+
+def search_key(summary: FileSummary) -> tuple[str, str]:
+    return summary.partition.get('make', ''), summary.partition.get(
+        'model', ''
+    )
+
+
+def searches_table(summaries: list[FileSummary]) -> pd.DataFrame:
+    # one row per stored make/model, added up from the file footers
+    rows = []
+    for (make, model), group in itertools.groupby(summaries, search_key):
+        group = list(group)
+        years = sorted({s.partition.get('year', '') for s in group})
+        firsts = [s.first_scraped for s in group if s.first_scraped]
+        lasts = [s.last_scraped for s in group if s.last_scraped]
+        rows.append(
+            {
+                'make': make,
+                'model': model,
+                'years': f'{years[0]}–{years[-1]}',
+                'files': len(group),
+                'rows': sum(s.num_rows for s in group),
+                'size': format_size(sum(s.size for s in group)),
+                'first scraped': min(firsts, default=None),
+                'last scraped': max(lasts, default=None),
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def files_table(summaries: list[FileSummary]) -> pd.DataFrame:
+    return pd.DataFrame(
+        [
+            {
+                **s.partition,
+                'file': s.path.name,
+                'rows': s.num_rows,
+                'row groups': s.num_row_groups,
+                'size': format_size(s.size),
+                'first scraped': s.first_scraped,
+                'last scraped': s.last_scraped,
+            }
+            for s in summaries
+        ]
+    )
+
+
+def csv_header(path: Path) -> list[str]:
+    # the first line only, a row count would mean reading the whole file
+    with path.open(newline='') as file:
+        return next(csv.reader(file), [])
+
+
+def read_csv_rows(path: Path, offset: int, limit: int) -> pd.DataFrame:
+    # streamed past the rows before the window, never held in memory
+    return pd.read_csv(
+        path,
+        index_col=0,
+        skiprows=range(1, offset + 1),
+        nrows=limit,
+    )
+
+
+def pager(key: str, total: Optional[int]) -> tuple[int, int]:
+    left, right = st.columns(2)
+    page_size = left.selectbox(
+        'Rows per page', PAGE_SIZES, index=1, key=f'{key}_page_size'
+    )
+    num_pages = None if total is None else max(-(-total // page_size), 1)
+    page = right.number_input(
+        'Page' if num_pages is None else f'Page (of {num_pages})',
+        min_value=1,
+        max_value=num_pages,
+        value=1,
+        key=f'{key}_page',
+    )
+    return (page - 1) * page_size, page_size
+
+
+def show_store(store: ListingStore):
+    summaries = store.summaries()
+    st.write('## Stored searches')
+    st.dataframe(searches_table(summaries), hide_index=True)
+    st.caption(
+        f'{len(summaries)} files, '
+        f'{sum(s.num_rows for s in summaries)} rows, '
+        f'{format_size(sum(s.size for s in summaries))}'
+    )
+    with st.expander('Files'):
+        st.dataframe(files_table(summaries), hide_index=True)
+
+    st.write('## Browse')
+    left, middle, right = st.columns(3)
+    searches = list(dict.fromkeys(map(search_key, summaries)))
+    search = left.selectbox('Search', searches, format_func=' '.join)
+    summaries = [s for s in summaries if search_key(s) == search]
+    years = sorted({s.partition.get('year', '') for s in summaries})
+    year = middle.selectbox('Year', ['All', *years])
+    if year != 'All':
+        summaries = [s for s in summaries if s.partition['year'] == year]
+    summary = right.selectbox(
+        'File',
+        [None, *summaries],
+        format_func=lambda s: 'All' if s is None else s.path.name,
+    )
+    if summary is not None:
+        summaries = [summary]
+
+    total = sum(s.num_rows for s in summaries)
+    offset, limit = pager('store', total)
+    table = read_rows([s.path for s in summaries], offset, limit, store.path)
+    st.dataframe(table.to_pandas(), hide_index=True)
+    st.caption(f'rows {offset + 1}–{offset + table.num_rows} of {total}')
+
+    with st.expander('Schema'):
+        schema = summaries[0].schema
+        st.dataframe(
+            pd.DataFrame(
+                {
+                    'column': schema.names,
+                    'type': [str(field.type) for field in schema],
+                }
+            ),
+            hide_index=True,
+        )
+
+
+def show_csvs(paths: list[Path]):
+    st.write('## CSV files')
+    st.caption('Searches saved before the listing store, not yet imported.')
+    st.dataframe(
+        pd.DataFrame(
+            [
+                {
+                    'file': path.name,
+                    'size': format_size(path.stat().st_size),
+                    'columns': len(csv_header(path)),
+                }
+                for path in paths
+            ]
+        ),
+        hide_index=True,
+    )
+    path = st.selectbox('CSV file', paths, format_func=lambda p: p.name)
+    offset, limit = pager('csv', None)
+    df = read_csv_rows(path, offset, limit)
+    st.dataframe(df)
+    if df.empty:
+        st.caption('past the end of the file')
+    else:
+        st.caption(f'rows {offset + 1}–{offset + len(df)}')
+
+
+def main():
+    st.set_page_config(page_title='File Explorer', layout='wide')
+    st.write('# File Explorer')
+    store = ListingStore()
+    csvs = sorted(DATA.glob('*.csv'))
+    if store.is_empty() and not csvs:
+        st.info('Nothing has been scraped yet.')
+        return
+
+    if not store.is_empty():
+        show_store(store)
+    if csvs:
+        show_csvs(csvs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+import asyncio
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from attrs import define, frozen
+
+import tracing
+from car import BASE_URL, parse_results
+from store import CarBatch
+
+
+@frozen
+class ParsedPage:
+    batch: CarBatch
+    num_results: Optional[int]
+    next_link: Optional[str]
+    cpu_seconds: float
+
+
+def parse_page(html: str, url: str = BASE_URL) -> ParsedPage:
+    # runs in a worker process, the only place the page is parsed. the
+    # cards go back as a CarBatch, typed column buffers pickle as a few
+    # byte strings instead of one object graph per car, with the result
+    # count, next link and the cpu time it took
+    start = time.process_time()
+    cars, num_results, next_link = parse_results(html, url)
+    return ParsedPage(
+        CarBatch.from_cars(cars),
+        num_results,
+        next_link,
+        time.process_time() - start,
+    )
+
+
+def _quiet():
+    # the per-listing prints, when only the timings matter
+    sys.stdout = open(os.devnull, 'w')
+
+
+@define
+class ParseStats:
+    workers: int
+    pages: int = 0
+    listings: int = 0
+    cpu_seconds: float = 0.0   # parsing inside the workers
+    wait_seconds: float = 0.0   # including the queue and the round trip
+    started: Optional[float] = None
+    finished: Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.perf_counter()) - self.started
+
+    @property
+    def listings_per_second(self) -> float:
+        return self.listings / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def pages_per_core_second(self) -> float:
+        return self.pages / self.cpu_seconds if self.cpu_seconds else 0.0
+
+    @property
+    def listings_per_core_second(self) -> float:
+        return self.listings / self.cpu_seconds if self.cpu_seconds else 0.0
+
+    @property
+    def utilization(self) -> float:
+        # share of the pool's cores that were busy parsing
+        if not self.elapsed:
+            return 0.0
+        return self.cpu_seconds / (self.elapsed * self.workers)
+
+    def cores_for(self, pages_per_second: float) -> float:
+        # processes needed to keep up with fetching at this rate
+        if not self.pages_per_core_second:
+            return 0.0
+        return pages_per_second / self.pages_per_core_second
+
+
+class ParsePool:
+    # parses result pages in worker processes, so parsing runs on every
+    # core instead of sharing the GIL with the event loop and fetchers
+    def __init__(
+        self, max_workers: Optional[int] = None, quiet: bool = False
+    ):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._executor = ProcessPoolExecutor(
+            self.max_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_quiet if quiet else None,
+        )
+        self.stats = ParseStats(self.max_workers)
+
+    def warm(self):
+        # start the workers and import the parser before the first page
+        futures = [
+            self._executor.submit(parse_page, '')
+            for _ in range(self.max_workers)
+        ]
+        for future in futures:
+            future.result()
+
+    async def parse(self, html: str, url: str = BASE_URL) -> ParsedPage:
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        if self.stats.started is None:
+            self.stats.started = start
+        parsed = await loop.run_in_executor(
+            self._executor, parse_page, html, url
+        )
+        stats = self.stats
+        stats.finished = time.perf_counter()
+        stats.pages += 1
+        stats.listings += len(parsed.batch)
+        stats.cpu_seconds += parsed.cpu_seconds
+        stats.wait_seconds += stats.finished - start
+        tracing.count('parse.cpu_us', round(parsed.cpu_seconds * 1e6))
+        return parsed
+
+    def close(self):
+        self._executor.shutdown(cancel_futures=True)
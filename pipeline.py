@@ -0,0 +1,327 @@
+import asyncio
+import json
+import os
+from pathlib import Path
+from typing import Callable, Optional
+
+import pandas as pd
+import pyarrow as pa
+from attrs import asdict, define, field
+
+import tracing
+from driver_pool import DriverPool
+from fetch import Fetcher, make_fetcher
+from listing_index import ListingIndex
+from parse_pool import ParsePool, ParseStats
+from rate_limit import RateLimiter, RateStats, ThrottledFetcher
+from scraper import (
+    MAX_RESULTS,
+    ScrapeError,
+    SearchQuery,
+    count_results,
+    iter_pages,
+)
+from store import ListingStore
+
+CHECKPOINTS = Path.cwd().joinpath('data', 'checkpoints')
+QUEUE_SIZE = 32   # parsed pages waiting to be written
+
+
+class Checkpoint:
+    # every shard of a search, whether it's finished and the next page of
+    # the ones in progress. saved after each flush to the store, so an
+    # interrupted search resumes from its last page on disk
+    def __init__(self, query: SearchQuery, directory: Path = CHECKPOINTS):
+        directory.mkdir(parents=True, exist_ok=True)
+        self.path = directory.joinpath(f'{query.name}.json')
+        self.shards: dict[str, dict] = {}
+        if self.path.exists():
+            self.shards = json.loads(self.path.read_text())['shards']
+        if not self.pending():
+            # nothing left from a previous run, start over
+            self.shards = {}
+            self.add(query)
+        self.resumed = sum(
+            state['next'] is not None for state in self.shards.values()
+        )
+
+    def add(self, shard: SearchQuery):
+        self.shards.setdefault(
+            shard.name,
+            {
+                'query': asdict(shard),
+                'done': False,
+                'results': None,
+                'page': None,
+                'seen': 0,
+                'next': None,
+            },
+        )
+
+    def pending(self) -> list[tuple[SearchQuery, dict]]:
+        return [
+            (SearchQuery(**state['query']), state)
+            for state in self.shards.values()
+            if not state['done']
+        ]
+
+    def advance(
+        self,
+        shard: SearchQuery,
+        num_results: int,
+        page_number: int,
+        num_seen: int,
+        next_page: Optional[str],
+    ):
+        state = self.shards[shard.name]
+        state.update(
+            results=num_results,
+            page=page_number,
+            seen=num_seen,
+            next=next_page,
+            done=next_page is None,
+        )
+
+    def finish(self, shard: SearchQuery):
+        self.shards[shard.name]['done'] = True
+
+    def save(self):
+        # written then renamed so a crash never leaves half a file
+        temp = self.path.with_suffix('.tmp')
+        temp.write_text(json.dumps({'shards': self.shards}))
+        os.replace(temp, self.path)
+
+    def remove(self):
+        self.path.unlink(missing_ok=True)
+
+
+@define
+class StreamStats:
+    pages: int = 0
+    listings: int = 0
+    written: int = 0
+    flushes: int = 0
+    shards: int = 0
+    pending: int = 0
+    resumed: int = 0
+    errors: list[ScrapeError] = field(factory=list)
+    rate: Optional[RateStats] = None
+    parse: Optional[ParseStats] = None
+
+
+async def stream_search(
+    fetcher: Fetcher,
+    query: SearchQuery,
+    store: ListingStore,
+    checkpoint: Checkpoint,
+    max_workers: int = 4,
+    on_flush: Optional[Callable[[pd.DataFrame, StreamStats], None]] = None,
+    index: Optional[ListingIndex] = None,
+    incremental: bool = False,
+    parser: Optional[ParsePool] = None,
+) -> StreamStats:
+    # fetch -> parse -> store as a pipeline: shard workers fetch and parse
+    # pages into a bounded queue, so they wait when writing falls behind,
+    # and a single writer appends whatever has queued up to the store
+    # before marking those pages done in the checkpoint. every page is
+    # recorded in the index when there is one, incremental searches also
+    # stop at known pages and only store new and changed listings
+    if incremental and index is None:
+        raise ValueError('incremental searches need a listing index')
+    stats = StreamStats(resumed=checkpoint.resumed)
+    if parser is not None:
+        # a warm pool is reused across searches, its stats are per search
+        parser.stats = ParseStats(parser.max_workers)
+    pages: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    slots = asyncio.Semaphore(max_workers)
+    seen: set[str] = set()
+
+    async def scrape_shard(
+        shard: SearchQuery, state: dict
+    ) -> list[SearchQuery]:
+        if state['next'] is not None:
+            page = await fetcher.fetch(state['next'])
+            num_results = state['results']
+            page_number, num_seen = state['page'] + 1, state['seen']
+        else:
+            page = await fetcher.fetch(shard.url)
+            num_results = count_results(page, shard)
+            page_number, num_seen = 0, 0
+            if num_results > MAX_RESULTS:
+                children = shard.split()
+                if children:
+                    return children
+                print(shard.name, 'cannot be split further')
+            if num_results == 0:
+                checkpoint.finish(shard)
+                return []
+
+        async for page_number, cars, next_page in iter_pages(
+            fetcher,
+            page,
+            shard,
+            num_results,
+            index if incremental else None,
+            page_number,
+            num_seen,
+            parser,
+        ):
+            num_seen += len(cars)
+            progress = (num_results, page_number, num_seen, next_page)
+            await pages.put((shard, *progress, cars))
+        return []
+
+    async def scrape(shard: SearchQuery, state: dict) -> list[SearchQuery]:
+        async with slots:
+            with tracing.span('shard', shard=shard.name):
+                return await scrape_shard(shard, state)
+
+    async def write():
+        done = False
+        while not done:
+            items = [await pages.get()]
+            while not pages.empty():
+                items.append(pages.get_nowait())
+            if items[-1] is None:
+                done = True
+                items.pop()
+            if not items:
+                continue
+
+            # the parsed batches go to the index and store as arrow,
+            # without a Car per row
+            tables = []
+            for *_, cars in items:
+                table = cars.to_arrow()
+                new = []
+                for position, listing_id in enumerate(table['id'].to_pylist()):
+                    if listing_id not in seen:
+                        seen.add(listing_id)
+                        new.append(position)
+                tables.append(table.take(new))
+            table = pa.concat_tables(tables)
+
+            if index is not None:
+                with tracing.span('index.record', rows=table.num_rows):
+                    changes = index.record(table)
+            if incremental:
+                # only new and changed listings, as newer snapshots
+                df = changes
+                with tracing.span('store.append', rows=len(df)):
+                    stats.written += await asyncio.to_thread(store.append, df)
+            else:
+                with tracing.span('store.append', rows=table.num_rows):
+                    stats.written += await asyncio.to_thread(
+                        store.append, table
+                    )
+                with tracing.span('table.to_pandas', rows=table.num_rows):
+                    df = table.unify_dictionaries().to_pandas()
+
+            with tracing.span('checkpoint.save', pages=len(items)):
+                for shard, *progress, _ in items:
+                    checkpoint.advance(shard, *progress)
+                checkpoint.save()
+
+            stats.pages += len(items)
+            stats.listings = len(seen)
+            stats.flushes += 1
+            if on_flush is not None:
+                with tracing.span('ui.flush'):
+                    on_flush(df, stats)
+
+    writer = asyncio.create_task(write())
+    pending = {
+        asyncio.create_task(scrape(shard, state)): shard
+        for shard, state in checkpoint.pending()
+    }
+    try:
+        while pending:
+            stats.pending = len(pending)
+            done, _ = await asyncio.wait(
+                [*pending, writer], return_when=asyncio.FIRST_COMPLETED
+            )
+            if writer in done:
+                # a failed write would leave the workers blocked on the queue
+                writer.result()
+            for task in done - {writer}:
+                shard = pending.pop(task)
+                try:
+                    children = task.result()
+                except ScrapeError as error:
+                    # left unfinished so the next run retries it
+                    stats.errors.append(error)
+                    continue
+
+                if children:
+                    checkpoint.finish(shard)
+                    for child in children:
+                        checkpoint.add(child)
+                        state = checkpoint.shards[child.name]
+                        pending[asyncio.create_task(scrape(child, state))] = (
+                            child
+                        )
+                    checkpoint.save()
+                else:
+                    stats.shards += 1
+
+        await pages.put(None)
+        await writer
+    finally:
+        for task in [*pending, writer]:
+            task.cancel()
+
+    stats.pending = 0
+    if parser is not None:
+        stats.parse = parser.stats
+    if not stats.errors:
+        checkpoint.remove()
+    return stats
+
+
+def streaming_search(
+    query: SearchQuery,
+    max_workers: int = 4,
+    on_flush: Optional[Callable[[pd.DataFrame, StreamStats], None]] = None,
+    pool: Optional[DriverPool] = None,
+    backend: str = 'http',
+    limiter: Optional[RateLimiter] = None,
+    index: Optional[ListingIndex] = None,
+    incremental: bool = False,
+    store: Optional[ListingStore] = None,
+    checkpoints: Path = CHECKPOINTS,
+    parse_workers: int = 0,
+    parser: Optional[ParsePool] = None,
+) -> StreamStats:
+    # parse_workers starts a pool of parse processes for this search,
+    # pass a parser instead to keep one warm across searches
+    owns_parser = parser is None and parse_workers > 0
+    if owns_parser:
+        parser = ParsePool(parse_workers)
+
+    async def run() -> StreamStats:
+        fetcher = ThrottledFetcher(
+            make_fetcher(backend, pool, max_connections=max_workers),
+            limiter or RateLimiter(),
+        )
+        try:
+            stats = await stream_search(
+                fetcher,
+                query,
+                store or ListingStore(),
+                Checkpoint(query, checkpoints),
+                max_workers,
+                on_flush,
+                index,
+                incremental,
+                parser,
+            )
+        finally:
+            await fetcher.aclose()
+        stats.rate = fetcher.limiter.stats
+        return stats
+
+    try:
+        return asyncio.run(run())
+    finally:
+        if owns_parser:
+            parser.close()
@@ -0,0 +1,207 @@
+import asyncio
+import random
+import time
+from typing import Callable, Optional
+
+from attrs import define
+
+import tracing
+from car import peek_result_count
+from fetch import Fetcher, Page, ScrapeError
+
+
+@define
+class RateStats:
+    requests: int = 0
+    pages: int = 0
+    blocked: int = 0
+    empty: int = 0
+    slow: int = 0
+    errors: int = 0
+    retries: int = 0
+    started: Optional[float] = None
+    finished: Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def pages_per_second(self) -> float:
+        return self.pages / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def block_rate(self) -> float:
+        return self.blocked / self.requests if self.requests else 0.0
+
+
+class RateLimiter:
+    # token bucket shared by every worker, the refill rate follows AIMD:
+    # it creeps up while pages succeed and halves on a block, with an
+    # exponential pause before anyone is allowed to try again
+    def __init__(
+        self,
+        rate: float = 1.0,
+        min_rate: float = 0.1,
+        max_rate: float = 8.0,
+        increase: float = 0.1,
+        decrease: float = 0.5,
+        burst: float = 2.0,
+        base_backoff: float = 2.0,
+        max_backoff: float = 120.0,
+    ):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.burst = burst
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.stats = RateStats()
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._failures = 0
+        self._lock = asyncio.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def share(self, num_shares: int) -> 'RateLimiter':
+        # one of num_shares limiters in separate processes, together they
+        # stay within this one's rates
+        return RateLimiter(
+            self.rate / num_shares,
+            self.min_rate / num_shares,
+            self.max_rate / num_shares,
+            self.increase / num_shares,
+            self.decrease,
+            self.burst,
+            self.base_backoff,
+            self.max_backoff,
+        )
+
+    def _loop_lock(self) -> asyncio.Lock:
+        # a lock belongs to one event loop, and a limiter kept between
+        # searches sees a new loop for each asyncio.run
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._lock, self._loop = asyncio.Lock(), loop
+        return self._lock
+
+    async def acquire(self):
+        async with self._loop_lock():
+            if self.stats.started is None:
+                self.stats.started = time.monotonic()
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._tokens = min(
+                    self.burst,
+                    self._tokens + (now - self._updated) * self.rate,
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self.stats.requests += 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def success(self):
+        self._failures = 0
+        self.rate = min(self.max_rate, self.rate + self.increase)
+        self.stats.pages += 1
+
+    def failure(self) -> float:
+        self._failures += 1
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        backoff = min(
+            self.max_backoff, self.base_backoff * 2 ** (self._failures - 1)
+        )
+        backoff *= random.uniform(0.5, 1.0)
+        self._paused_until = max(
+            self._paused_until, time.monotonic() + backoff
+        )
+        return backoff
+
+    def finish(self):
+        self.stats.finished = time.monotonic()
+
+
+class ThrottledFetcher:
+    # every fetch waits for the shared limiter, failed pages are retried
+    # in place so the shard resumes where it was instead of aborting. a
+    # page still failing after the last retry raises ScrapeError
+    def __init__(
+        self,
+        fetcher: Fetcher,
+        limiter: Optional[RateLimiter] = None,
+        max_retries: int = 5,
+        slow: float = 15.0,
+        is_usable: Optional[Callable[[Page], bool]] = None,
+    ):
+        self.fetcher = fetcher
+        self.limiter = limiter or RateLimiter()
+        self.max_retries = max_retries
+        self.slow = slow
+        # checks a page other than a search page, like a listing's details
+        self.is_usable = is_usable
+
+    def _problem(self, page: Page) -> Optional[str]:
+        if page.is_blocked:
+            return 'blocked'
+        if self.is_usable is not None:
+            if not self.is_usable(page):
+                return 'errors' if page.status != 200 else 'empty'
+        elif page.status != 200:
+            return 'errors'
+        else:
+            # checked on every fetch, so without parsing the page
+            num_search_results = peek_result_count(page.html)
+            if num_search_results is None:
+                return 'empty'
+            if num_search_results > 0 and 'listing-item' not in page.html:
+                return 'empty'
+        if page.elapsed > self.slow:
+            return 'slow'
+        return None
+
+    async def fetch(self, url: str) -> Page:
+        stats = self.limiter.stats
+        for attempt in range(self.max_retries + 1):
+            with tracing.span('limiter.wait'):
+                await self.limiter.acquire()
+            with tracing.span('fetch', url=url, attempt=attempt) as span:
+                page = await self.fetcher.fetch(url)
+            problem = self._problem(page)
+            if span is not None:
+                span.attributes['problem'] = problem or 'ok'
+            if problem is None:
+                self.limiter.success()
+                return page
+
+            setattr(stats, problem, getattr(stats, problem) + 1)
+            backoff = self.limiter.failure()
+            if problem == 'slow':
+                # slow pages are still usable, just ease off
+                stats.pages += 1
+                return page
+            if attempt < self.max_retries:
+                stats.retries += 1
+                print(f'{problem} on {url}, retrying in {backoff:.1f}s')
+
+        if problem == 'blocked':
+            raise ScrapeError(
+                'carsales thinks you are a robot, try a new ip address.'
+            )
+        raise ScrapeError(
+            f'{url} was {problem} after {self.max_retries} retries'
+        )
+
+    async def aclose(self):
+        self.limiter.finish()
+        await self.fetcher.aclose()
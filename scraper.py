@@ -0,0 +1,278 @@
+import asyncio
+from typing import AsyncIterator, Callable, Optional, Self
+
+import pandas as pd
+from attrs import define, evolve, field, frozen
+
+import tracing
+from car import Car, peek_result_count
+from driver_pool import DriverPool
+from fetch import Fetcher, Page, ScrapeError, make_fetcher
+from listing_index import ListingIndex
+from parse_pool import ParsePool, parse_page
+from rate_limit import RateLimiter, RateStats, ThrottledFetcher
+from store import CarBatch
+
+SEARCH_URL = 'https://www.carsales.com.au/cars/?q={query}&sort=~Price'
+MAX_RESULTS = 1000   # carsales stops paginating past this
+
+
+@frozen
+class SearchQuery:
+    make: str
+    model: str
+    min_year: int
+    max_year: int
+    min_price: Optional[int] = None
+    max_price: Optional[int] = None
+
+    @property
+    def url(self) -> str:
+        if self.model:
+            vehicle = f'(C.Make.{self.make}._.Model.{self.model}.)'
+        else:
+            vehicle = f'(C.Make.{self.make}.)'
+        terms = [f'Year.range({self.min_year}..{self.max_year})']
+        if self.min_price is not None or self.max_price is not None:
+            min_price = self.min_price or 0
+            max_price = '' if self.max_price is None else self.max_price
+            terms.append(f'Price.range({min_price}..{max_price})')
+        terms.append('Condition.Used')
+        query = '(And.' + vehicle + '_.' + '._.'.join(terms) + '.)'
+        return SEARCH_URL.format(query=query)
+
+    @property
+    def name(self) -> str:
+        parts = [self.make, self.model, str(self.min_year), str(self.max_year)]
+        if self.min_price is not None or self.max_price is not None:
+            parts.append(f'{self.min_price or 0}-{self.max_price or ""}')
+        return '_'.join(part for part in parts if part)
+
+    def split(self) -> list[Self]:
+        # disjoint sub-queries, by year first and then by price band
+        if self.min_year < self.max_year:
+            mid = (self.min_year + self.max_year) // 2
+            return [
+                evolve(self, max_year=mid),
+                evolve(self, min_year=mid + 1),
+            ]
+
+        min_price = self.min_price or 0
+        if self.max_price is None:
+            mid = max(2 * min_price, 20000)
+        elif self.max_price - min_price > 1:
+            mid = (min_price + self.max_price) // 2
+        else:
+            return []
+
+        return [
+            evolve(self, min_price=min_price, max_price=mid),
+            evolve(self, min_price=mid + 1),
+        ]
+
+
+@define
+class SearchResult:
+    cars: dict[str, Car] = field(factory=dict)
+    errors: list[ScrapeError] = field(factory=list)
+    shards: list[SearchQuery] = field(factory=list)
+    rate: Optional[RateStats] = None
+    changes: Optional[pd.DataFrame] = None
+
+    def add(self, cars: list[Car]):
+        for car in cars:
+            self.cars.setdefault(car.id, car)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return CarBatch.from_cars(self.cars.values()).to_dataframe()
+
+
+def count_results(page: Page, query: SearchQuery) -> int:
+    num_search_results = peek_result_count(page.html)
+
+    if num_search_results is None:
+        if page.is_blocked:
+            raise ScrapeError(
+                'carsales thinks you are a robot, try a new ip address.'
+            )
+        raise ScrapeError(f'{query.name} did not load, try again.')
+
+    return num_search_results
+
+
+async def iter_pages(
+    fetcher: Fetcher,
+    page: Page,
+    query: SearchQuery,
+    num_search_results: int,
+    index: Optional[ListingIndex] = None,
+    page_number: int = 0,
+    num_seen: int = 0,
+    parser: Optional[ParsePool] = None,
+) -> AsyncIterator[tuple[int, CarBatch, Optional[str]]]:
+    # yields (page number, cars, next page url) as each page is parsed,
+    # the url is None on the last page. page_number and num_seen let a
+    # resumed shard carry on from a later page. with a parser, pages are
+    # parsed in its processes rather than a thread of this one. either
+    # way each page is parsed once, for its cards, count and next link,
+    # and its cards stay a CarBatch on their way to the store
+    limit = min(num_search_results, MAX_RESULTS)
+
+    while True:
+        print('Loading page', str(page_number), 'of', query.name)
+        # parsed off the event loop so other shards keep fetching
+        with tracing.span('parse', page=page_number):
+            if parser is None:
+                parsed = await asyncio.to_thread(
+                    parse_page, page.html, page.url
+                )
+            else:
+                parsed = await parser.parse(page.html, page.url)
+            cars, num_results, next_link = (
+                parsed.batch,
+                parsed.num_results,
+                parsed.next_link,
+            )
+            tracing.count('listings', len(cars))
+        if not cars and num_seen < limit:
+            # a blocked or unrendered page has no cards or next link, it
+            # must not pass for the last page and finish the shard
+            if page.is_blocked:
+                raise ScrapeError(
+                    'carsales thinks you are a robot, try a new ip address.'
+                )
+            if num_results is None or num_results > num_seen:
+                raise ScrapeError(
+                    f'page {page_number} of {query.name} did not load, '
+                    'try again.'
+                )
+        num_seen += len(cars)
+
+        next_page = None
+        if num_seen >= limit:
+            pass
+        elif index is not None and index.all_unchanged(cars.to_arrow()):
+            print('nothing new on page', str(page_number), 'stopping.')
+        else:
+            next_page = next_link
+            if next_page is None:
+                print('could not find next page of', query.name, 'stopping.')
+
+        yield page_number, cars, next_page
+        if next_page is None:
+            return
+
+        page = await fetcher.fetch(next_page)
+        page_number += 1
+
+
+async def scrape_pages(
+    fetcher: Fetcher,
+    page: Page,
+    query: SearchQuery,
+    num_search_results: int,
+    index: Optional[ListingIndex] = None,
+) -> list[Car]:
+    car_list = []
+    async for _, cars, _ in iter_pages(
+        fetcher, page, query, num_search_results, index
+    ):
+        car_list.extend(cars.to_cars())
+    return car_list
+
+
+async def _run_shard(
+    fetcher: Fetcher,
+    query: SearchQuery,
+    index: Optional[ListingIndex] = None,
+) -> tuple[list[SearchQuery], list[Car]]:
+    page = await fetcher.fetch(query.url)
+    num_search_results = count_results(page, query)
+
+    if num_search_results > MAX_RESULTS:
+        children = query.split()
+        if children:
+            return children, []
+        print(query.name, 'cannot be split further, scraping first 1000')
+
+    if num_search_results == 0:
+        return [], []
+
+    cars = await scrape_pages(
+        fetcher, page, query, num_search_results, index
+    )
+    return [], cars
+
+
+async def search(
+    fetcher: Fetcher,
+    query: SearchQuery,
+    max_workers: int = 4,
+    on_progress: Optional[Callable[[SearchResult, int], None]] = None,
+    index: Optional[ListingIndex] = None,
+) -> SearchResult:
+    # oversized queries are split and re-queued until every shard fits
+    # under carsales' result cap, at most max_workers shards are scraped
+    # at once and the results are merged on Car.id
+    result = SearchResult()
+    slots = asyncio.Semaphore(max_workers)
+
+    async def run(shard: SearchQuery):
+        async with slots:
+            return await _run_shard(fetcher, shard, index)
+
+    pending = {asyncio.create_task(run(query)): query}
+    while pending:
+        done, _ = await asyncio.wait(
+            pending, return_when=asyncio.FIRST_COMPLETED
+        )
+        for task in done:
+            shard = pending.pop(task)
+            try:
+                children, cars = task.result()
+            except ScrapeError as error:
+                result.errors.append(error)
+                continue
+
+            for child in children:
+                pending[asyncio.create_task(run(child))] = child
+            if not children:
+                result.shards.append(shard)
+                result.add(cars)
+
+        if on_progress is not None:
+            on_progress(result, len(pending))
+
+    return result
+
+
+def parallel_search(
+    query: SearchQuery,
+    max_workers: int = 4,
+    on_progress: Optional[Callable[[SearchResult, int], None]] = None,
+    pool: Optional[DriverPool] = None,
+    backend: str = 'http',
+    limiter: Optional[RateLimiter] = None,
+    index: Optional[ListingIndex] = None,
+) -> SearchResult:
+    async def run() -> SearchResult:
+        # throttling lives in one limiter shared by every worker, rather
+        # than a fixed sleep per page, so it can adapt to blocks
+        fetcher = ThrottledFetcher(
+            make_fetcher(backend, pool, max_connections=max_workers),
+            limiter or RateLimiter(),
+        )
+        try:
+            result = await search(
+                fetcher, query, max_workers, on_progress, index
+            )
+        finally:
+            await fetcher.aclose()
+        result.rate = fetcher.limiter.stats
+        if index is not None:
+            # pages are walked until they hold only known listings, and
+            # only the new or changed rows are kept for writing
+            result.changes = index.record(result.cars.values())
+        return result
+
+    return asyncio.run(run())
@@ -0,0 +1,538 @@
+import datetime
+import functools
+import operator
+import sys
+import uuid
+from array import array
+from pathlib import Path
+from typing import Iterable, Optional, Union
+from urllib.parse import unquote
+
+import attrs
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from attrs import frozen
+
+from car import CATEGORICALS, Car
+
+STORE_PATH = Path.cwd().joinpath('data', 'listings')
+# small row groups let a reader decode a window of rows without the rest
+ROW_GROUP_ROWS = 16384
+PARTITION_COLUMNS = ['make', 'model', 'year']
+# filled in later from each listing's detail page, see enrich.py
+DETAIL_FIELDS = [
+    pa.field('vin', pa.string()),
+    pa.field('colour', pa.string()),
+    pa.field('rego_expiry', pa.string()),
+    pa.field('service_history', pa.string()),
+]
+# a regular scrape leaves these empty, so the latest snapshot keeps the
+# last value any snapshot of the listing had
+CARRIED_COLUMNS = [
+    'build_date',
+    'odometer',
+    *(field.name for field in DETAIL_FIELDS),
+]
+EXTRA_FIELDS = [
+    pa.field('first_seen', pa.timestamp('s')),
+    pa.field('last_seen', pa.timestamp('s')),
+    pa.field('scraped_at', pa.timestamp('s')),
+]
+
+
+def _arrow_type(name: str, type_) -> pa.DataType:
+    if name in CATEGORICALS:
+        return pa.dictionary(pa.int32(), pa.string())
+    if int in (type_, *getattr(type_, '__args__', ())):
+        return pa.int64()
+    return pa.string()
+
+
+def car_schema() -> pa.Schema:
+    # generated from the attrs fields so the store follows car.Car
+    fields = [
+        pa.field(field.name, _arrow_type(field.name, field.type))
+        for field in attrs.fields(Car)
+    ]
+    return pa.schema(fields + DETAIL_FIELDS + EXTRA_FIELDS)
+
+
+SCHEMA = car_schema()
+# partition values live in directory names, so they are read back as
+# plain strings and dictionary-encoded after the scan
+PARTITION_SCHEMA = pa.schema(
+    [
+        pa.field(name, pa.string())
+        if pa.types.is_dictionary(SCHEMA.field(name).type)
+        else SCHEMA.field(name)
+        for name in PARTITION_COLUMNS
+    ]
+)
+PARTITIONING = ds.partitioning(PARTITION_SCHEMA, flavor='hive')
+DATASET_SCHEMA = pa.schema(
+    [
+        PARTITION_SCHEMA.field(field.name)
+        if field.name in PARTITION_COLUMNS
+        else field
+        for field in SCHEMA
+    ]
+)
+
+
+CAR_FIELDS = [field.name for field in attrs.fields(Car)]
+
+
+class CarBatch:
+    # column buffers filled straight from Car objects: integers in typed
+    # arrays with a null mask, categoricals as dictionary codes, so large
+    # scrapes never build one dict per row
+    def __init__(self):
+        self._get = operator.attrgetter(*CAR_FIELDS)
+        self._kinds = []
+        self._columns = []
+        self._masks = {}
+        self._dictionaries = {}
+        for field in SCHEMA:
+            if field.name not in CAR_FIELDS:
+                continue
+            if pa.types.is_dictionary(field.type):
+                self._kinds.append('category')
+                self._columns.append(array('i'))
+                self._dictionaries[field.name] = {}
+            elif pa.types.is_integer(field.type):
+                self._kinds.append('int')
+                self._columns.append(array('q'))
+                self._masks[field.name] = array('b')
+            else:
+                self._kinds.append('str')
+                self._columns.append([])
+        self._length = 0
+
+    @classmethod
+    def from_cars(cls, cars: Iterable[Car]) -> 'CarBatch':
+        batch = cls()
+        batch.extend(cars)
+        return batch
+
+    def __len__(self) -> int:
+        return self._length
+
+    def append(self, car: Car):
+        for name, kind, column, value in zip(
+            CAR_FIELDS, self._kinds, self._columns, self._get(car)
+        ):
+            if kind == 'category':
+                if value is None:
+                    column.append(-1)
+                else:
+                    codes = self._dictionaries[name]
+                    column.append(codes.setdefault(value, len(codes)))
+            elif kind == 'int':
+                self._masks[name].append(value is None)
+                column.append(0 if value is None else value)
+            else:
+                column.append(value)
+        self._length += 1
+
+    def extend(self, cars: Iterable[Car]):
+        for car in cars:
+            self.append(car)
+
+    def to_arrow(self) -> pa.Table:
+        arrays = []
+        for name, kind, column in zip(CAR_FIELDS, self._kinds, self._columns):
+            if kind == 'category':
+                codes = np.frombuffer(column, dtype=np.int32)
+                arrays.append(
+                    pa.DictionaryArray.from_arrays(
+                        pa.array(codes, mask=codes < 0),
+                        pa.array(list(self._dictionaries[name]), pa.string()),
+                    )
+                )
+            elif kind == 'int':
+                arrays.append(
+                    pa.array(
+                        np.frombuffer(column, dtype=np.int64),
+                        mask=np.frombuffer(self._masks[name], dtype=bool),
+                    )
+                )
+            else:
+                arrays.append(pa.array(column, pa.string()))
+        schema = pa.schema([SCHEMA.field(name) for name in CAR_FIELDS])
+        return pa.Table.from_arrays(arrays, schema=schema)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return self.to_arrow().to_pandas()
+
+    def to_cars(self) -> list[Car]:
+        # back to Car objects column by column, categoricals share the
+        # dictionary's strings
+        columns = []
+        for name, kind, column in zip(CAR_FIELDS, self._kinds, self._columns):
+            if kind == 'category':
+                values = list(self._dictionaries[name])
+                columns.append(
+                    [values[code] if code >= 0 else None for code in column]
+                )
+            elif kind == 'int':
+                columns.append(
+                    [
+                        None if missing else value
+                        for value, missing in zip(column, self._masks[name])
+                    ]
+                )
+            else:
+                columns.append(column)
+        return [Car(*values) for values in zip(*columns)]
+
+
+def _complete(
+    table: pa.Table, scraped_at: Optional[datetime.datetime] = None
+) -> pa.Table:
+    # add the detail and bookkeeping columns a batch of cars doesn't carry
+    for field in DETAIL_FIELDS + EXTRA_FIELDS:
+        if field.name in table.column_names:
+            continue
+        value = None
+        if field.name == 'scraped_at':
+            value = scraped_at or datetime.datetime.now()
+        table = table.append_column(
+            field, pa.array([value] * table.num_rows, field.type)
+        )
+    return table.select(SCHEMA.names).cast(SCHEMA)
+
+
+def to_table(
+    df: pd.DataFrame, scraped_at: Optional[datetime.datetime] = None
+) -> pa.Table:
+    df = df.copy()
+    if 'scraped_at' not in df:
+        df['scraped_at'] = scraped_at or datetime.datetime.now()
+    for field in SCHEMA:
+        if field.name not in df:
+            df[field.name] = None
+        elif pa.types.is_timestamp(field.type):
+            df[field.name] = pd.to_datetime(df[field.name])
+        elif pa.types.is_integer(field.type):
+            df[field.name] = pd.to_numeric(df[field.name]).astype('Int64')
+        else:
+            df[field.name] = df[field.name].astype('string')
+    return pa.Table.from_pandas(
+        df[SCHEMA.names], schema=SCHEMA, preserve_index=False
+    )
+
+
+class ListingStore:
+    # listings partitioned by make/model/year as parquet, append only
+    def __init__(self, path: Path = STORE_PATH):
+        self.path = path
+
+    def is_empty(self) -> bool:
+        return not any(self.path.rglob('*.parquet'))
+
+    def models(self) -> list[tuple[str, str]]:
+        # read from the partition directories, no files are opened
+        return sorted(
+            (
+                unquote(make_dir.name.partition('=')[2]),
+                unquote(model_dir.name.partition('=')[2]),
+            )
+            for make_dir in self.path.glob('make=*')
+            for model_dir in make_dir.glob('model=*')
+        )
+
+    def append(
+        self,
+        listings: Union[pd.DataFrame, pa.Table, CarBatch, Iterable[Car]],
+        scraped_at: Optional[datetime.datetime] = None,
+    ) -> int:
+        if isinstance(listings, pd.DataFrame):
+            table = to_table(listings, scraped_at)
+        else:
+            if not isinstance(listings, (pa.Table, CarBatch)):
+                listings = CarBatch.from_cars(listings)
+            if isinstance(listings, CarBatch):
+                listings = listings.to_arrow()
+            table = _complete(listings, scraped_at)
+        if table.num_rows == 0:
+            return 0
+
+        table = table.cast(DATASET_SCHEMA)
+        ds.write_dataset(
+            table,
+            self.path,
+            format='parquet',
+            partitioning=PARTITIONING,
+            basename_template=f'part-{uuid.uuid4().hex}-{{i}}.parquet',
+            existing_data_behavior='overwrite_or_ignore',
+            max_rows_per_group=ROW_GROUP_ROWS,
+            min_rows_per_group=0,
+        )
+        return table.num_rows
+
+    def files(self) -> list[Path]:
+        return sorted(self.path.rglob('*.parquet'))
+
+    def summaries(self) -> list['FileSummary']:
+        return [file_summary(path, self.path) for path in self.files()]
+
+    def dataset(self, files: Optional[list[Path]] = None) -> ds.Dataset:
+        source = self.path if files is None else [str(f) for f in files]
+        return ds.dataset(
+            source,
+            schema=DATASET_SCHEMA,
+            format='parquet',
+            partitioning=PARTITIONING,
+            partition_base_dir=str(self.path),
+        )
+
+    def load(
+        self,
+        columns: Optional[list[str]] = None,
+        makes: Optional[list[str]] = None,
+        models: Optional[list[str]] = None,
+        min_year: Optional[int] = None,
+        max_year: Optional[int] = None,
+        min_price: Optional[int] = None,
+        max_price: Optional[int] = None,
+        latest: bool = True,
+    ) -> pd.DataFrame:
+        # filters on partition columns prune whole directories. a price
+        # changes between snapshots of a listing, so with latest it only
+        # filters the latest snapshot, otherwise an older price could match
+        if self.is_empty():
+            return pd.DataFrame(columns=columns or SCHEMA.names)
+
+        if latest:
+            scan = filter_expression(makes, models, min_year, max_year)
+            values = filter_expression(
+                min_price=min_price, max_price=max_price
+            )
+        else:
+            scan = filter_expression(
+                makes, models, min_year, max_year, min_price, max_price
+            )
+            values = None
+        table = self.dataset().to_table(
+            columns=read_columns(columns, latest), filter=scan
+        )
+        return to_dataframe(table, columns, latest, values)
+
+
+@frozen(eq=False)
+class FileSummary:
+    path: Path
+    partition: dict[str, str]
+    num_rows: int
+    num_row_groups: int
+    size: int
+    first_scraped: Optional[datetime.datetime]
+    last_scraped: Optional[datetime.datetime]
+    schema: pa.Schema
+
+
+def partition_values(path: Path, base: Path = STORE_PATH) -> dict[str, str]:
+    # make=Volkswagen/model=Golf/year=2012 -> the values in the file's path
+    return {
+        key: unquote(value)
+        for key, _, value in (
+            part.partition('=')
+            for part in path.parent.relative_to(base).parts
+        )
+        if key in PARTITION_COLUMNS
+    }
+
+
+@functools.lru_cache(maxsize=4096)
+def _summary(path: Path, base: Path, size: int, mtime_ns: int) -> FileSummary:
+    # only the footer is read, the date range comes from the scraped_at
+    # statistics of each row group. size and mtime are part of the cache
+    # key so a rewritten file is read again
+    metadata = pq.read_metadata(path)
+    schema = metadata.schema.to_arrow_schema()
+    first = last = None
+    column = schema.get_field_index('scraped_at')
+    for i in range(metadata.num_row_groups if column >= 0 else 0):
+        statistics = metadata.row_group(i).column(column).statistics
+        if statistics is None or not statistics.has_min_max:
+            continue
+        first = min(first or statistics.min, statistics.min)
+        last = max(last or statistics.max, statistics.max)
+    return FileSummary(
+        path,
+        partition_values(path, base),
+        metadata.num_rows,
+        metadata.num_row_groups,
+        size,
+        first,
+        last,
+        schema,
+    )
+
+
+def file_summary(path: Path, base: Path = STORE_PATH) -> FileSummary:
+    stat = path.stat()
+    return _summary(path, base, stat.st_size, stat.st_mtime_ns)
+
+
+def read_rows(
+    paths: list[Path], offset: int, limit: int, base: Path = STORE_PATH
+) -> pa.Table:
+    # rows offset to offset + limit of the files read end to end. files
+    # and row groups before the window are skipped using their footers,
+    # and only the row groups that overlap it are decoded from a memory
+    # map, so the cost follows the window and not the size of the files
+    tables = []
+    for path in paths:
+        if limit <= 0:
+            break
+        summary = file_summary(path, base)
+        if offset >= summary.num_rows:
+            offset -= summary.num_rows
+            continue
+        file = pq.ParquetFile(path, memory_map=True)
+        for i in range(file.metadata.num_row_groups):
+            num_rows = file.metadata.row_group(i).num_rows
+            if offset >= num_rows:
+                offset -= num_rows
+                continue
+            if limit <= 0:
+                break
+            table = file.read_row_group(i).slice(offset, limit)
+            offset = 0
+            limit -= table.num_rows
+            for name, value in summary.partition.items():
+                table = table.append_column(
+                    name, pa.array([value] * table.num_rows, pa.string())
+                )
+            tables.append(table)
+    if not tables:
+        return pa.table({})
+    return pa.concat_tables(tables, promote_options='permissive')
+
+
+def filter_expression(
+    makes: Optional[list[str]] = None,
+    models: Optional[list[str]] = None,
+    min_year: Optional[int] = None,
+    max_year: Optional[int] = None,
+    min_price: Optional[int] = None,
+    max_price: Optional[int] = None,
+) -> Optional[ds.Expression]:
+    conditions = []
+    if makes:
+        conditions.append(ds.field('make').isin(makes))
+    if models:
+        conditions.append(ds.field('model').isin(models))
+    if min_year is not None:
+        conditions.append(ds.field('year') >= min_year)
+    if max_year is not None:
+        conditions.append(ds.field('year') <= max_year)
+    if min_price is not None:
+        conditions.append(ds.field('ex_gov_price') >= min_price)
+    if max_price is not None:
+        conditions.append(ds.field('ex_gov_price') <= max_price)
+
+    expression = None
+    for condition in conditions:
+        expression = (
+            condition if expression is None else expression & condition
+        )
+    return expression
+
+
+def read_columns(
+    columns: Optional[list[str]], latest: bool = True
+) -> Optional[list[str]]:
+    # what picking the latest snapshot and filtering its price needs
+    if columns is None or not latest:
+        return columns
+    return list(dict.fromkeys(columns + ['id', 'scraped_at', 'ex_gov_price']))
+
+
+def latest_snapshots(table: pa.Table) -> pa.Table:
+    # appended rows are newer snapshots of the same listing, the last one
+    # of each id in scraped_at order
+    keys = pd.DataFrame(
+        {
+            'id': table['id'].to_pandas(),
+            'scraped_at': table['scraped_at'].to_pandas(),
+        }
+    )
+    order = keys.sort_values('scraped_at', kind='stable')
+    keep = order.drop_duplicates(subset=['id'], keep='last').index
+    latest = table.take(pa.array(keep, pa.int64()))
+    carried = [
+        name
+        for name in CARRIED_COLUMNS
+        if name in table.column_names and latest[name].null_count
+    ]
+    if not carried or len(keep) == table.num_rows:
+        return latest
+
+    # last skips nulls, so this is each listing's newest known value
+    filled = (
+        table.select(carried)
+        .to_pandas()
+        .reindex(order.index)
+        .groupby(order['id'].to_numpy(), sort=False)
+        .last()
+        .reindex(keys['id'].to_numpy()[keep])
+    )
+    for name in carried:
+        latest = latest.set_column(
+            latest.column_names.index(name),
+            latest.schema.field(name),
+            pa.array(filled[name], latest.schema.field(name).type),
+        )
+    return latest
+
+
+def to_dataframe(
+    table: pa.Table,
+    columns: Optional[list[str]] = None,
+    latest: bool = True,
+    values: Optional[ds.Expression] = None,
+) -> pd.DataFrame:
+    # values filters the latest snapshots rather than every row
+    if latest:
+        table = latest_snapshots(table)
+    if values is not None:
+        table = table.filter(values)
+    for name in PARTITION_COLUMNS:
+        if name in table.column_names and name in CATEGORICALS:
+            table = table.set_column(
+                table.column_names.index(name),
+                SCHEMA.field(name),
+                pc.dictionary_encode(table[name]),
+            )
+    df = table.unify_dictionaries().to_pandas()
+    if latest and columns is not None:
+        df = df[columns]
+    return df
+
+
+def migrate_csvs(
+    data: Path = Path.cwd().joinpath('data'),
+    store: Optional[ListingStore] = None,
+) -> int:
+    # one-shot import of the per-search csv files
+    store = store or ListingStore()
+    num_rows = 0
+    for path in sorted(data.glob('*.csv')):
+        df = pd.read_csv(path, index_col=0)
+        scraped_at = datetime.datetime.fromtimestamp(path.stat().st_mtime)
+        num_rows += store.append(df, scraped_at.replace(microsecond=0))
+        print('Imported', path.name)
+    return num_rows
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['migrate']:
+        print(migrate_csvs(), 'rows imported')
+    else:
+        print('usage: python store.py migrate')
@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from chart_data import bin_points, stratified_sample, trendlines
+
+
+def listings(num_rows: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    kms = rng.uniform(0, 200000, num_rows).round()
+    return pd.DataFrame(
+        {
+            'kms': kms,
+            'age': rng.uniform(0, 10, num_rows).round(1),
+            'ex_gov_price': 40000 - kms / 10 + rng.normal(0, 2000, num_rows),
+            'model': rng.choice(['a', 'b', 'c'], num_rows, p=[.8, .15, .05]),
+        }
+    )
+
+
+@pytest.mark.parametrize('groupby', ['kms', 'ex_gov_price'])
+def test_trendlines_grouped_by_an_axis_column(groupby):
+    df = listings(500)
+    curves = trendlines(df, 'kms', 'ex_gov_price', 'linear', groupby=groupby)
+    assert list(curves.columns) == ['kms', 'ex_gov_price']
+    assert len(curves) == 100
+
+
+def test_trendlines_per_group():
+    curves = trendlines(
+        listings(500), 'kms', 'ex_gov_price', 'linear', groupby='model'
+    )
+    assert set(curves['model']) == {'a', 'b', 'c'}
+
+
+@pytest.mark.parametrize('color_by', ['kms', 'ex_gov_price', 'model'])
+def test_bin_points_colour_by_any_column(color_by):
+    df = listings(2000)
+    binned = bin_points(df, 'kms', 'ex_gov_price', color_by, bins=10)
+    assert binned['count'].sum() == len(df)
+    assert not binned.columns.duplicated().any()
+
+
+@pytest.mark.parametrize('stratify_by', ['model', 'kms', 'age'])
+def test_stratified_sample_stays_under_max_rows(stratify_by):
+    df = listings(10000)
+    sample = stratified_sample(df, 500, stratify_by)
+    assert 450 <= len(sample) <= 500
+
+
+def test_stratified_sample_keeps_small_groups():
+    df = listings(10000)
+    df.loc[df.index[:3], 'model'] = 'rare'
+    sample = stratified_sample(df, 100, 'model')
+    assert 'rare' in set(sample['model'])
+    shares = sample['model'].value_counts(normalize=True)
+    assert shares['a'] == pytest.approx(0.8, abs=0.05)
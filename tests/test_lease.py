@@ -0,0 +1,74 @@
+import random
+from decimal import Decimal
+
+import pandas as pd
+import pytest
+
+from lease import D, Car, NovatedLease, lease_grid
+
+TERMS = range(1, 6)
+
+
+def random_cars(rng: random.Random, num_cars: int) -> list[Car]:
+    return [
+        Car(
+            make='Random',
+            model=str(i),
+            base_price_ex_gst=D(rng.uniform(10000, 150000)),
+            accessories_price_ex_gst=D(rng.uniform(0, 8000)),
+            delivery_charges_ex_gst=D(rng.uniform(0, 4000)),
+            is_electric=rng.random() < 0.5,
+            annual_running_costs=D(0),
+        )
+        for i in range(num_cars)
+    ]
+
+
+def units(value, places: int) -> int:
+    # cents, or 1e-4 for gst, which the scalar path doesn't quantize
+    if isinstance(value, Decimal):
+        return int(value.scaleb(places))
+    return round(value * 10**places)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_lease_grid_matches_scalar_classes(seed):
+    rng = random.Random(seed)
+    cars = random_cars(rng, 40)
+    rates = sorted(
+        {D(rng.uniform(0.01, 0.15), '0.0001') for _ in range(10)}
+    )
+    grid = lease_grid(
+        pd.DataFrame(
+            {
+                'base_price_ex_gst': [car.base_price_ex_gst for car in cars],
+                'accessories_price_ex_gst': [
+                    car.accessories_price_ex_gst for car in cars
+                ],
+                'delivery_charges_ex_gst': [
+                    car.delivery_charges_ex_gst for car in cars
+                ],
+                'is_electric': [car.is_electric for car in cars],
+            }
+        ),
+        [float(rate) for rate in rates],
+        TERMS,
+    )
+    assert len(grid) == len(cars) * len(rates) * len(TERMS)
+
+    mismatches = []
+    for i, car in enumerate(cars):
+        for rate in rates:
+            for term in TERMS:
+                lease = NovatedLease(car, rate, term)
+                row = grid.loc[(i, float(rate), term)]
+                for name in grid.columns:
+                    places = 4 if name == 'gst' else 2
+                    source = car if hasattr(car, name) else lease
+                    expected = units(getattr(source, name), places)
+                    actual = units(row[name], places)
+                    if actual != expected:
+                        mismatches.append(
+                            (i, rate, term, name, expected, actual)
+                        )
+    assert mismatches == []
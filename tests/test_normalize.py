@@ -0,0 +1,21 @@
+import pandas as pd
+
+from normalize import badge, badge_series
+
+
+def test_badge_series_with_a_repeated_index():
+    # frames concatenated from several csvs repeat their row labels
+    df = pd.DataFrame(
+        {
+            'title': ['2014 Volkswagen Golf R', '2015 Toyota Corolla Golf'],
+            'year': [2014, 2015],
+            'make': ['Volkswagen', 'Toyota'],
+            'model': ['Golf', 'Corolla'],
+        },
+        index=[0, 0],
+    )
+    badges = badge_series(df['title'], df['year'], df['make'], df['model'])
+    assert badges.index.tolist() == [0, 0]
+    assert badges.tolist() == [
+        badge(*row) for row in df.itertuples(index=False)
+    ]
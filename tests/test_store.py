@@ -0,0 +1,40 @@
+import datetime
+
+import pandas as pd
+
+from store import SCHEMA, ListingStore
+
+NOW = datetime.datetime(2024, 1, 1)
+
+
+def snapshot(listing_id: str, price: int, minutes: int, **details) -> dict:
+    row = dict.fromkeys(SCHEMA.names)
+    row.update(
+        id=listing_id,
+        make='Volkswagen',
+        model='Golf',
+        year=2012,
+        ex_gov_price=price,
+        scraped_at=NOW + datetime.timedelta(minutes=minutes),
+        **details,
+    )
+    return row
+
+
+def test_latest_snapshot_keeps_enriched_details(tmp_path):
+    store = ListingStore(tmp_path)
+    store.append(pd.DataFrame([snapshot('a', 20000, 0)]))
+    store.append(
+        pd.DataFrame([snapshot('a', 20000, 1, vin='VIN', colour='Red')])
+    )
+    # the next regular scrape doesn't visit the detail page
+    store.append(
+        pd.DataFrame([snapshot('a', 19000, 2), snapshot('b', 30000, 2)])
+    )
+
+    df = store.load(columns=['id', 'ex_gov_price', 'vin', 'colour'])
+    df = df.set_index('id')
+    assert df.loc['a'].tolist() == [19000, 'VIN', 'Red']
+    assert pd.isna(df.loc['b', 'vin'])
+    cheap = store.load(columns=['id', 'vin'], max_price=19500)
+    assert cheap.values.tolist() == [['a', 'VIN']]
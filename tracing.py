@@ -0,0 +1,258 @@
+import contextvars
+import cProfile
+import io
+import itertools
+import pstats
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from typing import Iterator, Optional
+
+import numpy as np
+import pandas as pd
+from attrs import define, field
+
+SERVICE_NAME = 'carsales'
+PROFILERS = ['cprofile', 'pyinstrument']
+
+# the span code is running in, follows asyncio tasks and to_thread calls
+_current: contextvars.ContextVar[Optional['Span']] = contextvars.ContextVar(
+    'span', default=None
+)
+_tracer: Optional['Tracer'] = None
+
+
+@define
+class Span:
+    name: str
+    span_id: int
+    parent_id: Optional[int]
+    start_ns: int
+    start: float
+    end: Optional[float] = None
+    attributes: dict = field(factory=dict)
+    counts: dict[str, int] = field(factory=dict)
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+
+class Tracer:
+    # collects timed spans and counters for one run, nesting follows the
+    # code that opened them so a fetch lands under its shard
+    def __init__(self):
+        self.trace_id = random.getrandbits(128)
+        self.spans: list[Span] = []
+        self.counts: Counter[str] = Counter()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Span]:
+        parent = _current.get()
+        span = Span(
+            name,
+            next(self._ids),
+            parent.span_id if parent is not None else None,
+            time.time_ns(),
+            time.perf_counter(),
+            attributes=attributes,
+        )
+        token = _current.set(span)
+        try:
+            yield span
+        finally:
+            span.end = time.perf_counter()
+            _current.reset(token)
+            with self._lock:
+                self.spans.append(span)
+
+    def count(self, name: str, n: int = 1):
+        span = _current.get()
+        with self._lock:
+            self.counts[name] += n
+            if span is not None:
+                span.counts[name] = span.counts.get(name, 0) + n
+
+    def summary(self) -> pd.DataFrame:
+        # one row per span name, counters are the mean per span
+        rows = []
+        spans = sorted(self.spans, key=lambda span: span.name)
+        for name, group in itertools.groupby(spans, lambda span: span.name):
+            group = list(group)
+            durations = np.array([span.duration for span in group])
+            row = {
+                'stage': name,
+                'count': len(group),
+                'total_s': durations.sum(),
+                'mean_ms': durations.mean() * 1000,
+                'p50_ms': np.percentile(durations, 50) * 1000,
+                'p90_ms': np.percentile(durations, 90) * 1000,
+                'max_ms': durations.max() * 1000,
+            }
+            counters = Counter()
+            for span in group:
+                counters.update(span.counts)
+            for counter, total in counters.items():
+                row[f'{counter} per span'] = total / len(group)
+            rows.append(row)
+        return (
+            pd.DataFrame(rows)
+            .sort_values('total_s', ascending=False)
+            .reset_index(drop=True)
+            if rows
+            else pd.DataFrame(columns=['stage', 'count', 'total_s'])
+        )
+
+    def to_json(self) -> dict:
+        return {
+            'trace_id': f'{self.trace_id:032x}',
+            'counts': dict(self.counts),
+            'spans': [
+                {
+                    'name': span.name,
+                    'span_id': span.span_id,
+                    'parent_id': span.parent_id,
+                    'start_ns': span.start_ns,
+                    'duration_s': span.duration,
+                    'attributes': span.attributes,
+                    'counts': span.counts,
+                }
+                for span in self.spans
+            ],
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'Tracer':
+        # a finished trace saved by another process, durations only
+        tracer = cls()
+        tracer.trace_id = int(data['trace_id'], 16)
+        tracer.counts.update(data['counts'])
+        tracer.spans = [
+            Span(
+                span['name'],
+                span['span_id'],
+                span['parent_id'],
+                span['start_ns'],
+                0.0,
+                span['duration_s'],
+                span['attributes'],
+                span['counts'],
+            )
+            for span in data['spans']
+        ]
+        return tracer
+
+    def to_otlp(self) -> dict:
+        # OTLP/JSON trace export, what an OpenTelemetry collector accepts
+        # on /v1/traces, without needing the opentelemetry sdk
+        def value(item) -> dict:
+            if isinstance(item, bool):
+                return {'boolValue': item}
+            if isinstance(item, int):
+                return {'intValue': str(item)}
+            if isinstance(item, float):
+                return {'doubleValue': item}
+            return {'stringValue': str(item)}
+
+        def attributes(items: dict) -> list[dict]:
+            return [{'key': k, 'value': value(v)} for k, v in items.items()]
+
+        spans = []
+        for span in self.spans:
+            end_ns = span.start_ns + int(span.duration * 1e9)
+            otlp_span = {
+                'traceId': f'{self.trace_id:032x}',
+                'spanId': f'{span.span_id:016x}',
+                'name': span.name,
+                'kind': 1,
+                'startTimeUnixNano': str(span.start_ns),
+                'endTimeUnixNano': str(end_ns),
+                'attributes': attributes(span.attributes | span.counts),
+            }
+            if span.parent_id is not None:
+                otlp_span['parentSpanId'] = f'{span.parent_id:016x}'
+            spans.append(otlp_span)
+
+        return {
+            'resourceSpans': [
+                {
+                    'resource': {
+                        'attributes': attributes(
+                            {'service.name': SERVICE_NAME}
+                        )
+                    },
+                    'scopeSpans': [
+                        {'scope': {'name': __name__}, 'spans': spans}
+                    ],
+                }
+            ]
+        }
+
+
+def span(name: str, **attributes):
+    # no-op unless a trace is active, so call sites cost next to nothing
+    if _tracer is None:
+        return nullcontext()
+    return _tracer.span(name, **attributes)
+
+
+def count(name: str, n: int = 1):
+    if _tracer is not None:
+        _tracer.count(name, n)
+
+
+@contextmanager
+def tracing() -> Iterator[Tracer]:
+    global _tracer
+    previous, _tracer = _tracer, Tracer()
+    try:
+        yield _tracer
+    finally:
+        _tracer = previous
+
+
+@define
+class Profile:
+    kind: str
+    report: str = ''
+
+
+@contextmanager
+def profiled(kind: Optional[str] = 'cprofile') -> Iterator[Profile]:
+    # opt-in profiler around a block, the text report is filled in on
+    # exit. cProfile only sees the calling thread, pyinstrument also
+    # follows the event loop across awaits
+    profile = Profile(kind or '')
+    if kind is None:
+        yield profile
+    elif kind == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield profile
+        finally:
+            profiler.disable()
+            out = io.StringIO()
+            stats = pstats.Stats(profiler, stream=out)
+            stats.sort_stats('cumulative').print_stats(40)
+            profile.report = out.getvalue()
+    elif kind == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+        except ImportError as error:
+            raise ImportError(
+                'pip install -r requirements-profile.txt to use pyinstrument'
+            ) from error
+        profiler = Profiler(async_mode='enabled')
+        profiler.start()
+        try:
+            yield profile
+        finally:
+            profiler.stop()
+            profile.report = profiler.output_text(unicode=True)
+    else:
+        raise ValueError(f'unknown profiler {kind}')
@@ -1,66 +1,264 @@
-from selenium import webdriver
-from selenium.common.exceptions import NoSuchElementException
-
-driver = webdriver.Firefox()
-
-make = input('Enter car make: ')
-model = input('Enter car model: ')
-yearly_increment = int(input('Enter yearly increment: '))
-year = 2013
-prices = []
-
-while year > 1999:
-    driver.get(
-        'http://www.carsales.com.au/car-valuations/refine/'
-        + make
-        + '/'
-        + model
-        + '/'
-        + str(year)
-        + '/Automatic'
+import datetime
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, Optional
+
+import pandas as pd
+from attrs import asdict, frozen
+
+import tracing
+from driver_pool import DriverPool, PooledDriver
+
+VALUATION_URL = (
+    'https://www.carsales.com.au/car-valuations/refine/'
+    '{make}/{model}/{year}/{transmission}'
+)
+VALUATIONS = Path.cwd().joinpath('data', 'valuations')
+TTL = datetime.timedelta(days=7)
+MAX_WORKERS = 8
+WAIT = 10   # seconds for the valuation card to render
+CARD = 'car-card.ng-scope'
+
+
+class ValuationError(Exception):
+    pass
+
+
+@frozen
+class PriceBand:
+    make: str
+    model: str
+    year: int
+    transmission: str
+    low: Optional[int]
+    high: Optional[int]
+    fetched_at: datetime.datetime
+
+    @property
+    def mid(self) -> Optional[float]:
+        if self.low is None or self.high is None:
+            return None
+        return (self.low + self.high) / 2
+
+    @property
+    def url(self) -> str:
+        return VALUATION_URL.format(
+            make=self.make,
+            model=self.model,
+            year=self.year,
+            transmission=self.transmission,
+        )
+
+
+class ValuationCache:
+    # one json file per make/model/year/transmission, only bands with
+    # prices are kept
+    def __init__(
+        self, directory: Path = VALUATIONS, ttl: datetime.timedelta = TTL
+    ):
+        directory.mkdir(parents=True, exist_ok=True)
+        self.directory = directory
+        self.ttl = ttl
+
+    def _path(
+        self, make: str, model: str, year: int, transmission: str
+    ) -> Path:
+        return self.directory.joinpath(
+            f'{make}_{model}_{year}_{transmission}.json'.lower()
+        )
+
+    def get(
+        self, make: str, model: str, year: int, transmission: str
+    ) -> Optional[PriceBand]:
+        path = self._path(make, model, year, transmission)
+        if not path.exists():
+            return None
+        data = json.loads(path.read_text())
+        fetched_at = datetime.datetime.fromisoformat(data['fetched_at'])
+        if datetime.datetime.now() - fetched_at > self.ttl:
+            return None
+        if data['low'] is None or data['high'] is None:
+            # written by older versions for a page without a card
+            return None
+        return PriceBand(**data | {'fetched_at': fetched_at})
+
+    def put(self, band: PriceBand):
+        path = self._path(
+            band.make, band.model, band.year, band.transmission
+        )
+        data = asdict(band) | {'fetched_at': band.fetched_at.isoformat()}
+        # written then renamed so a crash never leaves half a file
+        temp = path.with_suffix('.tmp')
+        temp.write_text(json.dumps(data))
+        os.replace(temp, path)
+
+
+def _price(text: str) -> int:
+    return int(text.replace(',', '').strip('$* '))
+
+
+def fetch_band(
+    session: PooledDriver,
+    make: str,
+    model: str,
+    year: int,
+    transmission: str = 'Automatic',
+) -> PriceBand:
+    from selenium.common.exceptions import WebDriverException
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support import expected_conditions
+    from selenium.webdriver.support.ui import WebDriverWait
+
+    # there's no element that reliably marks a year without a valuation,
+    # so a missing card, like any other failure, raises ValuationError
+    # and nothing is cached
+    band = PriceBand(
+        make, model, year, transmission, None, None, datetime.datetime.now()
     )
-    driver.implicitly_wait(10)
-    driver.execute_script('window.scrollTo(0, 200)')
+    driver = session.driver
+    wait = WebDriverWait(driver, WAIT)
+
+    # the price band only shows once the first matching variant is picked
     try:
-        car_div = driver.find_element_by_css_selector('car-card.ng-scope')
-        car_div2 = car_div.find_element_by_css_selector('div.hide-mobi')
-        select_button = car_div2.find_element_by_tag_name('button')
-        select_button.click()
-        low_price = int(
-            driver.find_element_by_css_selector('span.price-min')
-            .text.replace(',', '')
-            .strip('$*')
-        )
-        high_price = int(
-            driver.find_element_by_css_selector('span.price-max')
-            .text.replace(',', '')
-            .strip('$*')
+        session.get(band.url)
+        card = wait.until(
+            expected_conditions.presence_of_element_located(
+                (By.CSS_SELECTOR, CARD)
+            )
         )
-        mid_price = (low_price + high_price) / 2
-    except NoSuchElementException:
-        mid_price = 'none found'
-
-    prices.append((year, mid_price))
-    print('Year = {0}, average price = {1}'.format(year, mid_price))
-    year -= yearly_increment
-
-comparison_increment = int(input('Enter comparison increment: '))
-
-for tuple_index, tuple_thing in list(enumerate(prices[:-3])):
-    current_year = tuple_thing[0]
-    current_price = tuple_thing[1]
-    earlier_year = prices[tuple_index + comparison_increment][0]
-    earlier_price = prices[tuple_index + comparison_increment][1]
-    difference_in_yrs = current_year - earlier_year
-    if isinstance(earlier_price, float):
-        drop_off = current_price - earlier_price
-        print(
-            'Drop off in value for {0} car after {1} years: {2}'.format(
-                current_year, difference_in_yrs, drop_off
+        driver.execute_script('arguments[0].scrollIntoView()', card)
+        card.find_element(By.CSS_SELECTOR, 'div.hide-mobi').find_element(
+            By.TAG_NAME, 'button'
+        ).click()
+        low = wait.until(
+            expected_conditions.visibility_of_element_located(
+                (By.CSS_SELECTOR, 'span.price-min')
             )
         )
-    else:
-        print('No data available')
+        high = driver.find_element(By.CSS_SELECTOR, 'span.price-max')
+        return PriceBand(
+            make,
+            model,
+            year,
+            transmission,
+            _price(low.text),
+            _price(high.text),
+            band.fetched_at,
+        )
+    except (WebDriverException, ValueError) as error:
+        # stale or intercepted elements too, so one year can't abort the
+        # others
+        raise ValuationError(
+            f'no price band for {year} {make} {model} at {band.url}: '
+            f'{type(error).__name__}'
+        ) from error
+
+
+def valuations(
+    make: str,
+    model: str,
+    years: Iterable[int],
+    transmission: str = 'Automatic',
+    max_workers: int = MAX_WORKERS,
+    pool: Optional[DriverPool] = None,
+    cache: Optional[ValuationCache] = None,
+) -> list[PriceBand]:
+    # cached years come straight from disk, the rest are fetched at the
+    # same time, one browser session per worker
+    cache = cache or ValuationCache()
+    years = sorted(set(years))
+    bands = {}
+    missing = []
+    for year in years:
+        band = cache.get(make, model, year, transmission)
+        if band is None:
+            missing.append(year)
+        else:
+            bands[year] = band
+    if not missing:
+        return [bands[year] for year in years]
+
+    num_workers = min(max_workers, len(missing))
+    owns_pool = pool is None
+    pool = pool or DriverPool(max_size=num_workers)
+
+    def fetch(year: int) -> PriceBand:
+        with tracing.span('valuation.year', year=year):
+            try:
+                with pool.session() as session:
+                    band = fetch_band(
+                        session, make, model, year, transmission
+                    )
+            except ValuationError as error:
+                # left out of the cache, the next call tries it again
+                print(error)
+                return PriceBand(
+                    make,
+                    model,
+                    year,
+                    transmission,
+                    None,
+                    None,
+                    datetime.datetime.now(),
+                )
+        cache.put(band)
+        return band
+
+    try:
+        # each worker starts its own browser, so they all start at once
+        with ThreadPoolExecutor(num_workers) as executor:
+            for band in executor.map(fetch, missing):
+                bands[band.year] = band
+    finally:
+        if owns_pool:
+            pool.close()
+    return [bands[year] for year in years]
+
+
+def valuation(
+    make: str,
+    model: str,
+    years: Iterable[int],
+    transmission: str = 'Automatic',
+    compare: int = 1,
+    max_workers: int = MAX_WORKERS,
+    pool: Optional[DriverPool] = None,
+    cache: Optional[ValuationCache] = None,
+) -> pd.DataFrame:
+    # low/mid/high price per year, newest first, and how much value a car
+    # of each year loses against the one compare rows further down
+    bands = valuations(
+        make, model, years, transmission, max_workers, pool, cache
+    )
+    df = pd.DataFrame(
+        [
+            {
+                'year': band.year,
+                'low': band.low,
+                'mid': band.mid,
+                'high': band.high,
+                'fetched_at': band.fetched_at,
+            }
+            for band in reversed(bands)
+        ],
+        columns=['year', 'low', 'mid', 'high', 'fetched_at'],
+    )
+    df[['low', 'mid', 'high']] = df[['low', 'mid', 'high']].astype(float)
+    df['years_apart'] = df['year'] - df['year'].shift(-compare)
+    df['drop_off'] = df['mid'] - df['mid'].shift(-compare)
+    df['drop_off_pct'] = df['drop_off'] / df['mid']
+    return df
 
 
-print(prices)
+if __name__ == '__main__':
+    if len(sys.argv) not in (5, 6):
+        print('usage: python valuation.py MAKE MODEL MIN_YEAR MAX_YEAR [STEP]')
+        sys.exit(1)
+    make, model, min_year, max_year = sys.argv[1:5]
+    step = int(sys.argv[5]) if len(sys.argv) == 6 else 1
+    years = range(int(max_year), int(min_year) - 1, -step)
+    with pd.option_context('display.width', 120):
+        print(valuation(make, model, years))